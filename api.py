@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, Response, request, jsonify, send_from_directory, send_file, stream_with_context
 import os
 import io
 import base64
@@ -13,6 +13,7 @@ from pathlib import Path
 import boto3
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
+from exportacao_s3 import exportar, aceita_gzip
 
 # Carregar variáveis do .env
 load_dotenv()
@@ -177,7 +178,12 @@ class ProcessadorXMLTISS:
         except Exception as e:
             logger.error(f"Erro ao parsear XML: {str(e)}")
             return {'error': f'Erro ao processar XML: {str(e)}'}
-        
+
+        self.pacientes = list(self.iterar_pacientes(root))
+        return self.pacientes
+
+    def iterar_pacientes(self, root):
+        """Gera os pacientes um a um, conforme cada guia é processada"""
         numero_lote = self._extrair_texto(root, './/numeroLote')
         logger.info(f"Número do lote extraído: {numero_lote}")
         
@@ -206,9 +212,7 @@ class ProcessadorXMLTISS:
             paciente = self._extrair_dados_guia(guia, numero_lote)
             if paciente:
                 logger.info(f"Paciente {i} extraído - Guia: {paciente.get('numeroGuiaPrestador', 'N/A')}, Nome: {paciente.get('nome', 'N/A')}")
-                self.pacientes.append(paciente)
-        
-        return self.pacientes
+                yield paciente
     
     def _extrair_texto(self, elemento, xpath):
         def remover_namespace(tag):
@@ -331,9 +335,27 @@ def serve_static(path):
         return send_from_directory('.', path)
     return "File not found", 404
 
+# Exportação em streaming (NDJSON/CSV) das listas de pacientes
+COLUNAS_PACIENTE = ['numeroLote', 'numeroGuiaPrestador', 'numeroGuiaOperadora', 'numeroCarteira',
+                    'numeroProtocolo', 'nome', 'numeroDocumento']
+
+
+def resposta_streaming(itens, formato, colunas):
+    """Response Flask que escreve as linhas conforme são geradas (gzip se o cliente aceitar)
+
+    Serialização e compressão vêm de exportacao_s3, as mesmas do /images/export.
+    """
+    blocos, headers = exportar(itens, formato, aceita_gzip(request.headers.get('Accept-Encoding')), colunas)
+    return Response(stream_with_context(blocos), content_type=headers.pop('Content-Type'), headers=headers)
+
+
 @app.route('/api/analisar-xml', methods=['POST', 'OPTIONS'])
 def analisar_xml():
-    """Analisa o XML e retorna todos os pacientes encontrados sem processar"""
+    """Analisa o XML e retorna todos os pacientes encontrados sem processar
+
+    Com ?formato=ndjson ou ?formato=csv (ou "formato" no corpo) os pacientes
+    são enviados em streaming, um por linha, conforme são extraídos.
+    """
     if request.method == 'OPTIONS':
         return '', 204
 
@@ -346,6 +368,16 @@ def analisar_xml():
         if not xml_content:
             return jsonify({'error': 'Nenhum conteúdo XML enviado'}), 400
 
+        formato = request.args.get('formato') or data.get('formato')
+        if formato in ('ndjson', 'csv'):
+            processador = ProcessadorXMLTISS(xml_content)
+            try:
+                root = ET.fromstring(xml_content)
+            except Exception as e:
+                logger.error(f"❌ Erro ao analisar XML: {str(e)}")
+                return jsonify({'error': f'Erro ao processar XML: {str(e)}'}), 400
+            return resposta_streaming(processador.iterar_pacientes(root), formato, COLUNAS_PACIENTE)
+
         processador = ProcessadorXMLTISS(xml_content)
         pacientes = processador.extrair_pacientes()
 
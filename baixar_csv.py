@@ -1,10 +1,16 @@
 import boto3
 import csv
 import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
 from pathlib import Path
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from collections import deque
+from threading import Lock, Condition, Thread
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
 # Carregar variáveis do .env
@@ -17,6 +23,20 @@ AWS_REGION = os.getenv('AWS_REGION', 'sa-east-1')
 BUCKET_NAME = os.getenv('S3_BUCKET_NAME', 'aplis2')
 IMAGE_PREFIX = 'lab/Arquivos/Foto/'
 
+# Threads de download por etapa; o pool de conexões do cliente é dimensionado por elas
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '20'))
+# Threads das listagens de pré-passo (índices de imagens e laudos)
+LISTAGEM_WORKERS = 8
+# Imagens e laudos dividem as mesmas threads: peso na divisão quando os dois têm
+# trabalho na fila e máximo de threads de cada tipo ao mesmo tempo
+PRIORIDADES_DOWNLOAD = {'imagem': 2, 'laudo': 1}
+LIMITES_DOWNLOAD = {
+    'imagem': int(os.getenv('DOWNLOAD_LIMITE_IMAGENS', str(DOWNLOAD_WORKERS))),
+    'laudo': int(os.getenv('DOWNLOAD_LIMITE_LAUDOS', str(DOWNLOAD_WORKERS))),
+}
+# Ao interromper (Ctrl+C), quanto esperar (segundos) os downloads em andamento terminarem
+ESPERA_PARADA = float(os.getenv('DOWNLOAD_ESPERA_PARADA', '30'))
+
 # Caminhos
 CSV_PATH = r"C:\Users\supor\Desktop\Lista\requisicaoimagem_filtrada_final.csv"
 DESTINO_IMAGENS = Path(r"C:\Users\supor\Desktop\imagemAWS")
@@ -54,19 +74,45 @@ PREFIXOS_LAUDOS = {
     '0032': 'lab/Arquivos/Historico/0032/',
 }
 
-def conectar_s3():
-    """Conecta ao S3 com configurações otimizadas"""
+def conectar_s3(max_conexoes=DOWNLOAD_WORKERS + LISTAGEM_WORKERS):
+    """Conecta ao S3 com configurações otimizadas
+
+    Clientes boto3 são thread-safe: crie um por execução e compartilhe entre as
+    threads (criar um por tarefa custa CPU e memória e desperdiça conexões).
+    """
     return boto3.client(
         's3',
         aws_access_key_id=AWS_ACCESS_KEY,
         aws_secret_access_key=AWS_SECRET_KEY,
         region_name=AWS_REGION,
         config=boto3.session.Config(
-            max_pool_connections=50,  # Aumenta pool de conexões
+            max_pool_connections=max_conexoes,  # Uma conexão por thread que usa o cliente
             retries={'max_attempts': 2}  # Reduz tentativas de retry
         )
     )
 
+def contar_requisicoes(s3_client):
+    """Passa a contar as requisições do cliente (eventos públicos do botocore)
+
+    Retorna um dict atualizado a cada chamada: 'chamadas' (operações da API) e
+    'envios' (requisições HTTP, incluindo as repetidas pelos retries).
+    """
+    contagem = {'chamadas': 0, 'envios': 0}
+    lock = Lock()
+
+    def contador(campo):
+        def contar(**kwargs):
+            with lock:
+                contagem[campo] += 1
+        return contar
+
+    s3_client.meta.events.register('before-send.s3', contador('envios'))
+    s3_client.meta.events.register('after-call.s3', contador('chamadas'))
+    return contagem
+
+def resumo_requisicoes(contagem):
+    return f"{contagem['chamadas']} chamadas em {contagem['envios']} requisições HTTP (com retries)"
+
 def detectar_prefixo(nome_arquivo, prefixos_dict, default_prefix):
     """Detecta o prefixo da pasta baseado no nome do arquivo"""
     for codigo, caminho in prefixos_dict.items():
@@ -118,15 +164,398 @@ def buscar_arquivo_s3(s3_client, nome_arquivo, extensao, prefixos_dict, default_
     except Exception as e:
         return None
 
+# Quanto uma página de LIST (1000 keys) "custa" em HEADs: preço por chamada e latência maiores
+CUSTO_LIST_EM_HEADS = 5
+
+def objeto_ausente(erro):
+    """ClientError de objeto inexistente (404/NoSuchKey)"""
+    return erro.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+class ResolvedorImagens:
+    """Resolve nome do arquivo -> key, escolhendo por pasta entre HEAD por linha e uma listagem
+
+    Pastas com muitas linhas no CSV (em relação ao tamanho) são listadas uma vez
+    numa tabela por nome minúsculo; a listagem é abandonada se passar do custo
+    dos HEADs daquela pasta. No modo HEAD, um 404 lista só as keys que começam
+    com o trecho do nome sem letras (o código) para a comparação sem
+    maiúsculas. Faltas ficam em cache; outros erros do S3 sobem para quem chamou.
+    """
+
+    def __init__(self, s3_client, custo_list=CUSTO_LIST_EM_HEADS):
+        self.s3 = s3_client
+        self.custo_list = custo_list
+        # prefixo -> {nome minúsculo: [keys]}; ausente = modo HEAD
+        self._tabelas = {}
+        self._locks = {}
+        self._negativos = set()
+        self._lock = Lock()
+        self.stats = {'head': 0, 'list': 0, 'negativos_em_cache': 0, 'pastas_listadas': 0, 'pastas_head': 0}
+
+    def _contar(self, campo, n=1):
+        with self._lock:
+            self.stats[campo] += n
+
+    def _listar(self, prefixo, max_paginas=None):
+        """Tabela nome minúsculo -> keys da pasta; None se passar de `max_paginas`"""
+        tabela = {}
+        paginator = self.s3.get_paginator('list_objects_v2')
+        paginas = 0
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefixo, PaginationConfig={'PageSize': 1000}):
+            paginas += 1
+            self._contar('list')
+            for obj in page.get('Contents', []):
+                tabela.setdefault(obj['Key'].split('/')[-1].lower(), []).append(obj['Key'])
+            if max_paginas is not None and paginas >= max_paginas and page.get('IsTruncated'):
+                return None
+        return tabela
+
+    def preparar(self, linhas_por_prefixo, max_workers=8):
+        """Lista as pastas em que a listagem sai mais barata que os HEADs das suas linhas"""
+        for prefixo in linhas_por_prefixo:
+            self._locks.setdefault(prefixo, Lock())
+
+        def preparar_pasta(prefixo, linhas):
+            # Uma página sempre vale a pena (pastas pequenas); depois, só até empatar com os HEADs
+            tabela = self._listar(prefixo, max_paginas=max(1, linhas // self.custo_list))
+            if tabela is not None:
+                with self._lock:
+                    self._tabelas[prefixo] = tabela
+            self._contar('pastas_listadas' if tabela is not None else 'pastas_head')
+
+        if not linhas_por_prefixo:
+            return
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(linhas_por_prefixo))) as executor:
+            futures = [executor.submit(preparar_pasta, prefixo, linhas)
+                       for prefixo, linhas in linhas_por_prefixo.items()]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"[ERRO] Falha ao listar pasta de imagens: {e}")
+
+    def _tabela_completa(self, prefixo):
+        """Tabela da pasta, listando-a por inteiro na primeira vez (uma thread só lista)"""
+        with self._lock:
+            tabela = self._tabelas.get(prefixo)
+            lock = self._locks.setdefault(prefixo, Lock())
+        if tabela is not None:
+            return tabela
+        with lock:
+            with self._lock:
+                tabela = self._tabelas.get(prefixo)
+            if tabela is None:
+                tabela = self._listar(prefixo)
+                with self._lock:
+                    self._tabelas[prefixo] = tabela
+            return tabela
+
+    def resolver(self, nome_arquivo, extensao):
+        """Key do arquivo no S3 (nome exato preferido, senão sem diferenciar maiúsculas) ou None"""
+        prefixo = detectar_prefixo(nome_arquivo, PREFIXOS_IMAGENS, IMAGE_PREFIX)
+        nome_completo = f"{nome_arquivo}.{extensao.lower()}"
+        caminho_direto = f"{prefixo}{nome_completo}"
+        negativo = (prefixo, nome_completo.lower())
+
+        with self._lock:
+            if negativo in self._negativos:
+                self.stats['negativos_em_cache'] += 1
+                return None
+            tabela = self._tabelas.get(prefixo)
+
+        if tabela is None:
+            self._contar('head')
+            try:
+                self.s3.head_object(Bucket=BUCKET_NAME, Key=caminho_direto)
+                return caminho_direto
+            except ClientError as e:
+                # Throttling, 403, 5xx: é erro, não "não encontrado" (nem vai para o cache)
+                if not objeto_ausente(e):
+                    raise
+            # Maiúsculas só mudam as letras: as keys candidatas começam com o mesmo
+            # trecho até a primeira letra, e só ele é listado (não a pasta inteira)
+            trecho = nome_completo[:next((i for i, c in enumerate(nome_completo) if c.lower() != c.upper()),
+                                         len(nome_completo))]
+            tabela = self._listar(prefixo + trecho) if trecho else self._tabela_completa(prefixo)
+
+        keys = tabela.get(nome_completo.lower())
+        if not keys:
+            with self._lock:
+                self._negativos.add(negativo)
+            return None
+        return caminho_direto if caminho_direto in keys else keys[0]
+
+def prefixo_laudo_de(nome_arquivo):
+    """Pasta do Histórico onde procurar o laudo (pelos 4 primeiros dígitos do código)"""
+    codigo_empresa = nome_arquivo[:4] if len(nome_arquivo) >= 4 else ""
+    return PREFIXOS_LAUDOS.get(codigo_empresa, 'lab/Arquivos/Historico/')
+
+class IndiceLaudos:
+    """Keys do Histórico listadas uma vez por pasta, ordenadas pelo nome do arquivo
+
+    Substitui a listagem da pasta inteira a cada linha do CSV: a busca por
+    código vira uma bisseção no nome (minúsculo) e o desempate pelo LastModified.
+    Pastas que falharem no carregar têm uma nova tentativa; pastas que ninguém
+    pediu no pré-passo são listadas na primeira linha que precisar delas.
+    """
+
+    def __init__(self):
+        # prefixo listado -> (nomes minúsculos ordenados, [(LastModified, key)] na mesma ordem)
+        self._pastas = {}
+        self.falhas = {}
+        self.objetos = 0
+        self.chamadas_list = 0
+        self._lock = Lock()
+        self._locks = {}
+
+    def _listar(self, s3_client, prefixo):
+        itens = []
+        chamadas = 0
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefixo, PaginationConfig={'PageSize': 1000}):
+            chamadas += 1
+            for obj in page.get('Contents', []):
+                itens.append((obj['Key'].split('/')[-1].lower(), obj['LastModified'], obj['Key']))
+        itens.sort(key=lambda item: item[0])
+        return [item[0] for item in itens], [item[1:] for item in itens], chamadas
+
+    def _registrar(self, prefixo, listagem):
+        nomes, objetos, chamadas = listagem
+        with self._lock:
+            self._pastas[prefixo] = (nomes, objetos)
+            self.falhas.pop(prefixo, None)
+            self.objetos += len(nomes)
+            self.chamadas_list += chamadas
+
+    def carregar(self, s3_client, prefixos, max_workers=8, tentativas=2):
+        """Lista cada prefixo necessário uma única vez (em paralelo)
+
+        Prefixos contidos em outro já listado (ex: a raiz do Histórico) não são
+        listados de novo: a busca usa a listagem maior e filtra pelo caminho.
+        Os que falharem são listados de novo, até `tentativas` vezes no total.
+        """
+        prefixos = sorted(set(prefixos))
+        listar = [p for p in prefixos if not any(p != outro and p.startswith(outro) for outro in prefixos)]
+        for tentativa in range(1, tentativas + 1):
+            if not listar:
+                return
+            falharam = []
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(listar))) as executor:
+                futures = {executor.submit(self._listar, s3_client, prefixo): prefixo for prefixo in listar}
+                for future in as_completed(futures):
+                    prefixo = futures[future]
+                    try:
+                        self._registrar(prefixo, future.result())
+                    except Exception as e:
+                        self.falhas[prefixo] = str(e)
+                        falharam.append(prefixo)
+                        print(f"[ERRO] Falha ao listar {prefixo} (tentativa {tentativa}/{tentativas}): {e}")
+            listar = falharam
+
+    def cobre(self, prefixo):
+        return any(prefixo.startswith(listado) for listado in list(self._pastas))
+
+    def garantir(self, s3_client, prefixo):
+        """Lista `prefixo` se nenhuma listagem o cobrir (uma thread só lista, uma vez)
+
+        Pasta cuja listagem já falhou não é listada de novo a cada linha: o erro
+        sobe para quem chamou.
+        """
+        if self.cobre(prefixo):
+            return
+        with self._lock:
+            lock = self._locks.setdefault(prefixo, Lock())
+        with lock:
+            if self.cobre(prefixo):
+                return
+            with self._lock:
+                falha = next((erro for listado, erro in self.falhas.items() if prefixo.startswith(listado)), None)
+            if falha is not None:
+                raise RuntimeError(f"listagem de {prefixo} falhou: {falha}")
+            try:
+                self._registrar(prefixo, self._listar(s3_client, prefixo))
+            except Exception as e:
+                with self._lock:
+                    self.falhas[prefixo] = str(e)
+                raise
+
+    def mais_recente(self, prefixo, codigo):
+        """Key mais recente (LastModified) cujo nome começa com `codigo`, ou None"""
+        codigo = codigo.lower()
+        candidatos = []
+        for listado, (nomes, objetos) in list(self._pastas.items()):
+            if not prefixo.startswith(listado):
+                continue
+            i = bisect_left(nomes, codigo)
+            while i < len(nomes) and nomes[i].startswith(codigo):
+                if objetos[i][1].startswith(prefixo):
+                    candidatos.append(objetos[i])
+                i += 1
+        if not candidatos:
+            return None
+        return max(candidatos, key=lambda objeto: objeto[0])[1]
+
+def buscar_laudo_listando(s3, prefixo_laudo, nome_arquivo):
+    """Busca o laudo listando a pasta inteira (usada quando não há IndiceLaudos)"""
+    paginator = s3.get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        Bucket=BUCKET_NAME,
+        Prefix=prefixo_laudo,
+        PaginationConfig={'PageSize': 1000}
+    )
+
+    candidatos = []
+    for page in pages:
+        if 'Contents' not in page:
+            continue
+
+        for obj in page['Contents']:
+            file_name = obj['Key'].split('/')[-1]
+            # Verifica se o nome do arquivo na nuvem começa com o código da requisição
+            if file_name.lower().startswith(nome_arquivo.lower()):
+                candidatos.append(obj)
+
+    # Se encontrou arquivos que começam com o código, escolhe o mais recente
+    if candidatos:
+        candidatos.sort(key=lambda o: o['LastModified'], reverse=True)
+        return candidatos[0]['Key']
+    return None
+
+class ManifestoExecucao:
+    """Manifesto persistente (SQLite) do que cada linha do CSV já resolveu e baixou
+
+    Guarda por (tipo, nome) a key no S3, ETag, tamanho e status ('baixado',
+    'nao_encontrado' ou 'falha'). Ao retomar, linhas baixadas (com o arquivo
+    local ainda íntegro) ou sabidamente ausentes são puladas sem tocar no S3 e
+    keys já resolvidas não são buscadas de novo. Gravações são agrupadas (a cada 200 registros ou 2s) e `fechar()`
+    grava o resto.
+    """
+
+    FINAIS = ('baixado', 'nao_encontrado')
+
+    def __init__(self, caminho, retentar_faltantes=False):
+        self.caminho = Path(caminho)
+        self.retentar_faltantes = retentar_faltantes
+        self._conn = sqlite3.connect(str(self.caminho), timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS linhas (
+                tipo TEXT NOT NULL,
+                nome TEXT NOT NULL,
+                key TEXT,
+                etag TEXT,
+                tamanho INTEGER,
+                status TEXT NOT NULL,
+                atualizado_em REAL NOT NULL,
+                PRIMARY KEY (tipo, nome)
+            )
+        ''')
+        self._conn.commit()
+        self._lock = Lock()
+        self._pendentes = []
+        self._gravado_em = time.time()
+        self._registros = {
+            (tipo, nome): {'key': key, 'etag': etag, 'tamanho': tamanho, 'status': status}
+            for tipo, nome, key, etag, tamanho, status in self._conn.execute(
+                'SELECT tipo, nome, key, etag, tamanho, status FROM linhas')
+        }
+        self.pulados = {}
+
+    def __len__(self):
+        return len(self._registros)
+
+    def obter(self, tipo, nome):
+        with self._lock:
+            return self._registros.get((tipo, nome))
+
+    def concluida(self, tipo, nome, destino=None):
+        """A linha já terminou numa execução anterior (e não precisa de S3 agora)?
+
+        'baixado' só vale se o arquivo `destino` ainda existir com o tamanho
+        registrado: apagado ou truncado depois, a linha é baixada de novo.
+        """
+        registro = self.obter(tipo, nome)
+        if registro is None or registro['status'] not in self.FINAIS:
+            return False
+        if registro['status'] == 'baixado':
+            return destino is not None and arquivo_completo(destino, registro['tamanho'])
+        return not self.retentar_faltantes
+
+    def contar_pulo(self, tipo):
+        with self._lock:
+            self.pulados[tipo] = self.pulados.get(tipo, 0) + 1
+
+    def registrar(self, tipo, nome, status, key=None, etag=None, tamanho=None):
+        with self._lock:
+            if self._conn is None:
+                # Já fechado (execução interrompida): resultados tardios ficam de fora
+                return
+            self._registros[(tipo, nome)] = {'key': key, 'etag': etag, 'tamanho': tamanho, 'status': status}
+            self._pendentes.append((tipo, nome, key, etag, tamanho, status, time.time()))
+            if len(self._pendentes) >= 200 or time.time() - self._gravado_em >= 2:
+                self._gravar()
+
+    def _gravar(self):
+        # Chamado com o lock
+        if self._pendentes:
+            with self._conn:
+                self._conn.executemany('''
+                    INSERT OR REPLACE INTO linhas(tipo, nome, key, etag, tamanho, status, atualizado_em)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', self._pendentes)
+            self._pendentes = []
+        self._gravado_em = time.time()
+
+    def fechar(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._gravar()
+            self._conn.close()
+            self._conn = None
+
+def arquivo_completo(destino, tamanho):
+    """O arquivo local existe e tem exatamente `tamanho` bytes?"""
+    try:
+        return tamanho is not None and destino.stat().st_size == tamanho
+    except OSError:
+        return False
+
+def metadados_s3(s3_client, key):
+    """{'etag', 'tamanho'} do objeto (HEAD) ou None se não for possível consultar"""
+    try:
+        resposta = s3_client.head_object(Bucket=BUCKET_NAME, Key=key)
+    except Exception:
+        return None
+    return {'etag': resposta.get('ETag', '').strip('"'), 'tamanho': resposta['ContentLength']}
+
+def destino_laudo(key):
+    return DESTINO_LAUDOS / key.split('/')[-1]
+
 def baixar_arquivo(s3_client, key, destino):
-    """Baixa arquivo do S3"""
+    """Baixa arquivo do S3; retorna {'etag', 'tamanho'} ou None se falhar
+
+    Grava num temporário (.part) e só renomeia para o destino depois de
+    conferir o tamanho: um download interrompido nunca deixa arquivo truncado
+    com o nome final. Usa a conexão da própria thread (sem threads extras).
+    """
+    parcial = destino.with_name(f"{destino.name}.{threading.get_ident()}.part")
     try:
-        s3_client.download_file(BUCKET_NAME, key, str(destino))
-        return True
+        resposta = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)
+        with open(parcial, 'wb') as f:
+            for bloco in resposta['Body'].iter_chunks(256 * 1024):
+                f.write(bloco)
+        tamanho = parcial.stat().st_size
+        if tamanho != resposta['ContentLength']:
+            raise IOError(f"{key}: {tamanho} de {resposta['ContentLength']} bytes")
+        os.replace(parcial, destino)
+        return {'etag': resposta.get('ETag', '').strip('"'), 'tamanho': tamanho}
     except Exception as e:
-        return False
+        parcial.unlink(missing_ok=True)
+        print(f"[ERRO] Falha ao baixar {key}: {e}")
+        return None
 
-def processar_imagem(linha, s3, total, contadores, lock, erros):
+def processar_imagem(linha, s3, total, contadores, lock, erros, resolvedor=None, manifesto=None):
     """Processa uma imagem individualmente (usado em paralelo)"""
     nome_arquivo = linha['NomArquivo'].strip()
     extensao = linha['ExtArquivo'].strip()
@@ -134,18 +563,32 @@ def processar_imagem(linha, s3, total, contadores, lock, erros):
     nome_completo = f"{nome_arquivo}.{extensao.lower()}"
     destino = DESTINO_IMAGENS / nome_completo
 
-    # Verificar se já existe
-    if destino.exists():
+    # Manifesto: já baixada ou sabidamente ausente numa execução anterior
+    registro = manifesto.obter('imagem', nome_completo) if manifesto is not None else None
+    if registro and manifesto.concluida('imagem', nome_completo, destino):
+        manifesto.contar_pulo('imagem')
         with lock:
-            contadores['ja_existe'] += 1
             contadores['processados'] += 1
-            print(f"[IMAGEM {contadores['processados']}/{total}] {nome_completo:<40} JÁ EXISTE")
+            if registro['status'] == 'baixado':
+                contadores['ja_existe'] += 1
+                print(f"[IMAGEM {contadores['processados']}/{total}] {nome_completo:<40} JÁ BAIXADO (MANIFESTO)")
+            else:
+                contadores['nao_encontrado'] += 1
+                erros.append(f"IMAGEM: {nome_completo} - Não encontrado no S3")
+                print(f"[IMAGEM {contadores['processados']}/{total}] {nome_completo:<40} NÃO ENCONTRADO (MANIFESTO)")
         return
 
-    # Buscar no S3
-    key = buscar_arquivo_s3(s3, nome_arquivo, extensao, PREFIXOS_IMAGENS, IMAGE_PREFIX)
+    # Buscar no S3 (a key resolvida numa execução anterior dispensa a busca)
+    if registro and registro['key']:
+        key = registro['key']
+    elif resolvedor is not None:
+        key = resolvedor.resolver(nome_arquivo, extensao)
+    else:
+        key = buscar_arquivo_s3(s3, nome_arquivo, extensao, PREFIXOS_IMAGENS, IMAGE_PREFIX)
 
     if not key:
+        if manifesto is not None:
+            manifesto.registrar('imagem', nome_completo, 'nao_encontrado')
         with lock:
             contadores['nao_encontrado'] += 1
             contadores['processados'] += 1
@@ -153,9 +596,25 @@ def processar_imagem(linha, s3, total, contadores, lock, erros):
             print(f"[IMAGEM {contadores['processados']}/{total}] {nome_completo:<40} NÃO ENCONTRADO")
         return
 
-    # Baixar
-    if baixar_arquivo(s3, key, destino):
-        tamanho_kb = destino.stat().st_size / 1024
+    # Arquivo de uma execução anterior: só vale se o tamanho bater com o do S3
+    if destino.exists():
+        metadados = metadados_s3(s3, key)
+        if metadados and arquivo_completo(destino, metadados['tamanho']):
+            if manifesto is not None:
+                manifesto.registrar('imagem', nome_completo, 'baixado', key, **metadados)
+            with lock:
+                contadores['ja_existe'] += 1
+                contadores['processados'] += 1
+                print(f"[IMAGEM {contadores['processados']}/{total}] {nome_completo:<40} JÁ EXISTE")
+            return
+
+    # Baixar (substitui o arquivo incompleto, se houver)
+    baixado = baixar_arquivo(s3, key, destino)
+    if manifesto is not None:
+        manifesto.registrar('imagem', nome_completo, 'baixado' if baixado else 'falha', key,
+                            **(baixado or {}))
+    if baixado:
+        tamanho_kb = baixado['tamanho'] / 1024
         with lock:
             contadores['sucesso'] += 1
             contadores['processados'] += 1
@@ -167,7 +626,7 @@ def processar_imagem(linha, s3, total, contadores, lock, erros):
             erros.append(f"IMAGEM: {nome_completo} - Erro ao baixar")
             print(f"[IMAGEM {contadores['processados']}/{total}] {nome_completo:<40} ERRO AO BAIXAR")
 
-def processar_laudo(linha, s3, total, contadores, lock, erros):
+def processar_laudo(linha, s3, total, contadores, lock, erros, indice=None, manifesto=None):
     """Processa um laudo individualmente (usado em paralelo)"""
     nome_arquivo = linha['CodRequisicao_extraido'].strip()
 
@@ -179,48 +638,49 @@ def processar_laudo(linha, s3, total, contadores, lock, erros):
             print(f"[LAUDO {contadores['processados']}/{total}] {'(vazio)':<40} PULADO - SEM LAUDO")
         return
 
-    codigo_empresa = nome_arquivo[:4] if len(nome_arquivo) >= 4 else ""
-    if codigo_empresa in PREFIXOS_LAUDOS:
-        prefixo_laudo = PREFIXOS_LAUDOS[codigo_empresa]
-    else:
-        prefixo_laudo = 'lab/Arquivos/Historico/'
+    # Manifesto: já baixado ou sabidamente ausente numa execução anterior
+    registro = manifesto.obter('laudo', nome_arquivo) if manifesto is not None else None
+    if registro and manifesto.concluida('laudo', nome_arquivo,
+                                        destino_laudo(registro['key']) if registro['key'] else None):
+        manifesto.contar_pulo('laudo')
+        nome_completo = registro['key'].split('/')[-1] if registro['key'] else f"{nome_arquivo}.pdf"
+        with lock:
+            contadores['processados'] += 1
+            if registro['status'] == 'baixado':
+                contadores['ja_existe'] += 1
+                print(f"[LAUDO {contadores['processados']}/{total}] {nome_completo:<40} JÁ BAIXADO (MANIFESTO)")
+            else:
+                contadores['nao_encontrado'] += 1
+                erros.append(f"LAUDO: {nome_completo} - Não encontrado no S3")
+                print(f"[LAUDO {contadores['processados']}/{total}] {nome_completo:<40} NÃO ENCONTRADO (MANIFESTO)")
+        return
+
+    prefixo_laudo = prefixo_laudo_de(nome_arquivo)
 
     key = None
+    erro_busca = False
     try:
-        paginator = s3.get_paginator('list_objects_v2')
-        pages = paginator.paginate(
-            Bucket=BUCKET_NAME,
-            Prefix=prefixo_laudo,
-            PaginationConfig={'PageSize': 1000}
-        )
-
-        candidatos = []
-        for page in pages:
-            if 'Contents' not in page:
-                continue
-
-            for obj in page['Contents']:
-                file_name = obj['Key'].split('/')[-1]
-                # Verifica se o nome do arquivo na nuvem começa com o código da requisição
-                if file_name.lower().startswith(nome_arquivo.lower()):
-                    candidatos.append(obj)
-        
-        # Se encontrou arquivos que começam com o código, escolhe o mais recente
-        if candidatos:
-            # Ordena os candidatos pela data de modificação (mais recente primeiro)
-            candidatos.sort(key=lambda o: o['LastModified'], reverse=True)
-            key = candidatos[0]['Key'] # Pega o mais recente
-
+        if registro and registro['key']:
+            key = registro['key']
+        elif indice is not None:
+            indice.garantir(s3, prefixo_laudo)
+            key = indice.mais_recente(prefixo_laudo, nome_arquivo)
+        else:
+            key = buscar_laudo_listando(s3, prefixo_laudo, nome_arquivo)
     except Exception as e:
         key = None
+        erro_busca = True
         print(f"[ERRO] Falha ao listar laudos para {nome_arquivo}: {e}")
 
     # Define o nome do arquivo de destino com base no que foi encontrado
     if key:
         nome_completo = key.split('/')[-1]
-        destino = DESTINO_LAUDOS / nome_completo
-        # Verifica se o arquivo mais recente já existe localmente
-        if destino.exists():
+        destino = destino_laudo(key)
+        # O arquivo mais recente já existe localmente (e com o tamanho do S3)?
+        metadados = metadados_s3(s3, key) if destino.exists() else None
+        if metadados and arquivo_completo(destino, metadados['tamanho']):
+            if manifesto is not None:
+                manifesto.registrar('laudo', nome_arquivo, 'baixado', key, **metadados)
             with lock:
                 contadores['ja_existe'] += 1
                 contadores['processados'] += 1
@@ -230,6 +690,9 @@ def processar_laudo(linha, s3, total, contadores, lock, erros):
         nome_completo = f"{nome_arquivo}.pdf" # Nome padrão para logs de erro
 
     if not key:
+        # Falha na listagem não é "não encontrado": fica fora do manifesto e é refeita
+        if manifesto is not None and not erro_busca:
+            manifesto.registrar('laudo', nome_arquivo, 'nao_encontrado')
         with lock:
             contadores['nao_encontrado'] += 1
             contadores['processados'] += 1
@@ -237,10 +700,13 @@ def processar_laudo(linha, s3, total, contadores, lock, erros):
             print(f"[LAUDO {contadores['processados']}/{total}] {nome_completo:<40} NÃO ENCONTRADO")
         return
 
-    # Baixar
-    destino = DESTINO_LAUDOS / nome_completo
-    if baixar_arquivo(s3, key, destino):
-        tamanho_kb = destino.stat().st_size / 1024
+    # Baixar (substitui o arquivo incompleto, se houver)
+    destino = destino_laudo(key)
+    baixado = baixar_arquivo(s3, key, destino)
+    if manifesto is not None:
+        manifesto.registrar('laudo', nome_arquivo, 'baixado' if baixado else 'falha', key, **(baixado or {}))
+    if baixado:
+        tamanho_kb = baixado['tamanho'] / 1024
         with lock:
             contadores['sucesso'] += 1
             contadores['processados'] += 1
@@ -252,8 +718,123 @@ def processar_laudo(linha, s3, total, contadores, lock, erros):
             erros.append(f"LAUDO: {nome_completo} - Erro ao baixar")
             print(f"[LAUDO {contadores['processados']}/{total}] {nome_completo:<40} ERRO AO BAIXAR")
 
-def processar_csv():
-    """Processa o CSV e baixa IMAGENS e LAUDOS em 2 etapas"""
+class AgendadorDownloads:
+    """Um único pool de threads para vários tipos de tarefa (imagens e laudos)
+
+    Cada thread livre pega a próxima tarefa do tipo com menos threads em uso em
+    relação à sua prioridade (peso), respeitando o limite de cada tipo. Assim os
+    tipos andam juntos e, quando um acaba, o outro ocupa as threads livres: o
+    tempo total fica perto da etapa mais longa, não da soma das etapas.
+    """
+
+    def __init__(self, workers, prioridades=None, limites=None):
+        self.workers = workers
+        self.prioridades = prioridades or {}
+        self.limites = limites or {}
+        self._filas = {}
+        self._em_andamento = {}
+        self._cond = Condition()
+        self._parado = False
+        self.stats = {}
+
+    def _tipo(self, tipo):
+        if tipo not in self._filas:
+            self._filas[tipo] = deque()
+            self._em_andamento[tipo] = 0
+            self.stats[tipo] = {'enfileiradas': 0, 'concluidas': 0, 'erros': 0, 'inicio': None, 'fim': None}
+
+    def adicionar(self, tipo, func, *args):
+        with self._cond:
+            self._tipo(tipo)
+            self._filas[tipo].append((func, args))
+            self.stats[tipo]['enfileiradas'] += 1
+            self._cond.notify()
+
+    def _proxima(self):
+        # Chamado com o lock
+        if self._parado:
+            return None
+        elegiveis = [
+            tipo for tipo, fila in self._filas.items()
+            if fila and self._em_andamento[tipo] < self.limites.get(tipo, self.workers)
+        ]
+        if not elegiveis:
+            return None
+        tipo = min(elegiveis, key=lambda t: self._em_andamento[t] / self.prioridades.get(t, 1))
+        func, args = self._filas[tipo].popleft()
+        self._em_andamento[tipo] += 1
+        if self.stats[tipo]['inicio'] is None:
+            self.stats[tipo]['inicio'] = datetime.now()
+        return tipo, func, args
+
+    def _pendentes(self):
+        return any(self._filas.values()) or any(self._em_andamento.values())
+
+    def _loop(self, ao_falhar):
+        while True:
+            with self._cond:
+                tarefa = self._proxima()
+                while tarefa is None:
+                    if self._parado or not self._pendentes():
+                        return
+                    self._cond.wait()
+                    tarefa = self._proxima()
+            tipo, func, args = tarefa
+            erro = None
+            try:
+                func(*args)
+            except Exception as e:
+                erro = e
+            with self._cond:
+                self._em_andamento[tipo] -= 1
+                self.stats[tipo]['concluidas'] += 1
+                self.stats[tipo]['fim'] = datetime.now()
+                if erro is not None:
+                    self.stats[tipo]['erros'] += 1
+                # Libera vaga do tipo (e talvez o fim): acorda quem estiver esperando
+                self._cond.notify_all()
+            if erro is not None and ao_falhar:
+                ao_falhar(tipo, erro)
+
+    def parar(self):
+        """Não começa mais tarefas; as que já estão rodando terminam normalmente"""
+        with self._cond:
+            self._parado = True
+            self._cond.notify_all()
+
+    def executar(self, ao_falhar=None, espera_parada=ESPERA_PARADA):
+        """Roda até esvaziar todas as filas; ao_falhar(tipo, exceção) para erros inesperados
+
+        Se interrompido (Ctrl+C), para de pegar tarefas e espera até
+        `espera_parada` segundos as que estão em andamento antes de repassar a exceção.
+        """
+        threads = [Thread(target=self._loop, args=(ao_falhar,), name=f'download-{i}', daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            self.parar()
+            limite = time.time() + espera_parada
+            for thread in threads:
+                thread.join(max(0, limite - time.time()))
+            raise
+
+    def tempo(self, tipo):
+        """Segundos entre a primeira tarefa do tipo começar e a última terminar"""
+        stats = self.stats.get(tipo)
+        if not stats or stats['inicio'] is None:
+            return 0.0
+        return (stats['fim'] - stats['inicio']).total_seconds()
+
+def processar_csv(retentar_faltantes=False):
+    """Processa o CSV e baixa IMAGENS e LAUDOS (as duas etapas intercaladas no mesmo pool)
+
+    Retomável: o manifesto ao lado do log de erros lembra o que cada linha já
+    resolveu; retentar_faltantes volta a procurar no S3 o que estava ausente.
+    """
     print("="*80)
     print("DOWNLOAD AUTOMÁTICO - IMAGENS E LAUDOS DO S3")
     print("="*80)
@@ -274,17 +855,18 @@ def processar_csv():
 
     total = len(linhas)
     print(f"[INFO] Total de registros: {total}")
-    print(f"[INFO] Usando 20 threads paralelas para download ultra-rápido")
+    print(f"[INFO] Usando {DOWNLOAD_WORKERS} threads paralelas com um único cliente S3")
+
+    # Um cliente (e um pool de conexões) para a execução inteira
+    s3 = conectar_s3()
+    requisicoes = contar_requisicoes(s3)
+
+    manifesto = ManifestoExecucao(DESTINO_IMAGENS.parent / 'manifesto_download.db', retentar_faltantes)
+    print(f"[INFO] Manifesto: {manifesto.caminho} ({len(manifesto)} linhas de execuções anteriores)")
 
     inicio_geral = datetime.now()
     erros = []
-
-    # ============================================================
-    # ETAPA 1: BAIXAR IMAGENS
-    # ============================================================
-    print("\n" + "="*80)
-    print("ETAPA 1/2: BAIXANDO IMAGENS")
-    print("="*80)
+    lock = Lock()
 
     contadores_imagens = {
         'sucesso': 0,
@@ -293,42 +875,6 @@ def processar_csv():
         'ja_existe': 0,
         'processados': 0
     }
-    lock = Lock()
-
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = []
-        for linha in linhas:
-            s3 = conectar_s3()
-            future = executor.submit(processar_imagem, linha, s3, total, contadores_imagens, lock, erros)
-            futures.append(future)
-
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                with lock:
-                    contadores_imagens['falha'] += 1
-                    erros.append(f"IMAGEM - Erro inesperado: {str(e)}")
-
-    tempo_imagens = (datetime.now() - inicio_geral).total_seconds()
-
-    print("\n" + "="*80)
-    print("RESUMO ETAPA 1 - IMAGENS")
-    print("="*80)
-    print(f"Sucesso:          {contadores_imagens['sucesso']}")
-    print(f"Já existiam:      {contadores_imagens['ja_existe']}")
-    print(f"Não encontrados:  {contadores_imagens['nao_encontrado']}")
-    print(f"Falhas:           {contadores_imagens['falha']}")
-    print(f"Tempo:            {tempo_imagens:.1f}s")
-    print("="*80)
-
-    # ============================================================
-    # ETAPA 2: BAIXAR LAUDOS
-    # ============================================================
-    print("\n" + "="*80)
-    print("ETAPA 2/2: BAIXANDO LAUDOS")
-    print("="*80)
-
     contadores_laudos = {
         'sucesso': 0,
         'falha': 0,
@@ -338,24 +884,79 @@ def processar_csv():
         'sem_laudo': 0
     }
 
-    inicio_laudos = datetime.now()
+    # ============================================================
+    # PRÉ-PASSO: pastas de imagens (HEAD x listagem) e índice do Histórico
+    # ============================================================
+    # Quantas linhas (ainda não baixadas) cada pasta precisa resolver: decide HEAD x listagem
+    linhas_por_prefixo = {}
+    prefixos_laudos = set()
+    # Linhas concluídas ou com key já resolvida no manifesto não entram: retomar não lista nada
+    for linha in linhas:
+        nome_arquivo = linha['NomArquivo'].strip()
+        nome_completo = f"{nome_arquivo}.{linha['ExtArquivo'].strip().lower()}"
+        registro = manifesto.obter('imagem', nome_completo)
+        if (not manifesto.concluida('imagem', nome_completo, DESTINO_IMAGENS / nome_completo)
+                and not (registro and registro['key'])):
+            prefixo = detectar_prefixo(nome_arquivo, PREFIXOS_IMAGENS, IMAGE_PREFIX)
+            linhas_por_prefixo[prefixo] = linhas_por_prefixo.get(prefixo, 0) + 1
+        # Cada pasta do Histórico usada pelo CSV é listada uma única vez
+        codigo = linha['CodRequisicao_extraido'].strip()
+        registro = manifesto.obter('laudo', codigo) if codigo else None
+        if codigo and not (registro and registro['key']) and not manifesto.concluida('laudo', codigo):
+            prefixos_laudos.add(prefixo_laudo_de(codigo))
+
+    print(f"\n[INFO] Preparando {len(linhas_por_prefixo)} pasta(s) de imagens e "
+          f"{len(prefixos_laudos)} pasta(s) do Histórico...")
+    resolvedor = ResolvedorImagens(s3)
+    indice_laudos = IndiceLaudos()
+    # As duas listagens andam juntas (cada uma com metade das threads de listagem)
+    preparo = Thread(target=resolvedor.preparar, args=(linhas_por_prefixo, max(1, LISTAGEM_WORKERS // 2)))
+    preparo.start()
+    indice_laudos.carregar(s3, prefixos_laudos, max_workers=max(1, LISTAGEM_WORKERS // 2))
+    preparo.join()
+    print(f"[INFO] Pastas de imagens: {resolvedor.stats['pastas_listadas']} listadas, "
+          f"{resolvedor.stats['pastas_head']} por HEAD")
+    print(f"[INFO] {indice_laudos.objetos} laudos indexados com {indice_laudos.chamadas_list} chamadas LIST "
+          f"em {(datetime.now() - inicio_geral).total_seconds():.1f}s")
 
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = []
-        for linha in linhas:
-            s3 = conectar_s3()
-            future = executor.submit(processar_laudo, linha, s3, total, contadores_laudos, lock, erros)
-            futures.append(future)
+    # ============================================================
+    # IMAGENS E LAUDOS NO MESMO POOL
+    # ============================================================
+    print("\n" + "="*80)
+    print("BAIXANDO IMAGENS E LAUDOS")
+    print("="*80)
 
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                with lock:
-                    contadores_laudos['falha'] += 1
-                    erros.append(f"LAUDO - Erro inesperado: {str(e)}")
+    agendador = AgendadorDownloads(DOWNLOAD_WORKERS, PRIORIDADES_DOWNLOAD, LIMITES_DOWNLOAD)
+    for linha in linhas:
+        agendador.adicionar('imagem', processar_imagem, linha, s3, total, contadores_imagens, lock, erros,
+                            resolvedor, manifesto)
+        agendador.adicionar('laudo', processar_laudo, linha, s3, total, contadores_laudos, lock, erros,
+                            indice_laudos, manifesto)
 
-    tempo_laudos = (datetime.now() - inicio_laudos).total_seconds()
+    def ao_falhar(tipo, erro):
+        contadores = contadores_imagens if tipo == 'imagem' else contadores_laudos
+        with lock:
+            contadores['falha'] += 1
+            erros.append(f"{tipo.upper()} - Erro inesperado: {str(erro)}")
+
+    try:
+        agendador.executar(ao_falhar)
+    finally:
+        # Também ao interromper (Ctrl+C): o agendador já esperou as threads em
+        # andamento, e o que terminou fica no manifesto
+        manifesto.fechar()
+
+    print("\n" + "="*80)
+    print("RESUMO ETAPA 1 - IMAGENS")
+    print("="*80)
+    print(f"Sucesso:          {contadores_imagens['sucesso']}")
+    print(f"Já existiam:      {contadores_imagens['ja_existe']}")
+    print(f"Não encontrados:  {contadores_imagens['nao_encontrado']}")
+    print(f"Falhas:           {contadores_imagens['falha']}")
+    print(f"Chamadas S3:      {resolvedor.stats['head']} HEAD, {resolvedor.stats['list']} LIST "
+          f"({resolvedor.stats['negativos_em_cache']} faltas repetidas sem chamada)")
+    print(f"Tempo:            {agendador.tempo('imagem'):.1f}s")
+    print("="*80)
 
     print("\n" + "="*80)
     print("RESUMO ETAPA 2 - LAUDOS")
@@ -365,7 +966,7 @@ def processar_csv():
     print(f"Sem laudo:        {contadores_laudos['sem_laudo']}")
     print(f"Não encontrados:  {contadores_laudos['nao_encontrado']}")
     print(f"Falhas:           {contadores_laudos['falha']}")
-    print(f"Tempo:            {tempo_laudos:.1f}s")
+    print(f"Tempo:            {agendador.tempo('laudo'):.1f}s")
     print("="*80)
 
     # ============================================================
@@ -391,6 +992,9 @@ def processar_csv():
     print(f"  ✗ Não encontrados: {contadores_laudos['nao_encontrado']}")
     print(f"  ✗ Falhas:          {contadores_laudos['falha']}")
     print(f"")
+    print(f"Pulados (manifesto): {manifesto.pulados.get('imagem', 0)} imagens, "
+          f"{manifesto.pulados.get('laudo', 0)} laudos")
+    print(f"Requisições S3:      {resumo_requisicoes(requisicoes)}")
     print(f"Tempo total:         {tempo_total:.1f}s")
     print(f"Velocidade média:    {(total * 2) / tempo_total:.1f} arquivos/segundo")
     print("="*80)
@@ -409,8 +1013,11 @@ def processar_csv():
     print(f"[INFO] Laudos salvos em:  {DESTINO_LAUDOS}")
 
 if __name__ == '__main__':
+    import sys
+
     try:
-        processar_csv()
+        # --retentar-faltantes: procura de novo no S3 o que o manifesto marcou como ausente
+        processar_csv(retentar_faltantes='--retentar-faltantes' in sys.argv[1:])
     except KeyboardInterrupt:
         print("\n\n[INFO] Operação cancelada pelo usuário")
     except Exception as e:
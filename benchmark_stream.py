@@ -0,0 +1,114 @@
+import sys
+import time
+import argparse
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Benchmark de concorrência da API (s3_images_downloader.py --api):
+# dispara muitos /stream em paralelo e, ao mesmo tempo, mede a latência de um
+# endpoint leve. Com o event loop bloqueado por boto3, o endpoint leve fica
+# tão lento quanto os streams; com o I/O no pool dedicado ele continua rápido.
+# Repetir a mesma key mede o cache local da API: use --sem-cache para que cada
+# requisição vá ao S3 (Cache-Control: no-cache) e confira os hits no resumo.
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def baixar(url, headers=None):
+    """(status, ttfb, duração, bytes, X-Cache); status None se a requisição falhou (timeout, conexão)"""
+    inicio = time.perf_counter()
+    primeiro_byte = None
+    total = 0
+    cache = None
+    try:
+        with requests.get(url, stream=True, timeout=120, headers=headers) as r:
+            for bloco in r.iter_content(64 * 1024):
+                if primeiro_byte is None:
+                    primeiro_byte = time.perf_counter() - inicio
+                total += len(bloco)
+            status = r.status_code
+            cache = r.headers.get('X-Cache')
+    except requests.RequestException:
+        status = None
+    return status, primeiro_byte or 0.0, time.perf_counter() - inicio, total, cache
+
+
+def sondar(url, parar, latencias):
+    while not parar.is_set():
+        inicio = time.perf_counter()
+        try:
+            requests.get(url, timeout=60)
+            latencias.append(time.perf_counter() - inicio)
+        except Exception:
+            pass
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de /stream em paralelo")
+    parser.add_argument('key', help="Key S3 da imagem usada nos downloads")
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--concorrencia', type=int, default=50)
+    parser.add_argument('--total', type=int, default=500)
+    parser.add_argument('--sem-cache', action='store_true',
+                        help="Envia Cache-Control: no-cache (mede o S3, não o cache local da API)")
+    args = parser.parse_args()
+    headers = {'Cache-Control': 'no-cache'} if args.sem_cache else None
+
+    url_stream = f"{args.url}/stream/{args.key}"
+    url_sonda = f"{args.url}/catalog/status"
+
+    print("=" * 60)
+    print(f"BENCHMARK /stream - {args.total} requisições, {args.concorrencia} em paralelo"
+          f"{' (sem cache)' if args.sem_cache else ''}")
+    print("=" * 60)
+
+    parar = threading.Event()
+    latencias_sonda = []
+    sonda = threading.Thread(target=sondar, args=(url_sonda, parar, latencias_sonda), daemon=True)
+    sonda.start()
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concorrencia) as executor:
+        resultados = list(executor.map(lambda _: baixar(url_stream, headers), range(args.total)))
+    duracao = time.perf_counter() - inicio
+    parar.set()
+    sonda.join()
+
+    # Falhas de rede contam à parte e ficam fora das latências
+    falhas = sum(1 for status, *_ in resultados if status is None)
+    erros = sum(1 for status, *_ in resultados if status is not None and status >= 400)
+    concluidas = [r for r in resultados if r[0] is not None]
+    ttfb = [r[1] for r in concluidas]
+    tempos = [r[2] for r in concluidas]
+    bytes_total = sum(r[3] for r in resultados)
+    hits = sum(1 for r in concluidas if r[4] == 'HIT')
+    misses = sum(1 for r in concluidas if r[4] == 'MISS')
+
+    print(f"Duração:             {duracao:.2f}s")
+    print(f"Requisições/s:       {args.total / duracao:.1f}")
+    print(f"MB/s:                {bytes_total / duracao / (1024 * 1024):.2f}")
+    print(f"Erros (>=400):       {erros}")
+    print(f"Falhas (rede):       {falhas}")
+    print(f"Cache da API:        {hits} hits / {misses} misses"
+          f"{'' if hits + misses == len(concluidas) else f' / {len(concluidas) - hits - misses} sem X-Cache'}")
+    print(f"TTFB p50/p95:        {percentil(ttfb, 50) * 1000:.0f}ms / {percentil(ttfb, 95) * 1000:.0f}ms")
+    print(f"Total p50/p95/max:   {percentil(tempos, 50) * 1000:.0f}ms / {percentil(tempos, 95) * 1000:.0f}ms / {max(tempos, default=0) * 1000:.0f}ms")
+    if latencias_sonda:
+        print(f"/catalog/status p50/max durante a carga: "
+              f"{statistics.median(latencias_sonda) * 1000:.0f}ms / {max(latencias_sonda) * 1000:.0f}ms")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
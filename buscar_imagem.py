@@ -2,6 +2,8 @@ import boto3
 import sys
 import os
 from dotenv import load_dotenv
+from listagem_s3 import iterar_objetos_paralelo
+from catalogo_s3 import ArmazemCatalogo, CATALOGO_DB, CATALOGO_IDADE_MAXIMA
 
 # Carregar variáveis do .env
 load_dotenv()
@@ -29,6 +31,30 @@ PREFIXOS_CONHECIDOS = {
     '8511': 'lab/Arquivos/Foto/8511/',
 }
 
+def buscar_no_catalogo(nome, prefixo_busca):
+    """Busca no catálogo SQLite local; retorna None se ele não existir ou estiver desatualizado"""
+    if not CATALOGO_DB.exists():
+        return None
+
+    try:
+        armazem = ArmazemCatalogo()
+        idade = armazem.idade()
+        if idade is None or idade > CATALOGO_IDADE_MAXIMA:
+            return None
+
+        print(f"[INFO] Buscando no catálogo local (atualizado há {idade / 60:.0f} min)...")
+        return [
+            {
+                'key': img['key'],
+                'nome': img['file_name'],
+                'tamanho': img['size_kb']
+            }
+            for img in armazem.buscar(nome, prefixo_busca)
+        ]
+    except Exception as e:
+        print(f"[AVISO] Catálogo local indisponível: {e}")
+        return None
+
 def buscar_e_baixar(nome):
     """Busca e baixa uma imagem do S3"""
     print(f"\n[INFO] Buscando imagem: {nome}")
@@ -56,19 +82,16 @@ def buscar_e_baixar(nome):
     if not pasta_detectada:
         print("[INFO] Buscando em todas as pastas...")
 
-    print("[INFO] Conectando ao S3...")
-
     try:
-        paginator = s3.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefixo_busca)
-
-        encontradas = []
+        # Catálogo local primeiro; sem resultado, lista o S3 (arquivo pode ser novo)
+        encontradas = buscar_no_catalogo(nome, prefixo_busca)
 
-        for page in pages:
-            if 'Contents' not in page:
-                continue
+        if not encontradas:
+            print("[INFO] Conectando ao S3...")
+            encontradas = []
 
-            for obj in page['Contents']:
+            # Sem pasta detectada, as subpastas de Foto/ são listadas em paralelo
+            for obj in iterar_objetos_paralelo(s3, BUCKET_NAME, prefixo_busca):
                 key = obj['Key']
                 file_name = key.split('/')[-1]
 
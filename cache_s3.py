@@ -0,0 +1,283 @@
+import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+# Limites do cache de bytes (memória e disco) e do maior objeto cacheável
+CACHE_MEMORIA_MB = int(os.getenv('CACHE_MEMORIA_MB', '256'))
+CACHE_DISCO_MB = int(os.getenv('CACHE_DISCO_MB', '2048'))
+CACHE_ITEM_MAX_MB = int(os.getenv('CACHE_ITEM_MAX_MB', '16'))
+CACHE_DIR = Path(os.getenv('CACHE_DIR', Path(__file__).parent / 'cache_s3'))
+# CACHE_DISCO_MB vale para o diretório inteiro, que os workers compartilham: a
+# cada CACHE_DISCO_VARREDURA segundos o índice é refeito a partir do diretório
+# (arquivos de todos os processos) e o excesso sai pelo LRU (mtime)
+CACHE_DISCO_VARREDURA = float(os.getenv('CACHE_DISCO_VARREDURA', '60'))
+
+
+def etag_confere(if_none_match, etag):
+    """Compara o header If-None-Match (lista, '*' ou W/) com o ETag atual"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    etag = etag.strip('"')
+    for candidato in if_none_match.split(','):
+        candidato = candidato.strip()
+        if candidato.startswith('W/'):
+            candidato = candidato[2:]
+        if candidato.strip('"') == etag:
+            return True
+    return False
+
+
+def intervalo_range(range_header, tamanho):
+    """Converte 'bytes=a-b' / 'bytes=a-' / 'bytes=-n' em (inicio, fim) inclusivo
+
+    Retorna None se o header não for um range simples (o chamador responde
+    com o objeto inteiro) e levanta ValueError se o range for insatisfazível.
+    """
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    inicio, _, fim = range_header[6:].strip().partition('-')
+    try:
+        sufixo = int(fim) if inicio == '' else None
+        if sufixo is None:
+            inicio = int(inicio)
+            fim = int(fim) if fim else tamanho - 1
+    except ValueError:
+        return None
+    # Fora do try acima: insatisfazível vira 416, não é confundido com header malformado
+    if sufixo is not None:
+        if sufixo <= 0 or tamanho == 0:
+            raise ValueError(range_header)
+        return max(0, tamanho - sufixo), tamanho - 1
+    if inicio >= tamanho or fim < inicio:
+        raise ValueError(range_header)
+    return inicio, min(fim, tamanho - 1)
+
+
+class CacheBytes:
+    """Cache LRU de objetos do S3 por (key, ETag): memória na frente, disco atrás
+
+    Como o ETag faz parte da chave, um objeto sobrescrito no S3 nunca é servido
+    desatualizado: a versão antiga só deixa de ser pedida e sai pelo LRU.
+    """
+
+    def __init__(self, limite_memoria=CACHE_MEMORIA_MB * 1024 * 1024, diretorio=CACHE_DIR,
+                 limite_disco=CACHE_DISCO_MB * 1024 * 1024, item_maximo=CACHE_ITEM_MAX_MB * 1024 * 1024,
+                 varredura_disco=CACHE_DISCO_VARREDURA):
+        self.limite_memoria = limite_memoria
+        self.limite_disco = limite_disco
+        self.item_maximo = item_maximo
+        self.varredura_disco = varredura_disco
+        self.diretorio = Path(diretorio) if diretorio and limite_disco else None
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()
+        self._bytes_memoria = 0
+        self._disco = OrderedDict()
+        self._bytes_disco = 0
+        self._stats = {'hits_memoria': 0, 'hits_disco': 0, 'misses': 0, 'gravacoes': 0}
+        self._varrido_em = time.monotonic()
+        self._varrendo = False
+        if self.diretorio:
+            self.diretorio.mkdir(parents=True, exist_ok=True)
+            self._disco = self._varrer_disco()
+            self._bytes_disco = sum(self._disco.values())
+
+    def _varrer_disco(self):
+        """Índice LRU (nome -> tamanho, mais antigos primeiro) de todos os arquivos do diretório
+
+        Inclui os gravados por outros processos; a ordem é a do mtime, que
+        obter atualiza a cada leitura.
+        """
+        arquivos = []
+        agora = time.time()
+        for caminho in self.diretorio.iterdir():
+            try:
+                stat = caminho.stat()
+            except OSError:
+                continue
+            if not caminho.is_file():
+                continue
+            if caminho.suffix == '.tmp':
+                # Só temporários abandonados: outro processo pode estar gravando agora
+                if agora - stat.st_mtime > 3600:
+                    caminho.unlink(missing_ok=True)
+                continue
+            arquivos.append((stat.st_mtime, caminho.name, stat.st_size))
+        return OrderedDict((nome, tamanho) for _, nome, tamanho in sorted(arquivos))
+
+    @staticmethod
+    def _nome(key, etag):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '_' + etag.strip('"')
+
+    def cabe(self, tamanho):
+        return tamanho is not None and tamanho <= self.item_maximo
+
+    def obter(self, key, etag):
+        """Bytes do objeto nessa versão, ou None"""
+        if not etag:
+            return None
+        nome = self._nome(key, etag)
+        with self._lock:
+            dados = self._memoria.get(nome)
+            if dados is not None:
+                self._memoria.move_to_end(nome)
+                self._stats['hits_memoria'] += 1
+                return dados
+            no_disco = self.diretorio is not None and nome in self._disco
+            if no_disco:
+                self._disco.move_to_end(nome)
+
+        # Fora do índice também: o diretório pode ser compartilhado por vários
+        # processos (workers da API) e outro pode ter gravado o arquivo
+        if self.diretorio is not None:
+            caminho = self.diretorio / nome
+            try:
+                dados = caminho.read_bytes()
+                os.utime(caminho)
+            except OSError:
+                dados = None
+            if dados is not None:
+                with self._lock:
+                    self._stats['hits_disco'] += 1
+                    if nome not in self._disco:
+                        self._disco[nome] = len(dados)
+                        self._bytes_disco += len(dados)
+                    self._guardar_memoria(nome, dados)
+                return dados
+            if no_disco:
+                # Removido por outro processo
+                with self._lock:
+                    self._bytes_disco -= self._disco.pop(nome, 0)
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def guardar(self, key, etag, dados):
+        if not etag or not self.cabe(len(dados)):
+            return
+        nome = self._nome(key, etag)
+        with self._lock:
+            self._stats['gravacoes'] += 1
+            self._guardar_memoria(nome, dados)
+            gravar_disco = self.diretorio is not None and nome not in self._disco
+        if gravar_disco:
+            self._guardar_disco(nome, dados)
+
+    def _guardar_memoria(self, nome, dados):
+        # Chamado com o lock
+        if nome in self._memoria:
+            self._memoria.move_to_end(nome)
+            return
+        self._memoria[nome] = dados
+        self._bytes_memoria += len(dados)
+        while self._bytes_memoria > self.limite_memoria and self._memoria:
+            _, antigo = self._memoria.popitem(last=False)
+            self._bytes_memoria -= len(antigo)
+
+    def _guardar_disco(self, nome, dados):
+        caminho = self.diretorio / nome
+        temporario = caminho.with_name(f"{nome}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            temporario.write_bytes(dados)
+            os.replace(temporario, caminho)
+        except OSError as e:
+            temporario.unlink(missing_ok=True)
+            print(f"[CACHE] Falha ao gravar em disco: {e}")
+            return
+
+        with self._lock:
+            if nome not in self._disco:
+                self._disco[nome] = len(dados)
+                self._bytes_disco += len(dados)
+            varrer = not self._varrendo and time.monotonic() - self._varrido_em >= self.varredura_disco
+            if varrer:
+                self._varrendo = True
+        if varrer:
+            # Fora do lock: o índice deste processo só conhece o que ele gravou/leu
+            try:
+                disco = self._varrer_disco()
+            except OSError as e:
+                print(f"[CACHE] Falha ao varrer o diretório do cache: {e}")
+                disco = None
+            with self._lock:
+                if disco is not None:
+                    self._disco = disco
+                    self._bytes_disco = sum(disco.values())
+                self._varrido_em = time.monotonic()
+                self._varrendo = False
+
+        remover = []
+        with self._lock:
+            while self._bytes_disco > self.limite_disco and len(self._disco) > 1:
+                antigo, tamanho = self._disco.popitem(last=False)
+                self._bytes_disco -= tamanho
+                remover.append(antigo)
+        for antigo in remover:
+            (self.diretorio / antigo).unlink(missing_ok=True)
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'itens_memoria': len(self._memoria),
+                'mb_memoria': round(self._bytes_memoria / (1024 * 1024), 1),
+                'itens_disco': len(self._disco),
+                'mb_disco': round(self._bytes_disco / (1024 * 1024), 1)
+            }
+
+
+# Validade dos resultados de HEAD em cache (positivos e "não existe")
+CACHE_HEAD_TTL = int(os.getenv('CACHE_HEAD_TTL', '300'))
+CACHE_HEAD_TTL_NEGATIVO = int(os.getenv('CACHE_HEAD_TTL_NEGATIVO', '60'))
+CACHE_HEAD_MAX_ITENS = int(os.getenv('CACHE_HEAD_MAX_ITENS', '50000'))
+
+
+class CacheTTL:
+    """Cache em memória com validade por item e limite de itens (LRU)
+
+    Guarda também ausências (valor None) com validade própria, para que keys
+    inexistentes pedidas em loop não virem uma chamada ao S3 cada vez.
+    """
+
+    def __init__(self, ttl=CACHE_HEAD_TTL, ttl_negativo=CACHE_HEAD_TTL_NEGATIVO, max_itens=CACHE_HEAD_MAX_ITENS):
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self.max_itens = max_itens
+        self._lock = threading.Lock()
+        self._itens = OrderedDict()
+        self._stats = {'hits': 0, 'hits_negativos': 0, 'misses': 0}
+
+    def obter(self, chave):
+        """(True, valor) se houver entrada válida (valor None = não existe), senão (False, None)"""
+        agora = time.monotonic()
+        with self._lock:
+            entrada = self._itens.get(chave)
+            if entrada is not None and entrada[0] > agora:
+                self._itens.move_to_end(chave)
+                self._stats['hits' if entrada[1] is not None else 'hits_negativos'] += 1
+                return True, entrada[1]
+            if entrada is not None:
+                del self._itens[chave]
+            self._stats['misses'] += 1
+        return False, None
+
+    def guardar(self, chave, valor):
+        validade = time.monotonic() + (self.ttl if valor is not None else self.ttl_negativo)
+        with self._lock:
+            self._itens[chave] = (validade, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def invalidar(self, chave):
+        with self._lock:
+            self._itens.pop(chave, None)
+
+    def estatisticas(self):
+        with self._lock:
+            return {**self._stats, 'itens': len(self._itens)}
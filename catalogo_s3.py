@@ -0,0 +1,1095 @@
+import csv
+import gzip
+import io
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import unquote_plus
+from listagem_s3 import descobrir_subprefixos, LISTAGEM_WORKERS
+from tabela_imagens import TabelaImagens, registro_de_imagem
+from indice_nomes import IndiceTrigramas
+
+# Intervalo (segundos) entre atualizações completas do catálogo
+CATALOGO_INTERVALO = int(os.getenv('CATALOGO_INTERVALO', '300'))
+# Banco SQLite compartilhado entre processos (API, workers e CLI)
+CATALOGO_DB = Path(os.getenv('CATALOGO_DB', Path(__file__).parent / 'catalogo_s3.db'))
+# Idade máxima (segundos) para a CLI confiar no catálogo em disco
+CATALOGO_IDADE_MAXIMA = int(os.getenv('CATALOGO_IDADE_MAXIMA', '3600'))
+# 'incremental' (StartAfter por pasta + reconciliação periódica) ou 'completo' (relista tudo)
+CATALOGO_MODO = os.getenv('CATALOGO_MODO', 'incremental')
+# Intervalo (segundos) entre reconciliações completas de cada pasta (detecta remoções)
+CATALOGO_RECONCILIACAO = int(os.getenv('CATALOGO_RECONCILIACAO', str(6 * 3600)))
+# Vários processos (workers da API): só o líder (lease no SQLite) lista o S3; os
+# outros acompanham o log de alterações do armazém a cada CATALOGO_ESPERA_SEGUIDOR
+CATALOGO_LIDERANCA_TTL = int(os.getenv('CATALOGO_LIDERANCA_TTL', '30'))
+CATALOGO_ESPERA_SEGUIDOR = float(os.getenv('CATALOGO_ESPERA_SEGUIDOR', '5'))
+# Alterações mantidas no log; quem ficou mais atrasado que isso recarrega tudo
+CATALOGO_LOG_MAX = int(os.getenv('CATALOGO_LOG_MAX', '50000'))
+# Eventos e deltas pequenos ficam sobrepostos ao snapshot (sem copiar a tabela);
+# a cada CATALOGO_COMPACTACAO segundos o que acumulou é juntado em segundo plano
+CATALOGO_COMPACTACAO = float(os.getenv('CATALOGO_COMPACTACAO', '60'))
+
+
+def chave_recencia(img):
+    """Ordem total do catálogo: (last_modified, key), usada decrescente em todo lugar"""
+    return (img['last_modified'], img['key'])
+
+
+def objeto_para_imagem(obj):
+    """Converte um objeto do list_objects_v2 no dicionário usado pela API"""
+    key = obj['Key']
+    return {
+        'key': key,
+        'size': obj['Size'],
+        'last_modified': obj['LastModified'].isoformat(),
+        'file_name': key.split('/')[-1],
+        'pasta': '/'.join(key.split('/')[:-1]),
+        'size_kb': round(obj['Size'] / 1024, 1),
+        'etag': obj.get('ETag', '').strip('"')
+    }
+
+
+def _linha_para_imagem(linha):
+    """Converte uma linha da tabela objetos no dicionário usado pela API"""
+    key, pasta, file_name, size, etag, last_modified = linha
+    return {
+        'key': key,
+        'size': size,
+        'last_modified': last_modified,
+        'file_name': file_name,
+        'pasta': pasta,
+        'size_kb': round(size / 1024, 1),
+        'etag': etag
+    }
+
+
+class ArmazemCatalogo:
+    """Catálogo persistente em SQLite com índices por data, pasta, extensão e nome"""
+
+    COLUNAS = 'key, pasta, file_name, size, etag, last_modified'
+
+    def __init__(self, caminho=CATALOGO_DB):
+        self.caminho = Path(caminho)
+        self.fts = True
+        self._criar_schema()
+
+    def conectar(self):
+        # Uma conexão por operação: seguro entre threads e processos
+        conn = sqlite3.connect(str(self.caminho), timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _criar_schema(self):
+        self.caminho.parent.mkdir(parents=True, exist_ok=True)
+        conn = self.conectar()
+        try:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS objetos (
+                    key TEXT PRIMARY KEY,
+                    pasta TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    extensao TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_objetos_recencia ON objetos(last_modified DESC);
+                CREATE INDEX IF NOT EXISTS idx_objetos_pasta ON objetos(pasta, last_modified DESC);
+                CREATE INDEX IF NOT EXISTS idx_objetos_extensao ON objetos(extensao, last_modified DESC);
+                CREATE TABLE IF NOT EXISTS meta (
+                    chave TEXT PRIMARY KEY,
+                    valor TEXT
+                );
+                CREATE TABLE IF NOT EXISTS marcas (
+                    pasta TEXT PRIMARY KEY,
+                    ultima_key TEXT,
+                    monotonica INTEGER NOT NULL DEFAULT 1,
+                    reconciliado_em REAL
+                );
+                CREATE TABLE IF NOT EXISTS lideranca (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    dono TEXT NOT NULL,
+                    expira_em REAL NOT NULL
+                );
+                -- Log de keys alteradas (preenchido por triggers): outros processos
+                -- aplicam só o que mudou desde a última sequência que viram
+                CREATE TABLE IF NOT EXISTS alteracoes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL
+                );
+                CREATE TRIGGER IF NOT EXISTS objetos_log_ai AFTER INSERT ON objetos BEGIN
+                    INSERT INTO alteracoes(key) VALUES (new.key);
+                END;
+                CREATE TRIGGER IF NOT EXISTS objetos_log_au AFTER UPDATE ON objetos BEGIN
+                    INSERT INTO alteracoes(key) VALUES (new.key);
+                END;
+                CREATE TRIGGER IF NOT EXISTS objetos_log_ad AFTER DELETE ON objetos BEGIN
+                    INSERT INTO alteracoes(key) VALUES (old.key);
+                END;
+            ''')
+            try:
+                # Índice trigram (SQLite >= 3.34) para busca por substring no nome
+                conn.executescript('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS objetos_fts USING fts5(
+                        file_name, content='objetos', content_rowid='rowid', tokenize='trigram'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS objetos_fts_ai AFTER INSERT ON objetos BEGIN
+                        INSERT INTO objetos_fts(rowid, file_name) VALUES (new.rowid, new.file_name);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS objetos_fts_ad AFTER DELETE ON objetos BEGIN
+                        INSERT INTO objetos_fts(objetos_fts, rowid, file_name) VALUES ('delete', old.rowid, old.file_name);
+                    END;
+                ''')
+            except sqlite3.OperationalError as e:
+                print(f"[CATALOGO] FTS5/trigram indisponível, busca por nome usará LIKE: {e}")
+                self.fts = False
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _linha_objeto(img):
+        file_name = img['file_name']
+        extensao = file_name.rsplit('.', 1)[-1].lower() if '.' in file_name else ''
+        return (img['key'], img['pasta'], file_name, extensao, img['size'],
+                img.get('etag'), img['last_modified'])
+
+    @staticmethod
+    def _escopo(prefix=None, pasta=None):
+        """Cláusula WHERE que limita uma operação a um prefixo ou a uma pasta exata"""
+        if pasta is not None:
+            return 'pasta = ?', (pasta.rstrip('/'),)
+        if prefix:
+            return 'key >= ? AND key < ?', (prefix, prefix + '\uffff')
+        return '1 = 1', ()
+
+    def _marcar_atualizado(self, conn):
+        conn.execute("INSERT OR REPLACE INTO meta(chave, valor) VALUES ('atualizado_em', ?)",
+                     (str(time.time()),))
+
+    def _gravar(self, conn, imagens):
+        conn.executemany('''
+            INSERT INTO objetos(key, pasta, file_name, extensao, size, etag, last_modified)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                size = excluded.size,
+                etag = excluded.etag,
+                last_modified = excluded.last_modified
+            WHERE objetos.etag IS NOT excluded.etag
+               OR objetos.last_modified IS NOT excluded.last_modified
+        ''', (self._linha_objeto(img) for img in imagens))
+
+    def substituir(self, imagens, prefix=None, pasta=None):
+        """Sincroniza o escopo (prefixo, pasta ou tabela toda) com uma listagem completa
+
+        Retorna (novos_ou_alterados, chaves_removidas, chaves_inseridas).
+        """
+        where, params = self._escopo(prefix, pasta)
+        conn = self.conectar()
+        try:
+            with conn:
+                existentes = {
+                    key: (etag, last_modified)
+                    for key, etag, last_modified in conn.execute(
+                        f'SELECT key, etag, last_modified FROM objetos WHERE {where}', params)
+                }
+                alterados = [
+                    img for img in imagens
+                    if existentes.get(img['key']) != (img.get('etag'), img['last_modified'])
+                ]
+                atuais = {img['key'] for img in imagens}
+                removidos = [key for key in existentes if key not in atuais]
+                inseridos = {img['key'] for img in alterados if img['key'] not in existentes}
+
+                conn.executemany('DELETE FROM objetos WHERE key = ?', ((key,) for key in removidos))
+                self._gravar(conn, alterados)
+                self._marcar_atualizado(conn)
+            return alterados, removidos, inseridos
+        finally:
+            conn.close()
+
+    def aplicar(self, novos=(), removidos=()):
+        """Aplica um delta (upsert de novos, remoção de chaves) sem tocar no resto
+
+        Retorna os novos que de fato mudaram (key ausente ou ETag/data diferentes).
+        """
+        novos = list(novos)
+        conn = self.conectar()
+        try:
+            with conn:
+                existentes = {}
+                keys = [img['key'] for img in novos]
+                for i in range(0, len(keys), 500):
+                    lote = keys[i:i + 500]
+                    existentes.update(
+                        (key, (etag, last_modified)) for key, etag, last_modified in conn.execute(
+                            f'SELECT key, etag, last_modified FROM objetos WHERE key IN ({", ".join("?" * len(lote))})',
+                            lote))
+                alterados = [
+                    img for img in novos
+                    if existentes.get(img['key']) != (img.get('etag'), img['last_modified'])
+                ]
+                conn.executemany('DELETE FROM objetos WHERE key = ?', ((key,) for key in removidos))
+                self._gravar(conn, alterados)
+                self._marcar_atualizado(conn)
+            return alterados
+        finally:
+            conn.close()
+
+    def marcas(self):
+        """Marcas d'água por pasta: {pasta: {'ultima_key', 'monotonica', 'reconciliado_em'}}"""
+        conn = self.conectar()
+        try:
+            return {
+                pasta: {'ultima_key': ultima_key, 'monotonica': bool(monotonica), 'reconciliado_em': reconciliado_em}
+                for pasta, ultima_key, monotonica, reconciliado_em in conn.execute(
+                    'SELECT pasta, ultima_key, monotonica, reconciliado_em FROM marcas')
+            }
+        finally:
+            conn.close()
+
+    def gravar_marca(self, pasta, ultima_key, monotonica=True, reconciliado_em=None):
+        conn = self.conectar()
+        try:
+            with conn:
+                conn.execute('''
+                    INSERT INTO marcas(pasta, ultima_key, monotonica, reconciliado_em) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(pasta) DO UPDATE SET
+                        ultima_key = excluded.ultima_key,
+                        monotonica = excluded.monotonica,
+                        reconciliado_em = COALESCE(excluded.reconciliado_em, marcas.reconciliado_em)
+                ''', (pasta, ultima_key, int(monotonica), reconciliado_em))
+        finally:
+            conn.close()
+
+    def remover_marca(self, pasta):
+        """Esquece a marca d'água de uma pasta que sumiu do bucket"""
+        conn = self.conectar()
+        try:
+            with conn:
+                conn.execute('DELETE FROM marcas WHERE pasta = ?', (pasta,))
+        finally:
+            conn.close()
+
+    def assumir_lideranca(self, dono, ttl=CATALOGO_LIDERANCA_TTL):
+        """Assume ou renova o lease de líder por `ttl` segundos; True se `dono` for o líder"""
+        agora = time.time()
+        conn = self.conectar()
+        try:
+            with conn:
+                # Um único upsert: atômico mesmo com vários processos disputando
+                conn.execute('''
+                    INSERT INTO lideranca(id, dono, expira_em) VALUES (1, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET dono = excluded.dono, expira_em = excluded.expira_em
+                    WHERE lideranca.dono = excluded.dono OR lideranca.expira_em < ?
+                ''', (dono, agora + ttl, agora))
+                linha = conn.execute('SELECT dono FROM lideranca WHERE id = 1').fetchone()
+            return linha is not None and linha[0] == dono
+        finally:
+            conn.close()
+
+    def liberar_lideranca(self, dono):
+        """Expira o lease (se for de `dono`) para outro processo assumir logo"""
+        conn = self.conectar()
+        try:
+            with conn:
+                conn.execute('UPDATE lideranca SET expira_em = 0 WHERE id = 1 AND dono = ?', (dono,))
+        finally:
+            conn.close()
+
+    def lider(self):
+        """Dono do lease atual (ou None se expirado)"""
+        conn = self.conectar()
+        try:
+            linha = conn.execute('SELECT dono, expira_em FROM lideranca WHERE id = 1').fetchone()
+            return linha[0] if linha and linha[1] >= time.time() else None
+        finally:
+            conn.close()
+
+    def ultima_alteracao(self):
+        conn = self.conectar()
+        try:
+            return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM alteracoes').fetchone()[0]
+        finally:
+            conn.close()
+
+    def alteracoes_desde(self, seq, limite=CATALOGO_LOG_MAX):
+        """(nova_seq, imagens alteradas, keys removidas) depois de `seq`
+
+        None se o log não cobre mais essa sequência (podado) ou se há mais de
+        `limite` alterações: nesses casos é melhor recarregar tudo.
+        """
+        conn = self.conectar()
+        try:
+            menor, maior = conn.execute('SELECT MIN(seq), MAX(seq) FROM alteracoes').fetchone()
+            if maior is None or maior <= seq:
+                return seq, [], []
+            if seq < menor - 1 or maior - seq > limite:
+                return None
+            linhas = conn.execute('''
+                SELECT a.key, o.pasta, o.file_name, o.size, o.etag, o.last_modified
+                FROM (SELECT DISTINCT key FROM alteracoes WHERE seq > ? AND seq <= ?) a
+                LEFT JOIN objetos o ON o.key = a.key
+            ''', (seq, maior)).fetchall()
+        finally:
+            conn.close()
+        imagens = [_linha_para_imagem(linha) for linha in linhas if linha[1] is not None]
+        removidos = [linha[0] for linha in linhas if linha[1] is None]
+        return maior, imagens, removidos
+
+    def podar_alteracoes(self, manter=CATALOGO_LOG_MAX):
+        conn = self.conectar()
+        try:
+            with conn:
+                conn.execute('DELETE FROM alteracoes WHERE seq <= (SELECT MAX(seq) FROM alteracoes) - ?',
+                             (manter,))
+        finally:
+            conn.close()
+
+    def atualizado_em(self):
+        """Timestamp (epoch) da última sincronização gravada, ou None"""
+        conn = self.conectar()
+        try:
+            linha = conn.execute("SELECT valor FROM meta WHERE chave = 'atualizado_em'").fetchone()
+            return float(linha[0]) if linha else None
+        finally:
+            conn.close()
+
+    def idade(self):
+        atualizado = self.atualizado_em()
+        return None if atualizado is None else time.time() - atualizado
+
+    def _consultar(self, where='', params=(), limite=None, fts=None):
+        sql = f'SELECT {self.COLUNAS} FROM objetos'
+        if fts is not None:
+            sql = (f'SELECT {", ".join("o." + c.strip() for c in self.COLUNAS.split(","))} '
+                   f'FROM objetos_fts f JOIN objetos o ON o.rowid = f.rowid')
+            where = 'objetos_fts MATCH ?' + (f' AND {where}' if where else '')
+            params = (fts,) + tuple(params)
+        if where:
+            sql += f' WHERE {where}'
+        sql += ' ORDER BY last_modified DESC, key DESC'
+        if limite:
+            sql += f' LIMIT {int(limite)}'
+        conn = self.conectar()
+        try:
+            return [_linha_para_imagem(linha) for linha in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def todas(self, prefix=None):
+        """Todas as imagens (ou as de um prefixo), mais recentes primeiro"""
+        if prefix:
+            return self._consultar('key >= ? AND key < ?', (prefix, prefix + '\uffff'))
+        return self._consultar()
+
+    def recentes(self, n, prefix=None):
+        if prefix:
+            return self._consultar('key >= ? AND key < ?', (prefix, prefix + '\uffff'), limite=n)
+        return self._consultar(limite=n)
+
+    def por_pasta(self, pasta):
+        return self._consultar('pasta = ?', (pasta.rstrip('/'),))
+
+    def por_extensao(self, extensoes):
+        """extensoes: sequência de extensões com ou sem ponto (ex: ('.jpg', '.jpeg'))"""
+        extensoes = [e.lower().lstrip('.') for e in extensoes]
+        marcadores = ', '.join('?' for _ in extensoes)
+        return self._consultar(f'extensao IN ({marcadores})', extensoes)
+
+    def buscar(self, termo, prefix=None):
+        """Busca por substring no nome do arquivo (case-insensitive)"""
+        where, params = '', ()
+        if prefix:
+            where, params = 'o.key >= ? AND o.key < ?', (prefix, prefix + '\uffff')
+        # O tokenizer trigram só indexa termos com 3 ou mais caracteres
+        if self.fts and len(termo) >= 3:
+            return self._consultar(where, params, fts='"' + termo.replace('"', '""') + '"')
+        termo_like = '%' + termo.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where_like = "lower(file_name) LIKE ? ESCAPE '\\'"
+        if prefix:
+            where_like += ' AND key >= ? AND key < ?'
+        return self._consultar(where_like, (termo_like,) + params)
+
+
+def segue_numeracao(key):
+    """Keys que contam para a marca d'água: arquivos nomeados pelo código (começam com dígito)
+
+    Outros arquivos da pasta (Thumbs.db, notas, etc.) não seguem a numeração e,
+    se entrassem na marca, fariam o StartAfter pular códigos novos menores que eles.
+    """
+    nome = key.rsplit('/', 1)[-1]
+    return nome[:1].isdigit()
+
+
+def _normalizar_data(valor):
+    """Converte datas de inventário (ISO com 'Z' ou datetime) para o mesmo formato da listagem"""
+    if isinstance(valor, datetime):
+        data = valor
+    else:
+        data = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    if data.tzinfo is None:
+        data = data.replace(tzinfo=timezone.utc)
+    return data.astimezone(timezone.utc).isoformat()
+
+
+class SincronizadorCatalogo:
+    """Sincronização incremental do catálogo em disco, pasta por pasta
+
+    Cada pasta guarda a maior key já vista (marca d'água). Enquanto a numeração
+    dos arquivos for crescente, basta listar com StartAfter a partir dela; de
+    tempos em tempos a pasta é relistada por completo para detectar remoções,
+    sobrescritas e keys que chegaram fora de ordem.
+    """
+
+    def __init__(self, conectar, bucket, raizes, armazem, reconciliacao=CATALOGO_RECONCILIACAO,
+                 max_workers=LISTAGEM_WORKERS, conta_para_marca=segue_numeracao):
+        # conectar: função sem argumentos que retorna um cliente boto3 S3
+        # conta_para_marca(key): quais keys podem virar marca d'água da pasta
+        self.conectar = conectar
+        self.conta_para_marca = conta_para_marca
+        self.bucket = bucket
+        self.raizes = list(raizes)
+        self.armazem = armazem
+        self.reconciliacao = reconciliacao
+        self.max_workers = max_workers
+        self.ultima_execucao = {}
+        self._chamadas = 0
+        self._lock_chamadas = threading.Lock()
+
+    def _paginas(self, s3, **kwargs):
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, **kwargs):
+            with self._lock_chamadas:
+                self._chamadas += 1
+            yield page
+
+    def _listar(self, s3, pasta, start_after=None):
+        kwargs = {'Prefix': pasta}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        return [
+            objeto_para_imagem(obj)
+            for page in self._paginas(s3, **kwargs)
+            for obj in page.get('Contents', [])
+            if not obj['Key'].endswith('/')
+        ]
+
+    def _marca_de(self, imagens):
+        return max((img['key'] for img in imagens if self.conta_para_marca(img['key'])), default=None)
+
+    def pasta_de(self, key):
+        """Subpasta direta de uma raiz (a unidade que tem marca d'água) que contém a key"""
+        for raiz in self.raizes:
+            if key.startswith(raiz) and '/' in key[len(raiz):]:
+                return raiz + key[len(raiz):].split('/', 1)[0] + '/'
+        return None
+
+    def observar_keys(self, keys):
+        """Keys vistas fora da listagem (eventos): abaixo da marca, reconcilia a pasta já
+
+        Uma key nova menor que a marca d'água nunca apareceria no StartAfter; a
+        pasta deixa de ser tratada como monotônica e a próxima sincronização a
+        relista por completo. Retorna as pastas marcadas para reconciliação.
+        """
+        marcas = None
+        pastas = set()
+        for key in keys:
+            pasta = self.pasta_de(key)
+            if pasta is None or pasta in pastas or not self.conta_para_marca(key):
+                continue
+            if marcas is None:
+                marcas = self.armazem.marcas()
+            marca = marcas.get(pasta)
+            if marca and marca['monotonica'] and marca['ultima_key'] and key < marca['ultima_key']:
+                self.armazem.gravar_marca(pasta, marca['ultima_key'], False)
+                pastas.add(pasta)
+        return pastas
+
+    def sincronizar_pasta(self, s3, pasta, marca, forcar_completo=False):
+        """Sincroniza uma pasta; retorna (novos_ou_alterados, removidos, completo)"""
+        agora = time.time()
+        completo = (
+            forcar_completo
+            or not marca
+            or not marca['monotonica']
+            or not marca['ultima_key']
+            # Marca gravada a partir de uma key fora da numeração: não é confiável
+            or not self.conta_para_marca(marca['ultima_key'])
+            or marca['reconciliado_em'] is None
+            or agora - marca['reconciliado_em'] >= self.reconciliacao
+        )
+
+        if not completo:
+            listados = self._listar(s3, pasta, start_after=marca['ultima_key'])
+            # Keys fora da numeração (Thumbs.db, IMG_*.jpg) ficam acima da marca e
+            # voltam em toda listagem: só o que o armazém ainda não tem é novidade
+            novos = self.armazem.aplicar(listados) if listados else []
+            ultima_key = self._marca_de(listados)
+            if ultima_key and ultima_key != marca['ultima_key']:
+                self.armazem.gravar_marca(pasta, ultima_key, True)
+            return novos, [], False
+
+        imagens = self._listar(s3, pasta)
+        alterados, removidos, inseridos = self.armazem.substituir(imagens, prefix=pasta)
+
+        # Numeração crescente: nenhuma key nova apareceu abaixo da marca anterior
+        ultima_anterior = marca['ultima_key'] if marca else None
+        monotonica = not (ultima_anterior and any(
+            key < ultima_anterior for key in inseridos if self.conta_para_marca(key)))
+        ultima_key = self._marca_de(imagens)
+        self.armazem.gravar_marca(pasta, ultima_key, monotonica, agora)
+        return alterados, removidos, True
+
+    def sincronizar(self, forcar_completo=False):
+        """Sincroniza todas as raízes; retorna (novos_ou_alterados, removidos)"""
+        inicio = time.time()
+        self._chamadas = 0
+        s3 = self.conectar()
+        marcas = self.armazem.marcas()
+        novos, removidos = [], []
+        pastas_completas = 0
+
+        for raiz in self.raizes:
+            pastas, soltos = descobrir_subprefixos(s3, self.bucket, raiz)
+            with self._lock_chamadas:
+                self._chamadas += 1
+            # Arquivos soltos na raiz já vieram na listagem com Delimiter
+            soltos = [objeto_para_imagem(obj) for obj in soltos if not obj['Key'].endswith('/')]
+            alterados, fora, _ = self.armazem.substituir(soltos, pasta=raiz)
+            novos.extend(alterados)
+            removidos.extend(fora)
+
+            # Pastas sincronizadas em paralelo (workers limitados)
+            if pastas:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pastas)),
+                                        thread_name_prefix='sync-catalogo') as executor:
+                    resultados = executor.map(
+                        lambda pasta: self.sincronizar_pasta(s3, pasta, marcas.get(pasta), forcar_completo),
+                        pastas
+                    )
+                    for alterados, fora, completo in resultados:
+                        novos.extend(alterados)
+                        removidos.extend(fora)
+                        pastas_completas += completo
+
+            # Pastas que sumiram do bucket
+            for pasta in marcas:
+                if pasta.startswith(raiz) and pasta not in pastas and pasta.count('/') == raiz.count('/') + 1:
+                    _, fora, _ = self.armazem.substituir([], prefix=pasta)
+                    removidos.extend(fora)
+                    self.armazem.remover_marca(pasta)
+
+        self.ultima_execucao = {
+            'novos_ou_alterados': len(novos),
+            'removidos': len(removidos),
+            'pastas_reconciliadas': pastas_completas,
+            'chamadas_list': self._chamadas,
+            'duracao': round(time.time() - inicio, 2)
+        }
+        return novos, removidos
+
+    def _dentro_das_raizes(self, key):
+        return any(key.startswith(raiz) for raiz in self.raizes)
+
+    def importar_inventario(self, caminho):
+        """Semeia o catálogo a partir de um S3 Inventory local (manifest.json, CSV[.gz] ou Parquet)
+
+        Não remove nada: as marcas d'água ficam no maior key de cada pasta e a
+        próxima sincronização continua a partir delas com StartAfter (remoções
+        desde a data do inventário aparecem na reconciliação periódica).
+        """
+        caminho = Path(caminho)
+        if caminho.suffix == '.json':
+            manifest = json.loads(caminho.read_text(encoding='utf-8'))
+            colunas = [c.strip() for c in manifest.get('fileSchema', '').split(',')]
+            arquivos = [caminho.parent / Path(f['key']).name for f in manifest.get('files', [])]
+            formato = manifest.get('fileFormat', 'CSV').upper()
+        else:
+            colunas = ['Bucket', 'Key', 'Size', 'LastModifiedDate', 'ETag']
+            arquivos = [caminho]
+            formato = 'PARQUET' if caminho.suffix == '.parquet' else 'CSV'
+
+        total = 0
+        maiores = {}
+        for arquivo in arquivos:
+            lote = []
+            leitor = self._ler_parquet(arquivo) if formato == 'PARQUET' else self._ler_csv(arquivo, colunas)
+            for img in leitor:
+                if img['key'].endswith('/') or not self._dentro_das_raizes(img['key']):
+                    continue
+                lote.append(img)
+                pasta = img['pasta'] + '/'
+                if self.conta_para_marca(img['key']) and img['key'] > maiores.get(pasta, ''):
+                    maiores[pasta] = img['key']
+                if len(lote) >= 5000:
+                    self.armazem.aplicar(lote)
+                    total += len(lote)
+                    lote = []
+            if lote:
+                self.armazem.aplicar(lote)
+                total += len(lote)
+
+        # Marca d'água só para subpastas diretas das raízes (as que a sincronização percorre)
+        agora = time.time()
+        marcas = self.armazem.marcas()
+        for pasta, ultima_key in maiores.items():
+            for raiz in self.raizes:
+                if pasta.startswith(raiz) and pasta != raiz:
+                    subpasta = raiz + pasta[len(raiz):].split('/', 1)[0] + '/'
+                    atual = marcas.get(subpasta)
+                    if not atual or (atual['ultima_key'] or '') < ultima_key:
+                        self.armazem.gravar_marca(subpasta, ultima_key, True, agora)
+                        marcas[subpasta] = {'ultima_key': ultima_key}
+        return total
+
+    @staticmethod
+    def _imagem_inventario(key, size, last_modified, etag):
+        return {
+            'key': key,
+            'size': int(size or 0),
+            'last_modified': _normalizar_data(last_modified),
+            'file_name': key.split('/')[-1],
+            'pasta': '/'.join(key.split('/')[:-1]),
+            'size_kb': round(int(size or 0) / 1024, 1),
+            'etag': (etag or '').strip('"')
+        }
+
+    def _ler_csv(self, arquivo, colunas):
+        abrir = gzip.open if arquivo.suffix == '.gz' else open
+        with abrir(arquivo, 'rt', encoding='utf-8', newline='') as f:
+            for linha in csv.reader(f):
+                registro = dict(zip(colunas, linha))
+                if registro.get('Bucket', self.bucket) != self.bucket:
+                    continue
+                # O inventário CSV grava as keys codificadas como URL
+                yield self._imagem_inventario(
+                    unquote_plus(registro['Key']), registro.get('Size'),
+                    registro.get('LastModifiedDate'), registro.get('ETag')
+                )
+
+    def _ler_parquet(self, arquivo):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Inventário em Parquet requer pyarrow (pip install pyarrow)")
+
+        tabela = pq.read_table(arquivo)
+        for registro in tabela.to_pylist():
+            if registro.get('bucket', self.bucket) != self.bucket:
+                continue
+            yield self._imagem_inventario(
+                registro['key'], registro.get('size'),
+                registro.get('last_modified_date'), registro.get('e_tag')
+            )
+
+
+class CatalogoImagens:
+    """Catálogo em memória das imagens do S3, atualizado em segundo plano"""
+
+    def __init__(self, carregar, intervalo=CATALOGO_INTERVALO, armazem=None,
+                 sincronizador=None, prefix=None, filtro=None, ao_atualizar=None, intervalo_eventos=None,
+                 coordenar=False):
+        # carregar: função sem argumentos que retorna todas as imagens (TabelaImagens ou lista)
+        # armazem: ArmazemCatalogo opcional para persistir e reaproveitar a listagem
+        # sincronizador: SincronizadorCatalogo opcional; quando presente, as
+        #   atualizações são incrementais e `carregar` não é usado
+        # prefix/filtro: o que do armazém entra no snapshot em memória
+        # ao_atualizar: chamada com as imagens novas/alteradas (mais recentes
+        #   primeiro) após cada atualização, exceto a primeira carga
+        # intervalo_eventos: enquanto chegarem eventos do S3 (aplicar_eventos), a
+        #   atualização periódica passa a esperar este intervalo
+        # coordenar: vários processos no mesmo armazém; só o líder lista o S3 e
+        #   os demais seguem o log de alterações (exige armazem)
+        self.carregar = carregar
+        self.intervalo = intervalo
+        self.armazem = armazem
+        self.sincronizador = sincronizador
+        self.prefix = prefix
+        self.filtro = filtro
+        self.ao_atualizar = ao_atualizar
+        self.intervalo_eventos = intervalo_eventos
+        self._imagens = TabelaImagens()
+        self._lock = threading.Lock()
+        # Serializa quem gera snapshots novos (atualização periódica e eventos)
+        self._lock_escrita = threading.Lock()
+        self._eventos_em = None
+        self._compactado_em = time.time()
+        self.coordenado = bool(coordenar and armazem)
+        self.dono = f"{socket.gethostname()}:{os.getpid()}"
+        self._lider = False
+        self._seq = 0
+        self._thread_lideranca = None
+        self._pronto = threading.Event()
+        self._parar = threading.Event()
+        self._thread = None
+        self._atualizado_em = None
+        self._duracao = None
+        self._ultimo_erro = None
+
+    def iniciar(self):
+        """Inicia a thread de atualização periódica"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._loop, name='catalogo-s3', daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        """Sinaliza para a thread de atualização encerrar"""
+        self._parar.set()
+        if self.coordenado and self._lider:
+            try:
+                self.armazem.liberar_lideranca(self.dono)
+            except Exception as e:
+                print(f"[CATALOGO] Falha ao liberar liderança: {e}")
+            self._lider = False
+
+    def _loop(self):
+        espera = self._carregar_do_armazem()
+        if self.coordenado:
+            self._renovar_lideranca()
+            self._thread_lideranca = threading.Thread(target=self._loop_lideranca,
+                                                      name='catalogo-lideranca', daemon=True)
+            self._thread_lideranca.start()
+        # Catálogo em disco ainda válido: só relista o S3 quando vencer
+        proxima = time.time() + espera
+        while not self._parar.is_set():
+            if time.time() - self._compactado_em >= CATALOGO_COMPACTACAO:
+                self.compactar()
+            if self.coordenado:
+                self._seguir()
+                if not self._lider:
+                    # Se este processo assumir depois, espera um intervalo a partir daqui
+                    proxima = time.time() + self._proxima_espera()
+                    self._parar.wait(CATALOGO_ESPERA_SEGUIDOR)
+                    continue
+            if time.time() >= proxima:
+                if self.atualizar() and self.coordenado:
+                    self._podar_log()
+                proxima = time.time() + self._proxima_espera()
+            restante = max(0, proxima - time.time())
+            self._parar.wait(min(restante, CATALOGO_ESPERA_SEGUIDOR if self.coordenado else CATALOGO_COMPACTACAO))
+
+    def _renovar_lideranca(self):
+        try:
+            lider = self.armazem.assumir_lideranca(self.dono)
+        except Exception as e:
+            print(f"[CATALOGO] Falha ao renovar liderança: {e}")
+            lider = False
+        if lider != self._lider:
+            print(f"[CATALOGO] {self.dono} {'assumiu' if lider else 'perdeu'} a liderança")
+        self._lider = lider
+
+    def _loop_lideranca(self):
+        # Thread própria: o lease continua sendo renovado durante uma listagem longa
+        while not self._parar.wait(CATALOGO_LIDERANCA_TTL / 3):
+            self._renovar_lideranca()
+
+    def _podar_log(self):
+        try:
+            self.armazem.podar_alteracoes()
+        except Exception as e:
+            print(f"[CATALOGO] Falha ao podar log de alterações: {e}")
+
+    def _seguir(self):
+        """Aplica ao snapshot o que foi gravado no armazém (por este ou outro processo)"""
+        try:
+            alteracoes = self.armazem.alteracoes_desde(self._seq)
+        except Exception as e:
+            print(f"[CATALOGO] Falha ao ler log de alterações: {e}")
+            return
+        if alteracoes is None:
+            # Atrasado demais (log podado ou delta grande): recarrega tudo
+            self._carregar_do_armazem()
+            return
+        seq, novos, removidos = alteracoes
+        if seq == self._seq:
+            return
+
+        with self._lock_escrita:
+            atuais = self._imagens
+            # O que este processo mesmo gravou já está no snapshot: não refaz a tabela à toa
+            novos = [
+                img for img in self._filtrar(novos)
+                if (atual := atuais.obter(img['key'])) is None
+                or (atual['etag'], atual['last_modified']) != (img['etag'], img['last_modified'])
+            ]
+            removidos = [key for key in removidos if atuais.obter(key) is not None]
+            if novos or removidos:
+                imagens = self._aplicar_delta(novos, removidos)
+                with self._lock:
+                    self._imagens = imagens
+                    self._atualizado_em = time.time()
+            self._seq = seq
+        if novos or removidos:
+            print(f"[CATALOGO] Log do armazém: {len(novos)} novos/alterados, {len(removidos)} removidos")
+        if not self._pronto.is_set() and len(self._imagens):
+            self._pronto.set()
+
+    def compactar(self):
+        """Junta ao snapshot o delta sobreposto por eventos/sincronizações (merge O(N))"""
+        self._compactado_em = time.time()
+        with self._lock_escrita:
+            with self._lock:
+                atuais = self._imagens
+            if not atuais.sobrepostas():
+                return
+            try:
+                imagens = atuais.compactar()
+            except Exception as e:
+                print(f"[CATALOGO] Falha ao compactar snapshot: {e}")
+                return
+            with self._lock:
+                self._imagens = imagens
+        print(f"[CATALOGO] Snapshot compactado em {time.time() - self._compactado_em:.1f}s")
+
+    def _proxima_espera(self):
+        if (self.intervalo_eventos and self._eventos_em is not None
+                and time.time() - self._eventos_em < self.intervalo_eventos):
+            return self.intervalo_eventos
+        return self.intervalo
+
+    def _carregar_do_armazem(self):
+        """Carrega o snapshot do SQLite; retorna quantos segundos faltam para vencer"""
+        if not self.armazem:
+            return 0
+        try:
+            atualizado_em = self.armazem.atualizado_em()
+            if atualizado_em is None:
+                return 0
+            # Antes de ler: o que for gravado durante a leitura vem depois pelo log
+            seq = self.armazem.ultima_alteracao()
+            imagens = self._filtrar(self.armazem.todas(self.prefix))
+            imagens = TabelaImagens.construir((registro_de_imagem(img) for img in imagens),
+                                              indice=IndiceTrigramas())
+        except Exception as e:
+            print(f"[CATALOGO] Falha ao ler catálogo em disco: {e}")
+            return 0
+
+        with self._lock_escrita:
+            with self._lock:
+                self._imagens = imagens
+                self._atualizado_em = atualizado_em
+            self._seq = seq
+        self._pronto.set()
+        print(f"[CATALOGO] {len(imagens)} imagens carregadas do disco ({self.armazem.caminho})")
+        return max(0, self.intervalo - (time.time() - atualizado_em))
+
+    def _filtrar(self, imagens):
+        if isinstance(imagens, TabelaImagens):
+            return imagens.filtrar(prefix=self.prefix, funcao=self.filtro)
+        if self.prefix:
+            imagens = [img for img in imagens if img['key'].startswith(self.prefix)]
+        if self.filtro:
+            imagens = [img for img in imagens if self.filtro(img)]
+        return imagens
+
+    def _aplicar_delta(self, novos, removidos):
+        """Gera um novo snapshot a partir do atual mais o delta da sincronização"""
+        with self._lock:
+            atuais = self._imagens
+        if not atuais.indexada or atuais.documentos_indexados() > 2 * len(atuais) + 1000:
+            # Índice de nomes com muito lixo (nomes de imagens removidas/alteradas): refaz do zero
+            atuais = TabelaImagens.construir(atuais.registros(), ordenado=True, indice=IndiceTrigramas())
+        # Delta pequeno fica sobreposto (compactado depois, em compactar); senão
+        # merge linear com a tabela já ordenada e só os nomes novos entram no índice
+        return atuais.mesclar((registro_de_imagem(img) for img in novos), removidos)
+
+    def atualizar(self):
+        """Atualiza o snapshot (incremental com sincronizador, senão listagem completa)"""
+        inicio = time.time()
+        try:
+            if self.sincronizador:
+                novos, removidos = self.sincronizador.sincronizar()
+                novos = self._filtrar(novos)
+            else:
+                imagens = self._filtrar(self.carregar())
+                registros = (imagens.registros() if isinstance(imagens, TabelaImagens)
+                             else (registro_de_imagem(img) for img in imagens))
+                imagens = TabelaImagens.construir(registros, ordenado=isinstance(imagens, TabelaImagens),
+                                                  indice=IndiceTrigramas())
+            with self._lock_escrita:
+                if self.sincronizador:
+                    imagens = self._aplicar_delta(novos, removidos)
+                with self._lock:
+                    anteriores = self._imagens
+                    self._imagens = imagens
+                    self._atualizado_em = time.time()
+                    self._duracao = self._atualizado_em - inicio
+                    self._ultimo_erro = None
+        except Exception as e:
+            # Mantém o snapshot anterior; o erro fica visível no status
+            self._ultimo_erro = str(e)
+            print(f"[CATALOGO] Falha ao atualizar: {e}")
+            return False
+
+        self._pronto.set()
+        print(f"[CATALOGO] {len(imagens)} imagens carregadas em {self._duracao:.1f}s")
+
+        if self.armazem and not self.sincronizador:
+            try:
+                self.armazem.substituir(list(imagens), prefix=self.prefix)
+            except Exception as e:
+                print(f"[CATALOGO] Falha ao gravar catálogo em disco: {e}")
+
+        if self.ao_atualizar and anteriores:
+            if self.sincronizador:
+                alteradas = sorted(novos, key=chave_recencia, reverse=True)
+            else:
+                vistas = set(anteriores.pares())
+                alteradas = imagens.filtrar(funcao=lambda img: (img['key'], img['etag']) not in vistas)
+            if alteradas:
+                try:
+                    self.ao_atualizar(alteradas)
+                except Exception as e:
+                    print(f"[CATALOGO] Falha no ao_atualizar: {e}")
+        return True
+
+    def aplicar_eventos(self, novos=(), removidos=()):
+        """Aplica ao snapshot (e ao armazém) um delta vindo de eventos do S3
+
+        Não depende do intervalo de atualização: a imagem aparece assim que o
+        evento chega. A sincronização periódica continua corrigindo o que se perder.
+        """
+        novos = self._filtrar(list(novos))
+        removidos = list(removidos)
+        if not novos and not removidos:
+            return 0
+        if self.armazem:
+            self.armazem.aplicar(novos, removidos)
+        if self.sincronizador and novos:
+            # Key nova abaixo da marca d'água: a pasta é relistada na próxima sincronização
+            for pasta in self.sincronizador.observar_keys(img['key'] for img in novos):
+                print(f"[CATALOGO] Key fora da numeração em {pasta}: pasta será reconciliada")
+        with self._lock_escrita:
+            imagens = self._aplicar_delta(novos, removidos)
+            with self._lock:
+                self._imagens = imagens
+                self._eventos_em = time.time()
+        print(f"[CATALOGO] Eventos: {len(novos)} novos/alterados, {len(removidos)} removidos")
+
+        if self.ao_atualizar and novos:
+            try:
+                self.ao_atualizar(sorted(novos, key=chave_recencia, reverse=True))
+            except Exception as e:
+                print(f"[CATALOGO] Falha no ao_atualizar: {e}")
+        return len(novos) + len(removidos)
+
+    @property
+    def lider(self):
+        """Este processo lista o S3? (sempre, quando não há coordenação)"""
+        return self._lider if self.coordenado else True
+
+    @property
+    def pronto(self):
+        return self._pronto.is_set()
+
+    def aguardar(self, timeout=None):
+        """Bloqueia até a primeira carga terminar (ou timeout)"""
+        return self._pronto.wait(timeout)
+
+    def imagens(self, prefix=None):
+        """Retorna o snapshot atual (TabelaImagens ordenada por data, mais recente primeiro)"""
+        with self._lock:
+            imagens = self._imagens
+        if prefix:
+            return imagens.filtrar(prefix=prefix)
+        return imagens
+
+    def obter(self, key):
+        """Imagem do snapshot atual pelo key, ou None"""
+        with self._lock:
+            imagens = self._imagens
+        return imagens.obter(key)
+
+    def pagina(self, limite, apos=None):
+        """Próximas `limite` imagens depois da posição `apos` = (last_modified, key)
+
+        Paginação por posição (keyset): continua estável entre atualizações do
+        snapshot, sem pular nem repetir itens que não mudaram.
+        """
+        with self._lock:
+            imagens = self._imagens
+        return imagens.pagina(limite, apos)
+
+    def idade(self):
+        """Segundos desde a última atualização bem-sucedida"""
+        if self._atualizado_em is None:
+            return None
+        return round(time.time() - self._atualizado_em, 1)
+
+    def status(self):
+        return {
+            'pronto': self.pronto,
+            'total': len(self._imagens),
+            'memoria_mb': round(self._imagens.memoria() / (1024 * 1024), 1),
+            'indice_nomes': self._imagens.status_indice(),
+            'linhas_sobrepostas': self._imagens.sobrepostas(),
+            'idade_segundos': self.idade(),
+            'atualizado_em': datetime.fromtimestamp(self._atualizado_em).isoformat() if self._atualizado_em else None,
+            'duracao_ultima_carga': round(self._duracao, 2) if self._duracao is not None else None,
+            'intervalo_segundos': self.intervalo,
+            'persistente': str(self.armazem.caminho) if self.armazem else None,
+            'modo': 'incremental' if self.sincronizador else 'completo',
+            'processo': self.dono,
+            'lider': self._lider if self.coordenado else None,
+            'seq_alteracoes': self._seq if self.coordenado else None,
+            'ultima_sincronizacao': self.sincronizador.ultima_execucao if self.sincronizador else None,
+            'proxima_espera_segundos': self._proxima_espera(),
+            'ultimo_erro': self._ultimo_erro
+        }
+
+
+if __name__ == '__main__':
+    import sys
+    import boto3
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    RAIZES_PADRAO = ['lab/Arquivos/Foto/', 'lab/Arquivos/Historico/']
+
+    def conectar_s3():
+        return boto3.client(
+            's3',
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_KEY'),
+            region_name=os.getenv('AWS_REGION', 'sa-east-1')
+        )
+
+    args = sys.argv[1:]
+    if not args or args[0] not in ('--sync', '--inventario'):
+        print("Uso:")
+        print("  python catalogo_s3.py --sync [--completo] [raiz ...]")
+        print("  python catalogo_s3.py --inventario <manifest.json|arquivo.csv.gz|arquivo.parquet> [raiz ...]")
+        sys.exit(1)
+
+    armazem = ArmazemCatalogo()
+    comando = args.pop(0)
+    completo = '--completo' in args
+    args = [a for a in args if a != '--completo']
+
+    if comando == '--inventario':
+        if not args:
+            print("[ERRO] Informe o caminho do inventário")
+            sys.exit(1)
+        caminho = args.pop(0)
+        sincronizador = SincronizadorCatalogo(conectar_s3, os.getenv('S3_BUCKET_NAME', 'aplis2'),
+                                              args or RAIZES_PADRAO, armazem)
+        print(f"[INFO] Importando inventário {caminho}...")
+        total = sincronizador.importar_inventario(caminho)
+        print(f"[OK] {total} objetos importados para {armazem.caminho}")
+    else:
+        sincronizador = SincronizadorCatalogo(conectar_s3, os.getenv('S3_BUCKET_NAME', 'aplis2'),
+                                              args or RAIZES_PADRAO, armazem)
+        print(f"[INFO] Sincronizando {', '.join(sincronizador.raizes)}...")
+        sincronizador.sincronizar(forcar_completo=completo)
+        print(f"[OK] {sincronizador.ultima_execucao}")
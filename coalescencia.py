@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+
+class _Voo:
+    """Uma execução em andamento e quem está esperando por ela"""
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+        self.esperando = 0
+
+
+class _Contadores:
+    def __init__(self):
+        self.execucoes = 0
+        self.compartilhadas = 0
+
+    def status(self, voos):
+        return {
+            'execucoes': self.execucoes,
+            'compartilhadas': self.compartilhadas,
+            'em_andamento': {str(chave): esperando for chave, esperando in voos}
+        }
+
+
+class Coalescedor:
+    """Singleflight para threads: chamadas simultâneas com a mesma chave
+    compartilham uma única execução e o seu resultado (ou exceção)
+
+    Só junta quem chega enquanto a execução está em andamento; nada é guardado
+    depois que ela termina. O resultado é o mesmo objeto para todos: não alterar.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._voos = {}
+        self._contadores = _Contadores()
+
+    def executar(self, chave, func, *args, **kwargs):
+        with self._lock:
+            voo = self._voos.get(chave)
+            lider = voo is None
+            if lider:
+                voo = self._voos[chave] = _Voo()
+                self._contadores.execucoes += 1
+            else:
+                voo.esperando += 1
+                self._contadores.compartilhadas += 1
+
+        if not lider:
+            voo.evento.wait()
+            if voo.erro is not None:
+                raise voo.erro
+            return voo.resultado
+
+        try:
+            voo.resultado = func(*args, **kwargs)
+            return voo.resultado
+        except Exception as e:
+            voo.erro = e
+            raise
+        finally:
+            with self._lock:
+                del self._voos[chave]
+            voo.evento.set()
+
+    def status(self):
+        """Execuções, quantas chamadas pegaram carona e esperando por chave agora"""
+        with self._lock:
+            return self._contadores.status([(c, v.esperando) for c, v in self._voos.items()])
+
+
+class CoalescedorAsync:
+    """Singleflight para o event loop: `func` é uma coroutine function
+
+    A execução roda numa task própria: se o primeiro cliente desconectar,
+    os outros que estão esperando continuam recebendo o resultado.
+    """
+
+    def __init__(self):
+        self._voos = {}
+        self._contadores = _Contadores()
+
+    async def executar(self, chave, func, *args, **kwargs):
+        voo = self._voos.get(chave)
+        if voo is None:
+            tarefa = asyncio.ensure_future(func(*args, **kwargs))
+            voo = self._voos[chave] = [tarefa, 0]
+            self._contadores.execucoes += 1
+            tarefa.add_done_callback(lambda _: self._voos.pop(chave, None))
+        else:
+            voo[1] += 1
+            self._contadores.compartilhadas += 1
+        return await asyncio.shield(voo[0])
+
+    def status(self):
+        return self._contadores.status([(c, v[1]) for c, v in self._voos.items()])
@@ -0,0 +1,359 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import unquote_plus
+
+# Arquivo local com eventos do S3 (um JSON por linha), lido continuamente em segundo
+# plano; substitui uma fila real (ex: um consumidor de SQS que só grava as mensagens)
+EVENTOS_ARQUIVO = os.getenv('EVENTOS_ARQUIVO')
+# Token exigido no webhook (header X-Eventos-Token ou ?token=). Obrigatório: sem
+# ele o webhook responde 403 a tudo (eventos podem remover imagens do catálogo)
+EVENTOS_TOKEN = os.getenv('EVENTOS_TOKEN', '')
+# Com eventos chegando, a sincronização periódica vira só uma rede de segurança
+EVENTOS_INTERVALO_SYNC = int(os.getenv('EVENTOS_INTERVALO_SYNC', '3600'))
+EVENTOS_ESPERA_ARQUIVO = float(os.getenv('EVENTOS_ESPERA_ARQUIVO', '1'))
+# Keys cujo último sequencer é lembrado (descarta eventos atrasados/repetidos)
+EVENTOS_MAX_SEQUENCERS = 100_000
+# Eventos que chegam dentro desta janela (segundos) são aplicados num lote só;
+# 0 aplica a cada payload. Com EVENTOS_LOTE_MAX pendentes, aplica na hora
+EVENTOS_JANELA = float(os.getenv('EVENTOS_JANELA', '1'))
+EVENTOS_LOTE_MAX = int(os.getenv('EVENTOS_LOTE_MAX', '5000'))
+
+
+def _data_evento(valor):
+    """eventTime ('2024-01-01T12:00:00.123Z') -> mesmo formato do LastModified da listagem"""
+    if not valor:
+        data = datetime.now(timezone.utc)
+    else:
+        data = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+        if data.tzinfo is None:
+            data = data.replace(tzinfo=timezone.utc)
+    # LastModified tem resolução de segundos
+    return data.astimezone(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def _evento(tipo, bucket, objeto, quando, key_codificada):
+    key = objeto.get('key', '')
+    if key_codificada:
+        key = unquote_plus(key)
+    return {
+        'tipo': tipo,
+        'bucket': bucket,
+        'key': key,
+        'size': int(objeto.get('size') or 0),
+        'etag': (objeto.get('eTag') or objeto.get('etag') or '').strip('"'),
+        'sequencer': objeto.get('sequencer'),
+        'last_modified': _data_evento(quando)
+    }
+
+
+def extrair_eventos(payload):
+    """Eventos de objeto de uma notificação do S3 (direta, via SNS, SQS ou EventBridge)
+
+    Retorna dicts com tipo ('criado'/'removido'), bucket, key (já decodificada),
+    size, etag, sequencer e last_modified. Payloads sem eventos de objeto (ex:
+    s3:TestEvent) geram lista vazia.
+    """
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+    if isinstance(payload, list):
+        return [evento for item in payload for evento in extrair_eventos(item)]
+    if not isinstance(payload, dict):
+        return []
+
+    # Envelopes: SNS (Message) e SQS (Body) trazem a notificação como string JSON
+    if payload.get('Type') == 'Notification' and 'Message' in payload:
+        return extrair_eventos(payload['Message'])
+    if 'Body' in payload and 'Records' not in payload:
+        return extrair_eventos(payload['Body'])
+
+    # EventBridge: key sem codificação de URL
+    if payload.get('source') == 'aws.s3' and 'detail' in payload:
+        detalhe = payload['detail']
+        tipo = {'Object Created': 'criado', 'Object Deleted': 'removido'}.get(payload.get('detail-type'))
+        if tipo is None:
+            return []
+        return [_evento(tipo, detalhe.get('bucket', {}).get('name'), detalhe.get('object', {}),
+                        payload.get('time'), key_codificada=False)]
+
+    eventos = []
+    for registro in payload.get('Records') or []:
+        nome = registro.get('eventName', '')
+        if nome.startswith('ObjectCreated:'):
+            tipo = 'criado'
+        elif nome.startswith('ObjectRemoved:'):
+            tipo = 'removido'
+        else:
+            continue
+        s3 = registro.get('s3', {})
+        # Notificações do S3 gravam a key codificada como URL (espaço vira '+')
+        eventos.append(_evento(tipo, s3.get('bucket', {}).get('name'), s3.get('object', {}),
+                               registro.get('eventTime'), key_codificada=True))
+    return eventos
+
+
+def comparar_sequencers(a, b):
+    """-1, 0 ou 1 comparando dois sequencers do S3
+
+    Como a documentação do S3 manda: o mais curto é completado com '0' à direita
+    e as strings são comparadas lexicograficamente (não como número).
+    """
+    tamanho = max(len(a), len(b))
+    a, b = a.ljust(tamanho, '0'), b.ljust(tamanho, '0')
+    return (a > b) - (a < b)
+
+
+def eh_confirmacao_sns(payload):
+    """Pedido de confirmação de assinatura do SNS (precisa visitar a SubscribeURL)"""
+    return isinstance(payload, dict) and payload.get('Type') == 'SubscriptionConfirmation'
+
+
+class IngestorEventos:
+    """Aplica eventos do S3 ao catálogo: novos/sobrescritos entram, removidos saem
+
+    aplicar(novos, removidos) recebe imagens no formato da API e keys removidas.
+    Eventos chegam fora de ordem e repetidos: por key, só vale o de maior
+    sequencer já visto (ver comparar_sequencers). Os eventos ficam numa fila e
+    são aplicados em lote (ver processar e descarregar).
+    """
+
+    def __init__(self, aplicar, bucket, raizes, aceitar=None, max_sequencers=EVENTOS_MAX_SEQUENCERS,
+                 janela=EVENTOS_JANELA, max_pendentes=EVENTOS_LOTE_MAX):
+        self.aplicar = aplicar
+        self.bucket = bucket
+        self.raizes = tuple(raizes)
+        # aceitar(img): filtro extra para objetos criados (ex: só imagens)
+        self.aceitar = aceitar
+        self.max_sequencers = max_sequencers
+        self.janela = janela
+        self.max_pendentes = max_pendentes
+        self._sequencers = OrderedDict()
+        # Fila do próximo lote: key -> imagem / key removida / key -> sequencer
+        self._novos, self._removidos, self._pendentes = {}, {}, {}
+        self._lock = threading.Lock()
+        # Um lote por vez: lotes são aplicados na ordem em que saem da fila
+        self._lock_aplicar = threading.Lock()
+        self._timer = None
+        self._stats = {'recebidos': 0, 'aplicados': 0, 'ignorados': 0, 'fora_de_ordem': 0, 'lotes': 0}
+        self.ultimo_evento_em = None
+
+    def _mais_recente(self, key, sequencer):
+        """False se já houve evento mais novo para a key (aplicado ou na fila)"""
+        if not sequencer:
+            return True
+        valor = sequencer.upper()
+        anterior = self._pendentes.get(key, self._sequencers.get(key))
+        if anterior is not None and comparar_sequencers(anterior, valor) >= 0:
+            return False
+        self._pendentes[key] = valor
+        return True
+
+    def _registrar_sequencers(self, pendentes):
+        for key, valor in pendentes.items():
+            self._sequencers[key] = valor
+            self._sequencers.move_to_end(key)
+        while len(self._sequencers) > self.max_sequencers:
+            self._sequencers.popitem(last=False)
+
+    def enfileirar(self, payload):
+        """Extrai os eventos de um payload e os põe na fila; retorna quantos entraram"""
+        eventos = extrair_eventos(payload)
+        enfileirados = 0
+        with self._lock:
+            self._stats['recebidos'] += len(eventos)
+            for evento in eventos:
+                key = evento['key']
+                if (evento['bucket'] not in (None, self.bucket)
+                        or not key.startswith(self.raizes) or key.endswith('/')):
+                    self._stats['ignorados'] += 1
+                    continue
+                if not self._mais_recente(key, evento['sequencer']):
+                    self._stats['fora_de_ordem'] += 1
+                    continue
+                # Só o último evento de cada key vai para o lote
+                self._novos.pop(key, None)
+                self._removidos.pop(key, None)
+                if evento['tipo'] == 'removido':
+                    self._removidos[key] = True
+                    enfileirados += 1
+                    continue
+                img = {
+                    'key': key,
+                    'size': evento['size'],
+                    'last_modified': evento['last_modified'],
+                    'file_name': key.split('/')[-1],
+                    'pasta': '/'.join(key.split('/')[:-1]),
+                    'size_kb': round(evento['size'] / 1024, 1),
+                    'etag': evento['etag']
+                }
+                if self.aceitar and not self.aceitar(img):
+                    self._stats['ignorados'] += 1
+                    continue
+                self._novos[key] = img
+                enfileirados += 1
+        return enfileirados
+
+    def processar(self, payload):
+        """Enfileira os eventos de um payload; retorna quantos entraram na fila
+
+        O lote é aplicado `janela` segundos depois do primeiro evento (um só
+        aplicar para tudo que chegar nesse meio tempo), ou já aqui se a janela
+        for 0 ou a fila chegar a `max_pendentes`.
+        """
+        enfileirados = self.enfileirar(payload)
+        if self.janela <= 0 or self.pendentes() >= self.max_pendentes:
+            self.descarregar()
+        elif enfileirados:
+            self._agendar()
+        return enfileirados
+
+    def pendentes(self):
+        with self._lock:
+            return len(self._novos) + len(self._removidos)
+
+    def _agendar(self):
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.janela, self._descarregar_agendado)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _descarregar_agendado(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.descarregar()
+        except Exception as e:
+            print(f"[EVENTOS] Falha ao aplicar lote de eventos: {e}")
+            # O lote voltou para a fila: tenta de novo na próxima janela
+            self._agendar()
+
+    def descarregar(self):
+        """Aplica de uma vez tudo que está na fila; retorna quantos eventos foram aplicados"""
+        with self._lock_aplicar:
+            with self._lock:
+                novos, removidos, pendentes = self._novos, self._removidos, self._pendentes
+                self._novos, self._removidos, self._pendentes = {}, {}, {}
+            try:
+                if novos or removidos:
+                    self.aplicar(list(novos.values()), list(removidos))
+            except Exception:
+                with self._lock:
+                    # Devolve o lote à fila, menos as keys que já têm evento mais novo nela
+                    for key, valor in pendentes.items():
+                        self._pendentes.setdefault(key, valor)
+                    for key in novos.keys() | removidos.keys():
+                        if key not in self._novos and key not in self._removidos:
+                            if key in novos:
+                                self._novos[key] = novos[key]
+                            else:
+                                self._removidos[key] = True
+                raise
+            with self._lock:
+                # Só depois de aplicado: se falhar, os eventos continuam na fila
+                self._registrar_sequencers(pendentes)
+                if not novos and not removidos:
+                    return 0
+                self._stats['aplicados'] += len(novos) + len(removidos)
+                self._stats['lotes'] += 1
+                self.ultimo_evento_em = time.time()
+        return len(novos) + len(removidos)
+
+    def status(self):
+        with self._lock:
+            return {
+                **self._stats,
+                'pendentes': len(self._novos) + len(self._removidos),
+                'janela_segundos': self.janela,
+                'ultimo_evento_em': (datetime.fromtimestamp(self.ultimo_evento_em).isoformat()
+                                     if self.ultimo_evento_em else None)
+            }
+
+
+class LeitorArquivoEventos:
+    """Acompanha um arquivo de eventos (um payload JSON por linha), como um `tail -f`
+
+    A posição lida é gravada em `<arquivo>.pos` para não reaplicar tudo ao
+    reiniciar; se o arquivo encolher (rotacionado/truncado), volta ao início.
+    """
+
+    def __init__(self, caminho, ingestor, espera=EVENTOS_ESPERA_ARQUIVO, ativo=None):
+        # ativo(): com vários processos, só quem retornar True lê o arquivo (o líder)
+        self.ativo = ativo
+        self.caminho = Path(caminho)
+        self.caminho_posicao = self.caminho.with_name(self.caminho.name + '.pos')
+        self.ingestor = ingestor
+        self.espera = espera
+        self._parar = threading.Event()
+        self._thread = None
+        self.linhas_invalidas = 0
+
+    def iniciar(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._loop, name='eventos-s3', daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+
+    def _ler_posicao(self):
+        try:
+            return int(self.caminho_posicao.read_text().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _gravar_posicao(self, posicao):
+        temporario = self.caminho_posicao.with_name(self.caminho_posicao.name + '.tmp')
+        temporario.write_text(str(posicao))
+        os.replace(temporario, self.caminho_posicao)
+
+    def ler_novas(self, posicao):
+        """Aplica, num lote só, as linhas completas a partir de `posicao`; retorna a nova posição"""
+        try:
+            if self.caminho.stat().st_size < posicao:
+                posicao = 0
+        except FileNotFoundError:
+            return posicao
+        with open(self.caminho, 'rb') as f:
+            f.seek(posicao)
+            for linha in f:
+                # Linha ainda sendo escrita: espera o '\n'
+                if not linha.endswith(b'\n'):
+                    break
+                posicao += len(linha)
+                if not linha.strip():
+                    continue
+                try:
+                    self.ingestor.enfileirar(linha)
+                except ValueError:
+                    self.linhas_invalidas += 1
+                    print(f"[EVENTOS] Linha inválida em {self.caminho.name} (posição {posicao})")
+        # Se falhar, a posição não é gravada e as linhas são lidas de novo
+        self.ingestor.descarregar()
+        return posicao
+
+    def _loop(self):
+        posicao = None
+        while not self._parar.is_set():
+            if self.ativo and not self.ativo():
+                posicao = None
+                self._parar.wait(self.espera)
+                continue
+            if posicao is None:
+                # Ao (re)assumir, continua de onde o último leitor parou
+                posicao = self._ler_posicao()
+            try:
+                nova = self.ler_novas(posicao)
+                if nova != posicao:
+                    posicao = nova
+                    self._gravar_posicao(posicao)
+            except Exception as e:
+                print(f"[EVENTOS] Falha ao ler {self.caminho}: {e}")
+            self._parar.wait(self.espera)
@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    # orjson é opcional: sem ele usa o json da biblioteca padrão
+    orjson = None
+
+# Linhas agrupadas por bloco enviado (menos chamadas de escrita, memória constante)
+EXPORTACAO_LOTE = 500
+COLUNAS_IMAGEM = ('key', 'size', 'last_modified', 'file_name', 'pasta', 'size_kb', 'etag')
+FORMATOS_EXPORTACAO = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8'
+}
+
+
+def serializar_json(obj):
+    """Objeto -> bytes JSON (orjson quando disponível)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def blocos_ndjson(itens, lote=EXPORTACAO_LOTE):
+    """Gera blocos de bytes com um JSON por linha, à medida que os itens são consumidos"""
+    buffer = []
+    for item in itens:
+        buffer.append(serializar_json(item))
+        if len(buffer) >= lote:
+            yield b'\n'.join(buffer) + b'\n'
+            buffer.clear()
+    if buffer:
+        yield b'\n'.join(buffer) + b'\n'
+
+
+def blocos_csv(itens, colunas=COLUNAS_IMAGEM, lote=EXPORTACAO_LOTE):
+    """Gera blocos de bytes CSV (com cabeçalho), à medida que os itens são consumidos"""
+    saida = io.StringIO()
+    escritor = csv.writer(saida)
+    escritor.writerow(colunas)
+    pendentes = 0
+    for item in itens:
+        escritor.writerow([item.get(coluna, '') for coluna in colunas])
+        pendentes += 1
+        if pendentes >= lote:
+            yield saida.getvalue().encode('utf-8')
+            saida.seek(0)
+            saida.truncate()
+            pendentes = 0
+    if saida.tell():
+        yield saida.getvalue().encode('utf-8')
+
+
+def comprimir_gzip(blocos, nivel=6):
+    """Comprime em gzip bloco a bloco (sem juntar a resposta inteira em memória)"""
+    compressor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+    for bloco in blocos:
+        comprimido = compressor.compress(bloco)
+        if comprimido:
+            yield comprimido
+    yield compressor.flush()
+
+
+def aceita_gzip(accept_encoding):
+    return bool(accept_encoding) and 'gzip' in accept_encoding.lower()
+
+
+def exportar(itens, formato, gzip=False, colunas=COLUNAS_IMAGEM):
+    """(gerador de bytes, headers) para um StreamingResponse no formato pedido"""
+    if formato not in FORMATOS_EXPORTACAO:
+        raise ValueError(f"Formato não suportado: {formato} (use {', '.join(FORMATOS_EXPORTACAO)})")
+    blocos = blocos_csv(itens, colunas) if formato == 'csv' else blocos_ndjson(itens)
+    headers = {'Content-Type': FORMATOS_EXPORTACAO[formato]}
+    if gzip:
+        blocos = comprimir_gzip(blocos)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    return blocos, headers
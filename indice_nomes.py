@@ -0,0 +1,104 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class IndiceTrigramas:
+    """Índice invertido de trigramas dos nomes de arquivo (em minúsculas), só de acréscimo
+
+    Cada nome indexado vira um documento com id sequencial; os nomes ficam num
+    único bytearray UTF-8 (separados por '\\n') para a verificação final. Como
+    nada é removido, quem consulta descarta ids que não existem mais no seu
+    snapshot; o catálogo reconstrói o índice quando o lixo passa do dobro.
+    """
+
+    def __init__(self):
+        self._texto = bytearray()
+        self._offsets = array('Q', [0])     # documento d = _texto[_offsets[d]:_offsets[d+1]-1]
+        self._postings = {}                 # trigrama -> array('I') de ids (crescentes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def adicionar(self, nome):
+        """Indexa um nome (já em minúsculas) e retorna o id do documento"""
+        with self._lock:
+            doc = len(self._offsets) - 1
+            self._texto += nome.encode('utf-8') + b'\n'
+            self._offsets.append(len(self._texto))
+            # '\n' + 2 primeiros caracteres marca o início do nome (buscas por prefixo)
+            for trigrama in {nome[i:i + 3] for i in range(len(nome) - 2)} | {'\n' + nome[:2]}:
+                lista = self._postings.get(trigrama)
+                if lista is None:
+                    lista = self._postings[trigrama] = array('I')
+                lista.append(doc)
+        return doc
+
+    def _confere(self, doc, termo, inicio):
+        ini, fim = self._offsets[doc], self._offsets[doc + 1] - 1
+        if inicio:
+            return self._texto.startswith(termo, ini, fim)
+        return self._texto.find(termo, ini, fim) != -1
+
+    def termina_com(self, doc, sufixos):
+        """O nome do documento termina com algum dos sufixos (bytes, minúsculos)?"""
+        return self._texto.endswith(sufixos, self._offsets[doc], self._offsets[doc + 1] - 1)
+
+    def _varrer(self, termo, inicio):
+        """Termos curtos (sem trigrama): find direto no texto de todos os nomes"""
+        encontrados = []
+        texto, offsets = self._texto, self._offsets
+        posicao = texto.find(termo)
+        while posicao != -1:
+            doc = bisect_right(offsets, posicao) - 1
+            fim = offsets[doc + 1] - 1
+            if posicao + len(termo) <= fim and (not inicio or posicao == offsets[doc]):
+                encontrados.append(doc)
+                posicao = texto.find(termo, fim + 1)
+            else:
+                posicao = texto.find(termo, posicao + 1)
+        return encontrados
+
+    def buscar(self, termo, inicio=False):
+        """Ids (crescentes) dos nomes que contêm `termo` (ou começam com ele, se `inicio`)
+
+        Com 3+ caracteres (2+ para prefixo): candidatos pela lista de trigramas
+        mais rara, filtrados pela segunda mais rara e verificados no texto.
+        """
+        termo = termo.lower()
+        termo_bytes = termo.encode('utf-8')
+        if '\n' in termo or not termo:
+            return []
+        trigramas = {termo[i:i + 3] for i in range(len(termo) - 2)}
+        if inicio and len(termo) >= 2:
+            trigramas.add('\n' + termo[:2])
+        if not trigramas:
+            return self._varrer(termo_bytes, inicio)
+
+        listas = []
+        for trigrama in trigramas:
+            lista = self._postings.get(trigrama)
+            if lista is None:
+                return []
+            listas.append(lista)
+        listas.sort(key=len)
+
+        candidatos = listas[0]
+        if len(listas) > 1:
+            segunda = listas[1]
+            candidatos = [
+                doc for doc in candidatos
+                if (i := bisect_left(segunda, doc)) < len(segunda) and segunda[i] == doc
+            ]
+        return [doc for doc in candidatos if self._confere(doc, termo_bytes, inicio)]
+
+    def status(self):
+        with self._lock:
+            postings = sum(len(lista) for lista in self._postings.values())
+            return {
+                'documentos': len(self),
+                'trigramas': len(self._postings),
+                'memoria_mb': round((len(self._texto) + 8 * len(self._offsets) + 4 * postings)
+                                    / (1024 * 1024), 1)
+            }
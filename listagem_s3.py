@@ -0,0 +1,129 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+# Máximo de subpastas listadas ao mesmo tempo
+LISTAGEM_WORKERS = int(os.getenv('LISTAGEM_WORKERS', '8'))
+
+_FIM = object()
+
+
+def iterar_paginas(s3_client, bucket, prefix, **kwargs):
+    """Gera as páginas do prefixo em ordem de key, uma chamada list_objects_v2 por vez
+
+    Nada é listado antes de o consumidor pedir a próxima página, então parar a
+    iteração cedo também para as chamadas ao S3.
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **kwargs):
+        yield page.get('Contents', [])
+
+
+# Filtros combináveis: cada um recebe um objeto do list_objects_v2 e retorna bool
+
+def por_extensao(extensoes):
+    extensoes = tuple(e.lower() for e in extensoes)
+    return lambda obj: obj['Key'].lower().endswith(extensoes)
+
+
+def por_nome(termo):
+    termo = termo.lower()
+    return lambda obj: termo in obj['Key'].rsplit('/', 1)[-1].lower()
+
+
+def por_pasta(pasta):
+    pasta = pasta.rstrip('/') + '/'
+    return lambda obj: obj['Key'].startswith(pasta)
+
+
+def iterar_objetos(s3_client, bucket, prefix, *filtros, limite=None, **kwargs):
+    """Gera objetos (sem 'pastas') que passam em todos os filtros, página a página
+
+    limite: para de listar assim que encontrar essa quantidade.
+    """
+    objetos = (
+        obj
+        for contents in iterar_paginas(s3_client, bucket, prefix, **kwargs)
+        for obj in contents
+        if not obj['Key'].endswith('/') and all(f(obj) for f in filtros)
+    )
+    return islice(objetos, limite) if limite else objetos
+
+
+def descobrir_subprefixos(s3_client, bucket, prefix):
+    """Lista as subpastas diretas do prefixo (Delimiter='/') e os objetos soltos nele"""
+    subprefixos, soltos = [], []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        subprefixos.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        soltos.extend(page.get('Contents', []))
+    return subprefixos, soltos
+
+
+def listar_paralelo(s3_client, bucket, prefix, max_workers=LISTAGEM_WORKERS, **kwargs):
+    """Gera páginas de objetos (listas de dicts do list_objects_v2) do prefixo inteiro
+
+    As subpastas são paginadas em paralelo e cada página é entregue assim que
+    chega, sem ordem garantida entre pastas. A fila é limitada, então os
+    workers esperam quando o consumidor fica para trás; se o consumidor parar
+    de iterar, os workers são cancelados na próxima página.
+    kwargs extras (ex: PaginationConfig) são repassados ao paginator.
+    """
+    subprefixos, soltos = descobrir_subprefixos(s3_client, bucket, prefix)
+    if soltos:
+        yield soltos
+    if not subprefixos:
+        return
+
+    fila = queue.Queue(maxsize=max_workers * 2)
+    cancelado = threading.Event()
+
+    def entregar(item):
+        # put com timeout para nunca ficar preso se o consumidor desistir
+        while not cancelado.is_set():
+            try:
+                fila.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def listar_subprefixo(subprefixo):
+        try:
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=subprefixo, **kwargs):
+                if page.get('Contents') and not entregar(page['Contents']):
+                    return
+        except Exception as e:
+            entregar(e)
+        finally:
+            entregar(_FIM)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(subprefixos)),
+                                  thread_name_prefix='listagem-s3')
+    try:
+        for subprefixo in subprefixos:
+            executor.submit(listar_subprefixo, subprefixo)
+
+        pendentes = len(subprefixos)
+        while pendentes:
+            item = fila.get()
+            if item is _FIM:
+                pendentes -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        cancelado.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iterar_objetos_paralelo(s3_client, bucket, prefix, max_workers=LISTAGEM_WORKERS, **kwargs):
+    """Mesmo que listar_paralelo, mas gera objeto por objeto (ignorando 'pastas')"""
+    for contents in listar_paralelo(s3_client, bucket, prefix, max_workers, **kwargs):
+        for obj in contents:
+            if not obj['Key'].endswith('/'):
+                yield obj
@@ -0,0 +1,175 @@
+import io
+import os
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cache_s3 import CacheBytes, CACHE_DIR
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # Pillow é opcional: sem ele o endpoint de miniaturas responde 501
+    Image = None
+
+# Larguras fixas geradas (pedidos intermediários usam a próxima acima)
+MINIATURA_LARGURAS = tuple(int(w) for w in os.getenv('MINIATURA_LARGURAS', '160,320,640,1280').split(','))
+MINIATURA_FORMATOS = {'webp': 'image/webp', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+MINIATURA_QUALIDADE = int(os.getenv('MINIATURA_QUALIDADE', '80'))
+# Processos para redimensionar (trabalho de CPU, fora do event loop e do pool S3)
+MINIATURA_WORKERS = int(os.getenv('MINIATURA_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Quantas imagens novas por atualização do catálogo têm a miniatura pré-gerada (0 desliga)
+MINIATURA_PREGERAR = int(os.getenv('MINIATURA_PREGERAR', '200'))
+MINIATURA_PADRAO = (320, 'webp')
+
+
+def gerar_miniatura(dados, largura, formato, qualidade=MINIATURA_QUALIDADE):
+    """Redimensiona para `largura` (mantendo a proporção) e converte para `formato`
+
+    Roda nos processos do pool; recebe e devolve bytes.
+    """
+    with Image.open(io.BytesIO(dados)) as original:
+        # JPEG: decodifica já reduzido (bem mais rápido que abrir em resolução cheia)
+        original.draft('RGB', (largura, largura))
+        img = ImageOps.exif_transpose(original)
+        if img.width > largura:
+            altura = max(1, round(img.height * largura / img.width))
+            img = img.resize((largura, altura), Image.LANCZOS)
+        modo = 'RGBA' if formato != 'jpeg' and 'A' in img.getbands() else 'RGB'
+        if img.mode != modo:
+            img = img.convert(modo)
+        saida = io.BytesIO()
+        img.save(saida, format=formato.upper(), quality=qualidade)
+        return saida.getvalue()
+
+
+def normalizar_parametros(largura, formato):
+    """Ajusta a largura para a fixa mais próxima acima; ValueError se o formato não existir"""
+    formato = formato.lower().replace('jpg', 'jpeg')
+    if formato not in MINIATURA_FORMATOS:
+        raise ValueError(f"Formato não suportado: {formato} (use {', '.join(MINIATURA_FORMATOS)})")
+    larguras = sorted(MINIATURA_LARGURAS)
+    largura = next((w for w in larguras if w >= largura), larguras[-1])
+    return largura, formato
+
+
+class GeradorMiniaturas:
+    """Gera miniaturas num pool de processos e guarda por (key, largura, formato) + ETag da origem
+
+    ler_original(key, etag) -> (bytes, etag): busca o arquivo original (bloqueante).
+    """
+
+    def __init__(self, ler_original, cache=None, workers=MINIATURA_WORKERS, pregerar=MINIATURA_PREGERAR):
+        self.ler_original = ler_original
+        self.cache = cache or CacheBytes(limite_memoria=64 * 1024 * 1024, diretorio=CACHE_DIR / 'miniaturas')
+        self.workers = workers
+        self.limite_pregerar = pregerar
+        self._pool = None
+        self._lock = threading.Lock()
+        self._fila = queue.Queue()
+        self._enfileiradas = set()
+        self._thread = None
+        self._stats = {'geradas': 0, 'pregeradas': 0, 'falhas': 0}
+
+    @property
+    def disponivel(self):
+        return Image is not None
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: o processo da API tem threads, fork não é seguro
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def descartar_pool(self):
+        """Descarta um pool quebrado (processo morto); o próximo uso cria outro"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def parar(self):
+        self._fila.put(None)
+        self.descartar_pool()
+
+    @staticmethod
+    def _chave(key, largura, formato):
+        return f"{key}@{largura}.{formato}"
+
+    def obter_cache(self, key, etag, largura, formato):
+        return self.cache.obter(self._chave(key, largura, formato), etag)
+
+    def guardar(self, key, etag, largura, formato, dados):
+        with self._lock:
+            self._stats['geradas'] += 1
+        self.cache.guardar(self._chave(key, largura, formato), etag, dados)
+
+    def gerar(self, key, etag, largura, formato):
+        """Miniatura em bytes (do cache ou gerada agora); bloqueante"""
+        dados = self.obter_cache(key, etag, largura, formato) if etag else None
+        if dados is not None:
+            return dados
+        original, etag = self.ler_original(key, etag)
+        try:
+            dados = self.pool.submit(gerar_miniatura, original, largura, formato).result()
+        except BrokenProcessPool:
+            self.descartar_pool()
+            raise
+        self.guardar(key, etag, largura, formato, dados)
+        return dados
+
+    def pregerar(self, imagens, larguras=(MINIATURA_PADRAO,)):
+        """Enfileira miniaturas das imagens mais recentes; geradas por uma thread em segundo plano"""
+        if not self.disponivel or not self.limite_pregerar:
+            return 0
+        enfileiradas = 0
+        with self._lock:
+            for img in imagens[:self.limite_pregerar]:
+                for largura, formato in larguras:
+                    item = (img['key'], img.get('etag'), largura, formato)
+                    if item in self._enfileiradas:
+                        continue
+                    self._enfileiradas.add(item)
+                    self._fila.put(item)
+                    enfileiradas += 1
+            if enfileiradas and not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._loop_pregerar, name='miniaturas', daemon=True)
+                self._thread.start()
+        return enfileiradas
+
+    def _loop_pregerar(self):
+        while True:
+            item = self._fila.get()
+            if item is None:
+                return
+            key, etag, largura, formato = item
+            try:
+                if etag is None or self.obter_cache(key, etag, largura, formato) is None:
+                    self.gerar(key, etag, largura, formato)
+                    with self._lock:
+                        self._stats['pregeradas'] += 1
+            except Exception as e:
+                with self._lock:
+                    self._stats['falhas'] += 1
+                print(f"[MINIATURAS] Falha ao gerar {key}: {e}")
+            finally:
+                with self._lock:
+                    self._enfileiradas.discard(item)
+
+    def status(self):
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            'disponivel': self.disponivel,
+            'larguras': list(MINIATURA_LARGURAS),
+            'formatos': list(MINIATURA_FORMATOS),
+            'workers': self.workers,
+            'na_fila': self._fila.qsize(),
+            **stats,
+            'cache': self.cache.estatisticas()
+        }
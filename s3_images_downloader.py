@@ -1,16 +1,58 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Response, Header, Request
 from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import time
-import io
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import heapq
+import json
+import base64
+import secrets
+import zipfile
 from pathlib import Path
 from datetime import datetime
+from urllib.parse import urlparse
+from urllib.request import urlopen
+from email.utils import formatdate
+from contextlib import asynccontextmanager
+from listagem_s3 import iterar_objetos_paralelo, iterar_objetos, por_extensao, por_nome, LISTAGEM_WORKERS
+from coalescencia import CoalescedorAsync
+from exportacao_s3 import exportar, aceita_gzip, FORMATOS_EXPORTACAO
+from eventos_s3 import (IngestorEventos, LeitorArquivoEventos, eh_confirmacao_sns,
+                        EVENTOS_ARQUIVO, EVENTOS_TOKEN, EVENTOS_INTERVALO_SYNC)
+from cache_s3 import CacheBytes, CacheTTL, etag_confere, intervalo_range
+from miniaturas_s3 import GeradorMiniaturas, gerar_miniatura, normalizar_parametros, MINIATURA_FORMATOS
+from tabela_imagens import TabelaImagens, registro_de_objeto
+from catalogo_s3 import (CatalogoImagens, ArmazemCatalogo, SincronizadorCatalogo, objeto_para_imagem,
+                         CATALOGO_IDADE_MAXIMA, CATALOGO_MODO, CATALOGO_ESPERA_SEGUIDOR)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Carrega o catálogo em segundo plano; a API já responde enquanto isso
+    catalogo.iniciar()
+    if leitor_eventos:
+        leitor_eventos.iniciar()
+    yield
+    if leitor_eventos:
+        leitor_eventos.parar()
+    try:
+        # Eventos ainda na janela de agrupamento não ficam para trás
+        ingestor_eventos.descarregar()
+    except Exception as e:
+        print(f"[EVENTOS] Falha ao aplicar eventos pendentes: {e}")
+    catalogo.parar()
+    miniaturas.parar()
 
-app = FastAPI(title="S3 Image Downloader API", version="1.0.0")
+app = FastAPI(title="S3 Image Downloader API", version="1.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -31,6 +73,38 @@ AWS_REGION = os.getenv('AWS_REGION', 'sa-east-1')
 BUCKET_NAME = os.getenv('S3_BUCKET_NAME', 'aplis2')
 IMAGE_PREFIX = 'lab/Arquivos/Foto/'
 LOCAL_IMAGES_DIR = Path(__file__).parent / 'imagens_s3'
+EXTENSOES_IMAGEM = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', 'pdf')
+CHUNK_SIZE = 64 * 1024
+# Modo API: processos uvicorn (--workers) e porta (--port)
+API_WORKERS = int(os.getenv('API_WORKERS', '1'))
+API_PORTA = int(os.getenv('API_PORTA', '8000'))
+# Threads dedicadas às chamadas boto3 (bloqueantes) feitas pelos endpoints
+S3_WORKERS = int(os.getenv('S3_WORKERS', '32'))
+# Máximo de operações S3 em andamento/na fila; acima disso a API responde 503
+S3_MAX_PENDENTES = int(os.getenv('S3_MAX_PENDENTES', str(S3_WORKERS * 4)))
+S3_TIMEOUT_FILA = float(os.getenv('S3_TIMEOUT_FILA', '10'))
+# Download em ZIP: objetos buscados ao mesmo tempo (limita a memória) e máximo de keys por pedido
+ZIP_CONCORRENCIA = int(os.getenv('ZIP_CONCORRENCIA', '8'))
+ZIP_MAX_KEYS = int(os.getenv('ZIP_MAX_KEYS', '2000'))
+# HEADs simultâneos ao resolver um lote de metadados, e máximo de keys por lote
+INFO_CONCORRENCIA = int(os.getenv('INFO_CONCORRENCIA', '16'))
+INFO_MAX_KEYS = int(os.getenv('INFO_MAX_KEYS', '1000'))
+# max-age (segundos) do Cache-Control das imagens; o navegador revalida com If-None-Match
+CACHE_MAX_AGE = int(os.getenv('CACHE_MAX_AGE', '3600'))
+# Maior original (MB) lido inteiro em memória (miniaturas e ZIP); acima disso a API responde 413
+ORIGINAL_MAX_MB = int(os.getenv('ORIGINAL_MAX_MB', '64'))
+
+# Content type baseado na extensão
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.tiff': 'image/tiff',
+    '.webp': 'image/webp',
+    '.pdf': 'application/pdf'
+}
 
 # Modelos Pydantic
 class ImageInfo(BaseModel):
@@ -47,70 +121,590 @@ class DownloadRequest(BaseModel):
 class SearchRequest(BaseModel):
     query: str
     codigo_pasta: Optional[str] = None
+    inicio: bool = False
 
 class ListRequest(BaseModel):
     limit: Optional[int] = None
     offset: int = 0
 
+class PageRequest(BaseModel):
+    limit: int = 50
+    cursor: Optional[str] = None
+
+class ImagePage(BaseModel):
+    items: List[ImageInfo]
+    next: Optional[str] = None
+    ordem: str
+
 class RecentRequest(BaseModel):
     count: int = 10
 
 class ExtensionRequest(BaseModel):
     extension: str
 
+class InfoRequest(BaseModel):
+    keys: List[str]
+    metadata: bool = False
+
+class PregenerateRequest(BaseModel):
+    count: int = 50
+    widths: Optional[List[int]] = None
+    fmt: str = 'webp'
+
+_s3_client = None
+_s3_lock = threading.Lock()
+
 def conectar_s3():
+    """Cliente S3 compartilhado (clientes boto3 são thread-safe depois de criados)"""
+    global _s3_client
+    if _s3_client is not None:
+        return _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            try:
+                _s3_client = boto3.client(
+                    's3',
+                    aws_access_key_id=AWS_ACCESS_KEY,
+                    aws_secret_access_key=AWS_SECRET_KEY,
+                    region_name=AWS_REGION,
+                    # Pool do tamanho das threads que usam o cliente ao mesmo tempo
+                    config=Config(max_pool_connections=S3_WORKERS + LISTAGEM_WORKERS)
+                )
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Falha ao conectar S3: {str(e)}")
+    return _s3_client
+
+# ==================== I/O S3 FORA DO EVENT LOOP ====================
+
+executor_s3 = ThreadPoolExecutor(max_workers=S3_WORKERS, thread_name_prefix='s3-io')
+_pendentes_s3 = asyncio.Semaphore(S3_MAX_PENDENTES)
+
+async def em_executor(func, *args, **kwargs):
+    """Roda uma chamada boto3 no pool dedicado sem bloquear o event loop
+
+    O semáforo limita quantas operações podem estar em andamento ou na fila;
+    se ficar cheio por mais de S3_TIMEOUT_FILA segundos a requisição recebe 503
+    em vez de acumular trabalho indefinidamente.
+    """
     try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS_KEY,
-            aws_secret_access_key=AWS_SECRET_KEY,
-            region_name=AWS_REGION
-        )
-        return s3_client
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Falha ao conectar S3: {str(e)}")
+        await asyncio.wait_for(_pendentes_s3.acquire(), timeout=S3_TIMEOUT_FILA)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Servidor ocupado, tente novamente")
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor_s3, partial(func, *args, **kwargs))
+    finally:
+        _pendentes_s3.release()
 
 def listar_imagens(s3_client, bucket, prefix):
     try:
-        imagens = []
-        extensoes_img = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', 'pdf')
-
-        # Listar com paginação para pegar todos os arquivos
-        paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-
-        for page in pages:
-            if 'Contents' not in page:
-                continue
-
-            for obj in page['Contents']:
-                key = obj['Key']
-                if not key.endswith('/') and key.lower().endswith(extensoes_img):
-                    imagens.append({
-                        'key': key,
-                        'size': obj['Size'],
-                        'last_modified': obj['LastModified'].isoformat(),
-                        'file_name': key.split('/')[-1],
-                        'pasta': '/'.join(key.split('/')[:-1]),
-                        'size_kb': round(obj['Size'] / 1024, 1)
-                    })
-
-        imagens.sort(key=lambda x: x['last_modified'], reverse=True)
-        return imagens
+        # Subpastas paginadas em paralelo; o tempo total fica próximo ao da maior pasta.
+        # Vira uma tabela em colunas: nenhum dicionário por objeto é montado aqui
+        return TabelaImagens.construir(
+            registro_de_objeto(obj)
+            for obj in iterar_objetos_paralelo(s3_client, bucket, prefix)
+            if obj['Key'].lower().endswith(EXTENSOES_IMAGEM)
+        )
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Falha ao listar imagens: {str(e)}")
 
-def baixar_imagem_memoria(s3_client, bucket, key):
-    """Baixa imagem direto para memória e retorna como bytes"""
+def listar_imagens_recentes(s3_client, bucket, prefix, n):
+    """Retorna as N imagens mais recentes mantendo só um heap de N objetos (sem ordenar tudo)"""
     try:
-        buffer = io.BytesIO()
-        s3_client.download_fileobj(bucket, key, buffer)
-        buffer.seek(0)
-        return buffer
+        objetos = (
+            obj for obj in iterar_objetos_paralelo(s3_client, bucket, prefix)
+            if obj['Key'].lower().endswith(EXTENSOES_IMAGEM)
+        )
+        # Mesmo resultado que ordenar a listagem inteira e fatiar [:n]
+        return [objeto_para_imagem(obj) for obj in heapq.nlargest(n, objetos, key=lambda o: (o['LastModified'], o['Key']))]
+
     except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Falha ao listar imagens: {str(e)}")
+
+def abrir_objeto_s3(s3_client, bucket, key, range_header=None, if_none_match=None):
+    """get_object sem ler o corpo; Range e If-None-Match são repassados ao S3 como vieram
+
+    Se o ETag conferir, o S3 responde 304 sem corpo e aqui vira
+    HTTPException(304) com o ETag atual no header.
+    """
+    kwargs = {'Bucket': bucket, 'Key': key}
+    if range_header:
+        kwargs['Range'] = range_header
+    if if_none_match:
+        kwargs['IfNoneMatch'] = if_none_match
+    try:
+        return s3_client.get_object(**kwargs)
+    except ClientError as e:
+        codigo = e.response.get('Error', {}).get('Code')
+        if codigo in ('304', 'NotModified'):
+            etag = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('etag')
+            raise HTTPException(status_code=304, headers={'ETag': etag} if etag else None)
+        if codigo in ('NoSuchKey', '404', 'NotFound'):
+            raise HTTPException(status_code=404, detail=f"Imagem não encontrada: {key}")
+        if codigo == 'InvalidRange':
+            raise HTTPException(status_code=416, detail=f"Range inválido: {range_header}")
         raise HTTPException(status_code=500, detail=f"Falha ao baixar {key}: {str(e)}")
 
+async def iterar_corpo(body, tamanho_bloco=CHUNK_SIZE, guardar_em=None):
+    """Repassa o corpo do get_object em blocos (lidos no pool S3) e fecha a conexão ao terminar
+
+    guardar_em: (key, etag) para gravar o objeto no cache de bytes se a
+    transferência chegar ao fim (o cliente recebe os blocos sem esperar).
+    """
+    loop = asyncio.get_running_loop()
+    blocos = [] if guardar_em else None
+    try:
+        while True:
+            bloco = await loop.run_in_executor(executor_s3, body.read, tamanho_bloco)
+            if not bloco:
+                break
+            if blocos is not None:
+                blocos.append(bloco)
+            yield bloco
+        if blocos is not None:
+            await loop.run_in_executor(executor_s3, cache_bytes.guardar, *guardar_em, b''.join(blocos))
+    finally:
+        body.close()
+
+def cabecalhos_base(file_name, disposicao, etag=None):
+    headers = {
+        'Content-Disposition': f'{disposicao}; filename="{file_name}"',
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f'private, max-age={CACHE_MAX_AGE}'
+    }
+    if etag:
+        headers['ETag'] = f'"{etag}"'
+    return headers
+
+def resposta_bytes(dados, headers, content_type, range_header=None):
+    """Resposta a partir de bytes em cache, recortando o Range se houver"""
+    try:
+        intervalo = intervalo_range(range_header, len(dados))
+    except ValueError:
+        raise HTTPException(status_code=416, detail=f"Range inválido: {range_header}",
+                            headers={'Content-Range': f'bytes */{len(dados)}'})
+    if intervalo is None:
+        return Response(dados, media_type=content_type, headers=headers)
+    inicio, fim = intervalo
+    headers['Content-Range'] = f'bytes {inicio}-{fim}/{len(dados)}'
+    return Response(dados[inicio:fim + 1], status_code=206, media_type=content_type, headers=headers)
+
+async def resposta_objeto_s3(key, disposicao, range_header=None, if_none_match=None, cache_control=None):
+    """Responde com a imagem: 304, cache local ou streaming direto do S3 (206 com Range)
+
+    O ETag vem do catálogo quando disponível, então repetições não fazem GET
+    no S3 (um objeto sobrescrito é percebido na próxima atualização do catálogo).
+    Cache-Control: no-cache na requisição ignora o cache local de bytes; o
+    header X-Cache (HIT/MISS) diz de onde veio a resposta.
+    """
+    file_name = key.split('/')[-1]
+    ext = Path(file_name).suffix.lower()
+    content_type = CONTENT_TYPES.get(ext, 'application/octet-stream')
+
+    img = catalogo.obter(key) if catalogo.pronto else None
+    etag = img.get('etag') if img else None
+
+    if etag:
+        headers = cabecalhos_base(file_name, disposicao, etag)
+        if etag_confere(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        sem_cache = 'no-cache' in (cache_control or '').lower()
+        dados = None if sem_cache else await em_executor(cache_bytes.obter, key, etag)
+        if dados is not None:
+            headers['X-Cache'] = 'HIT'
+            return resposta_bytes(dados, headers, content_type, range_header)
+
+    try:
+        # Sem ETag no catálogo o S3 compara o If-None-Match: 304 não custa um GET com corpo
+        obj = await em_executor(abrir_objeto_s3, conectar_s3(), BUCKET_NAME, key, range_header,
+                                if_none_match)
+    except HTTPException as e:
+        if e.status_code != 304:
+            raise
+        etag_s3 = (e.headers or {}).get('ETag', '').strip('"') or None
+        return Response(status_code=304, headers=cabecalhos_base(file_name, disposicao, etag_s3))
+    etag_s3 = obj.get('ETag', '').strip('"') or None
+    headers = cabecalhos_base(file_name, disposicao, etag_s3)
+
+    if etag_confere(if_none_match, etag_s3):
+        obj['Body'].close()
+        return Response(status_code=304, headers=headers)
+
+    headers['X-Cache'] = 'MISS'
+    headers['Content-Length'] = str(obj['ContentLength'])
+    if obj.get('LastModified'):
+        headers['Last-Modified'] = formatdate(obj['LastModified'].timestamp(), usegmt=True)
+
+    status_code = 200
+    if obj.get('ContentRange'):
+        headers['Content-Range'] = obj['ContentRange']
+        status_code = 206
+
+    # Objeto inteiro e pequeno o bastante: vai para o cache enquanto é enviado
+    guardar_em = None
+    if status_code == 200 and etag_s3 and cache_bytes.cabe(obj['ContentLength']):
+        guardar_em = (key, etag_s3)
+
+    return StreamingResponse(
+        iterar_corpo(obj['Body'], guardar_em=guardar_em),
+        status_code=status_code,
+        media_type=content_type,
+        headers=headers
+    )
+
+class SaidaZip:
+    """Destino não-posicionável do ZipFile: acumula o que foi escrito até ser drenado"""
+
+    def __init__(self):
+        self._partes = []
+        self._posicao = 0
+
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        self._posicao += len(dados)
+        return len(dados)
+
+    def tell(self):
+        return self._posicao
+
+    def flush(self):
+        pass
+
+    def drenar(self):
+        dados = b''.join(self._partes)
+        self._partes.clear()
+        return dados
+
+def nome_no_zip(key):
+    return key[len(IMAGE_PREFIX):] if key.startswith(IMAGE_PREFIX) else key
+
+async def gerar_zip(keys, concorrencia=ZIP_CONCORRENCIA):
+    """Gera o ZIP em blocos: busca até `concorrencia` objetos ao mesmo tempo e
+    escreve cada entrada assim que chega (ordem de chegada, não a do pedido)
+
+    Uma vaga só é liberada depois que a entrada é escrita, então no máximo
+    `concorrencia` objetos ficam em memória. Keys que falharem vão para o
+    manifesto.json no fim do arquivo.
+    """
+    vagas = asyncio.Semaphore(concorrencia)
+    prontos = asyncio.Queue()
+    tarefas = set()
+
+    async def buscar(key):
+        try:
+            dados, _ = await em_executor(ler_original, key, None)
+            await prontos.put((key, dados, None))
+        except HTTPException as e:
+            await prontos.put((key, None, e.detail))
+        except Exception as e:
+            await prontos.put((key, None, str(e)))
+
+    async def produzir():
+        for key in keys:
+            await vagas.acquire()
+            tarefa = asyncio.create_task(buscar(key))
+            tarefas.add(tarefa)
+            tarefa.add_done_callback(tarefas.discard)
+
+    produtor = asyncio.create_task(produzir())
+    saida = SaidaZip()
+    faltando = []
+    try:
+        # Imagens já são comprimidas: ZIP_STORED evita gastar CPU à toa
+        with zipfile.ZipFile(saida, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for _ in range(len(keys)):
+                key, dados, erro = await prontos.get()
+                try:
+                    if erro is not None:
+                        faltando.append({'key': key, 'erro': erro})
+                        continue
+                    img = catalogo.obter(key) if catalogo.pronto else None
+                    data = datetime.fromisoformat(img['last_modified']) if img else datetime.now()
+                    info = zipfile.ZipInfo(nome_no_zip(key), date_time=data.timetuple()[:6])
+                    zf.writestr(info, dados)
+                finally:
+                    vagas.release()
+                yield saida.drenar()
+
+            zf.writestr('manifesto.json', json.dumps({
+                'total': len(keys),
+                'incluidas': len(keys) - len(faltando),
+                'faltando': faltando
+            }, ensure_ascii=False, indent=2))
+        yield saida.drenar()
+    finally:
+        # Cliente desconectou ou terminou: nada continua buscando no S3
+        produtor.cancel()
+        for tarefa in list(tarefas):
+            tarefa.cancel()
+
+async def resposta_miniatura(key, largura, formato, if_none_match=None):
+    """Miniatura da imagem: 304, cache de miniaturas ou gerada agora no pool de processos"""
+    if not miniaturas.disponivel:
+        raise HTTPException(status_code=501, detail="Miniaturas indisponíveis: instale o Pillow")
+    try:
+        largura, formato = normalizar_parametros(largura, formato)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def cabecalhos(etag_origem):
+        headers = {'Cache-Control': f'private, max-age={CACHE_MAX_AGE}'}
+        if etag_origem:
+            headers['ETag'] = f'"{etag_origem}-w{largura}.{formato}"'
+        return headers
+
+    img = catalogo.obter(key) if catalogo.pronto else None
+    etag = img.get('etag') if img else None
+    if etag:
+        headers = cabecalhos(etag)
+        if etag_confere(if_none_match, headers['ETag']):
+            return Response(status_code=304, headers=headers)
+        dados = await em_executor(miniaturas.obter_cache, key, etag, largura, formato)
+        if dados is not None:
+            return Response(dados, media_type=MINIATURA_FORMATOS[formato], headers=headers)
+
+    if img:
+        # Tamanho do catálogo: recusa sem nem abrir o objeto no S3
+        verificar_tamanho_original(key, img.get('size'))
+    original, etag = await em_executor(ler_original, key, etag)
+    headers = cabecalhos(etag)
+    try:
+        # CPU fica no pool de processos; o event loop só espera o resultado
+        dados = await asyncio.get_running_loop().run_in_executor(
+            miniaturas.pool, partial(gerar_miniatura, original, largura, formato)
+        )
+    except BrokenProcessPool:
+        miniaturas.descartar_pool()
+        raise HTTPException(status_code=503, detail="Pool de miniaturas reiniciando, tente novamente")
+    except Exception as e:
+        raise HTTPException(status_code=415, detail=f"Não foi possível gerar miniatura de {key}: {e}")
+    await em_executor(miniaturas.guardar, key, etag, largura, formato, dados)
+    return Response(dados, media_type=MINIATURA_FORMATOS[formato], headers=headers)
+
+def eh_imagem(img):
+    return img['key'].lower().endswith(EXTENSOES_IMAGEM)
+
+# Cache LRU (memória + disco) dos bytes servidos por /stream e /download
+cache_bytes = CacheBytes()
+
+def verificar_tamanho_original(key, tamanho):
+    """413 se o original for grande demais para ser lido inteiro em memória"""
+    if tamanho is not None and tamanho > ORIGINAL_MAX_MB * 1024 * 1024:
+        raise HTTPException(status_code=413,
+                            detail=f"{key} tem {tamanho / 1024 / 1024:.1f}MB (limite {ORIGINAL_MAX_MB}MB)")
+
+def ler_original(key, etag=None):
+    """Bytes do arquivo original (cache de bytes ou get_object) e o ETag lido"""
+    dados = cache_bytes.obter(key, etag) if etag else None
+    if dados is not None:
+        return dados, etag
+    obj = abrir_objeto_s3(conectar_s3(), BUCKET_NAME, key)
+    with obj['Body'] as body:
+        # ContentLength antes de ler: um TIFF/PDF enorme não chega a ocupar a memória
+        verificar_tamanho_original(key, obj.get('ContentLength'))
+        dados = body.read()
+    etag = obj.get('ETag', '').strip('"') or None
+    cache_bytes.guardar(key, etag, dados)
+    return dados, etag
+
+# Resultados de head_object (inclusive "não existe") por alguns minutos
+cache_head = CacheTTL()
+
+def consultar_head(key, usar_cache=True):
+    """head_object com cache; None se a key não existir"""
+    if usar_cache:
+        encontrado, head = cache_head.obter(key)
+        if encontrado:
+            return head
+    try:
+        resposta = conectar_s3().head_object(Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404', 'NotFound'):
+            raise
+        head = None
+    else:
+        head = {
+            'size': resposta['ContentLength'],
+            'last_modified': resposta['LastModified'].isoformat(),
+            'content_type': resposta.get('ContentType', 'unknown'),
+            'etag': resposta.get('ETag', '').strip('"'),
+            'metadata': resposta.get('Metadata', {})
+        }
+    cache_head.guardar(key, head)
+    return head
+
+def montar_info(key, dados):
+    """Resposta de metadados a partir do catálogo ou de um HEAD (consultar_head)"""
+    info = {
+        "key": key,
+        "file_name": key.split('/')[-1],
+        "size": dados['size'],
+        "size_kb": round(dados['size'] / 1024, 1),
+        "size_mb": round(dados['size'] / (1024 * 1024), 2),
+        "last_modified": dados['last_modified'],
+        "content_type": dados.get('content_type') or CONTENT_TYPES.get(Path(key).suffix.lower(), 'unknown'),
+        "etag": dados.get('etag')
+    }
+    if 'metadata' in dados:
+        info['metadata'] = dados['metadata']
+    return info
+
+async def obter_info(key, metadata=False, vagas=None):
+    """Metadados de uma key: catálogo, depois cache de HEAD, depois head_object; None se não existir
+
+    metadata=True pula o catálogo (que não guarda Metadata/ContentType do objeto).
+    """
+    if not metadata and catalogo.pronto:
+        img = catalogo.obter(key)
+        if img:
+            return montar_info(key, img)
+    encontrado, head = cache_head.obter(key)
+    if not encontrado:
+        if vagas:
+            async with vagas:
+                head = await em_executor(consultar_head, key, False)
+        else:
+            head = await em_executor(consultar_head, key, False)
+    return montar_info(key, head) if head else None
+
+# Miniaturas (WebP/JPEG em larguras fixas) geradas em processos separados
+miniaturas = GeradorMiniaturas(ler_original)
+
+# Catálogo em memória (persistido em SQLite): evita listar o bucket inteiro a cada requisição
+armazem = ArmazemCatalogo()
+sincronizador = (
+    SincronizadorCatalogo(conectar_s3, BUCKET_NAME, [IMAGE_PREFIX], armazem)
+    if CATALOGO_MODO == 'incremental' else None
+)
+catalogo = CatalogoImagens(
+    lambda: listar_imagens(conectar_s3(), BUCKET_NAME, IMAGE_PREFIX),
+    armazem=armazem,
+    sincronizador=sincronizador,
+    prefix=IMAGE_PREFIX,
+    filtro=eh_imagem,
+    # Imagens novas já ganham a miniatura da galeria
+    ao_atualizar=miniaturas.pregerar,
+    intervalo_eventos=EVENTOS_INTERVALO_SYNC,
+    # Com vários workers (--workers N) só um lista o S3; os outros seguem o SQLite
+    coordenar=True
+)
+
+def aplicar_eventos_s3(novos, removidos):
+    """Eventos do S3 -> catálogo; o HEAD em cache dessas keys deixa de valer"""
+    for key in [img['key'] for img in novos] + removidos:
+        cache_head.invalidar(key)
+    catalogo.aplicar_eventos(novos, removidos)
+
+# Notificações do S3 (webhook ou arquivo local) atualizam o catálogo em segundos
+ingestor_eventos = IngestorEventos(aplicar_eventos_s3, BUCKET_NAME, [IMAGE_PREFIX], aceitar=eh_imagem)
+leitor_eventos = (LeitorArquivoEventos(EVENTOS_ARQUIVO, ingestor_eventos, ativo=lambda: catalogo.lider)
+                  if EVENTOS_ARQUIVO else None)
+
+# Requisições simultâneas idênticas ao S3 (ex: galeria aberta por vários usuários
+# antes do catálogo ficar pronto) compartilham uma única listagem em andamento
+coalescedor = CoalescedorAsync()
+
+def exigir_lider_sem_catalogo():
+    """Sem catálogo pronto, só o líder lista o S3 direto
+
+    O coalescedor só junta pedidos dentro de um processo: se cada worker
+    seguidor listasse por conta própria, um armazém vazio custaria uma
+    varredura completa por worker. O seguidor responde 503 até carregar o que
+    o líder gravar no SQLite.
+    """
+    if not catalogo.lider:
+        raise HTTPException(status_code=503, detail="Catálogo ainda carregando, tente novamente",
+                            headers={'Retry-After': str(max(1, round(CATALOGO_ESPERA_SEGUIDOR)))})
+
+async def obter_imagens(prefix=IMAGE_PREFIX):
+    """Retorna imagens do catálogo; lista direto no S3 enquanto ele não estiver pronto"""
+    if catalogo.pronto:
+        return catalogo.imagens(prefix if prefix != IMAGE_PREFIX else None)
+    exigir_lider_sem_catalogo()
+    return await coalescedor.executar(('listar', prefix), em_executor,
+                                      listar_imagens, conectar_s3(), BUCKET_NAME, prefix)
+
+async def buscar_por_nome(termo, prefix=IMAGE_PREFIX, inicio=False):
+    """Imagens cujo nome contém `termo` (ou começa com ele): índice de trigramas do
+    catálogo primeiro, prefixo depois; sem catálogo, lista o prefixo no S3"""
+    if catalogo.pronto:
+        imagens = catalogo.imagens()
+    else:
+        imagens = await obter_imagens(prefix)
+    return imagens.filtrar(termo=termo, inicio=inicio, prefix=prefix if prefix != IMAGE_PREFIX else None)[:]
+
+async def obter_recentes(n):
+    """N imagens mais recentes: fatia do catálogo ou top-K direto do S3"""
+    if catalogo.pronto:
+        return catalogo.imagens()[:n]
+    exigir_lider_sem_catalogo()
+    return await coalescedor.executar(('recentes', n), em_executor,
+                                      listar_imagens_recentes, conectar_s3(), BUCKET_NAME, IMAGE_PREFIX, n)
+
+def codificar_cursor(dados):
+    return base64.urlsafe_b64encode(json.dumps(dados, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decodificar_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def listar_pagina_s3(s3_client, bucket, prefix, limite, start_after=None):
+    """Uma página de imagens em ordem de key, direto do S3 (normalmente uma única chamada)"""
+    imagens = []
+    ultima_key = start_after
+    truncado = True
+    while truncado and len(imagens) < limite:
+        kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': min(1000, limite - len(imagens))}
+        if ultima_key:
+            kwargs['StartAfter'] = ultima_key
+        response = s3_client.list_objects_v2(**kwargs)
+        truncado = response.get('IsTruncated', False)
+        for obj in response.get('Contents', []):
+            ultima_key = obj['Key']
+            if not obj['Key'].endswith('/') and obj['Key'].lower().endswith(EXTENSOES_IMAGEM):
+                imagens.append(objeto_para_imagem(obj))
+    # Cursor aponta para a última key examinada (pula também os não-imagem)
+    return imagens, ultima_key if truncado else None
+
+async def obter_pagina(limite, cursor=None):
+    """Página de imagens com cursor opaco: posição no catálogo ou StartAfter no S3"""
+    dados = decodificar_cursor(cursor) if cursor else None
+    modo = dados.get('m') if dados else ('c' if catalogo.pronto else 's')
+
+    if modo == 'c':
+        apos = (dados['lm'], dados['k']) if dados else None
+        itens, tem_mais = catalogo.pagina(limite, apos)
+        proximo = None
+        if tem_mais and itens:
+            proximo = codificar_cursor({'m': 'c', 'lm': itens[-1]['last_modified'], 'k': itens[-1]['key']})
+        return {'items': itens, 'next': proximo, 'ordem': 'recencia'}
+
+    if modo == 's':
+        try:
+            start_after = dados.get('k') if dados else None
+            itens, ultima_key = await coalescedor.executar(
+                ('pagina', limite, start_after), em_executor,
+                listar_pagina_s3, conectar_s3(), BUCKET_NAME, IMAGE_PREFIX, limite, start_after
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Falha ao listar imagens: {str(e)}")
+        proximo = codificar_cursor({'m': 's', 'k': ultima_key}) if ultima_key else None
+        return {'items': itens, 'next': proximo, 'ordem': 'key'}
+
+    raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def cabecalhos_catalogo(response: Response):
+    """Informa prontidão e idade do catálogo nos headers da resposta"""
+    response.headers['X-Catalogo-Pronto'] = 'true' if catalogo.pronto else 'false'
+    idade = catalogo.idade()
+    if idade is not None:
+        response.headers['X-Catalogo-Idade'] = str(idade)
+
 # ==================== ENDPOINTS API ====================
 
 @app.get("/")
@@ -123,22 +717,31 @@ async def root():
         "prefix": IMAGE_PREFIX,
         "endpoints": {
             "GET /images": "Listar todas as imagens",
+            "GET /images/page": "Listar imagens por página (cursor)",
             "GET /images/recent": "Listar imagens mais recentes",
             "GET /images/search": "Buscar imagens por nome",
             "GET /images/extension/{ext}": "Listar por extensão",
+            "GET /images/stats": "Quantidade e volume por pasta, extensão e dia",
+            "GET /images/export?formato=ndjson|csv": "Exportar a listagem em streaming",
             "GET /download/{key:path}": "Baixar imagem específica",
-            "GET /stream/{key:path}": "Stream de imagem"
+            "GET /stream/{key:path}": "Stream de imagem",
+            "GET /thumb/{key:path}?w=320&fmt=webp": "Miniatura da imagem",
+            "POST /api/download-zip": "Baixar várias imagens em um ZIP",
+            "POST /api/info-batch": "Metadados de várias imagens em uma chamada",
+            "POST /api/s3-events": "Receber notificações de eventos do S3 (webhook, exige EVENTOS_TOKEN)",
+            "GET /catalog/status": "Prontidão e idade do catálogo em memória"
         }
     }
 
 @app.get("/images", response_model=List[ImageInfo])
 async def listar_todas_imagens(
+    response: Response,
     limit: Optional[int] = Query(None, description="Limitar número de resultados"),
     offset: int = Query(0, description="Offset para paginação")
 ):
     """Lista todas as imagens do S3"""
-    s3 = conectar_s3()
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
+    cabecalhos_catalogo(response)
+    imagens = await obter_imagens()
 
     if not imagens:
         return []
@@ -148,26 +751,34 @@ async def listar_todas_imagens(
         return imagens[offset:offset + limit]
     return imagens[offset:]
 
+@app.get("/images/page", response_model=ImagePage)
+async def listar_pagina(
+    response: Response,
+    limit: int = Query(50, description="Itens por página", ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="Cursor 'next' da página anterior")
+):
+    """Lista imagens por página com cursor (custa no máximo uma listagem do S3 por página)"""
+    cabecalhos_catalogo(response)
+    return await obter_pagina(limit, cursor)
+
 @app.get("/images/recent", response_model=List[ImageInfo])
 async def listar_recentes(
+    response: Response,
     count: int = Query(10, description="Quantidade de imagens recentes", ge=1, le=100)
 ):
     """Lista as N imagens mais recentes"""
-    s3 = conectar_s3()
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
-
-    if not imagens:
-        return []
-
-    return imagens[:count]
+    cabecalhos_catalogo(response)
+    return await obter_recentes(count)
 
 @app.get("/images/search", response_model=List[ImageInfo])
 async def buscar_imagens(
+    response: Response,
     q: str = Query(..., description="Termo de busca no nome do arquivo"),
-    codigo_pasta: Optional[str] = Query(None, description="Código da pasta para busca rápida")
+    codigo_pasta: Optional[str] = Query(None, description="Código da pasta para busca rápida"),
+    inicio: bool = Query(False, description="Só nomes que começam com o termo")
 ):
     """Busca imagens por nome"""
-    s3 = conectar_s3()
+    cabecalhos_catalogo(response)
 
     # Determinar prefixo de busca
     if codigo_pasta:
@@ -175,21 +786,58 @@ async def buscar_imagens(
     else:
         prefix_busca = IMAGE_PREFIX
 
-    imagens = listar_imagens(s3, BUCKET_NAME, prefix_busca)
-
-    # Filtrar por termo de busca
-    imagens_encontradas = [
-        img for img in imagens
-        if q.lower() in img['file_name'].lower()
-    ]
+    return await buscar_por_nome(q, prefix_busca, inicio)
 
-    return imagens_encontradas
+@app.get("/images/export")
+async def exportar_imagens(
+    formato: str = Query('ndjson', description="ndjson ou csv"),
+    q: Optional[str] = Query(None, description="Termo de busca no nome do arquivo"),
+    codigo_pasta: Optional[str] = Query(None, description="Restringe a uma pasta"),
+    extension: Optional[str] = Query(None, description="Restringe a uma extensão"),
+    gzip: Optional[bool] = Query(None, description="Comprimir (padrão: conforme Accept-Encoding)"),
+    accept_encoding: Optional[str] = Header(None)
+):
+    """Exporta a listagem em streaming (NDJSON ou CSV), linha a linha, sem montar a resposta inteira"""
+    if formato not in FORMATOS_EXPORTACAO:
+        raise HTTPException(status_code=400, detail=f"Formato não suportado: {formato}")
+
+    imagens = await obter_imagens()
+    extensoes = None
+    if extension:
+        ext = extension.lower() if extension.startswith('.') else f'.{extension.lower()}'
+        extensoes = ('.jpg', '.jpeg') if ext == '.jpeg' else (ext,)
+    imagens = imagens.filtrar(
+        termo=q,
+        pasta=f"{IMAGE_PREFIX}{codigo_pasta}" if codigo_pasta else None,
+        extensoes=extensoes
+    )
+
+    comprimir = aceita_gzip(accept_encoding) if gzip is None else gzip
+    # Gerador síncrono: o Starlette consome em thread, fora do event loop
+    blocos, headers = exportar(iter(imagens), formato, comprimir)
+    nome = f"imagens_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{'csv' if formato == 'csv' else 'ndjson'}"
+    headers['Content-Disposition'] = f'attachment; filename="{nome}"'
+    headers['X-Total-Count'] = str(len(imagens))
+    return StreamingResponse(blocos, media_type=headers.pop('Content-Type'), headers=headers)
+
+@app.get("/images/stats")
+async def estatisticas_imagens(
+    response: Response,
+    limit: int = Query(50, description="Máximo de pastas e de dias listados", ge=1, le=10000),
+    codigo_pasta: Optional[str] = Query(None, description="Restringe a uma pasta")
+):
+    """Quantidade e volume por pasta, extensão e dia (agregados pré-calculados do catálogo)"""
+    cabecalhos_catalogo(response)
+    imagens = await obter_imagens()
+    if codigo_pasta:
+        imagens = imagens.filtrar(pasta=f"{IMAGE_PREFIX}{codigo_pasta}")
+    return imagens.agregados(limit)
 
 @app.get("/images/extension/{extension}", response_model=List[ImageInfo])
-async def listar_por_extensao(extension: str):
+async def listar_por_extensao(extension: str, response: Response):
     """Lista imagens por extensão (jpg, png, gif, bmp, tiff, webp, pdf)"""
-    s3 = conectar_s3()
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
+    cabecalhos_catalogo(response)
+    imagens = await obter_imagens()
 
     # Normalizar extensão
     ext = extension.lower()
@@ -197,105 +845,68 @@ async def listar_por_extensao(extension: str):
         ext = f'.{ext}'
 
     # Tratar JPEG como JPG também
-    if ext == '.jpeg':
-        imagens_filtradas = [
-            img for img in imagens
-            if img['file_name'].lower().endswith(('.jpg', '.jpeg'))
-        ]
-    else:
-        imagens_filtradas = [
-            img for img in imagens
-            if img['file_name'].lower().endswith(ext)
-        ]
-
-    return imagens_filtradas
+    extensoes = ('.jpg', '.jpeg') if ext == '.jpeg' else (ext,)
+    return imagens.filtrar(extensoes=extensoes)[:]
 
 @app.get("/download/{key:path}")
-async def download_imagem(key: str):
-    """Baixa uma imagem específica pelo key"""
-    s3 = conectar_s3()
-
-    try:
-        buffer = baixar_imagem_memoria(s3, BUCKET_NAME, key)
-        file_name = key.split('/')[-1]
-
-        # Determinar content type baseado na extensão
-        content_types = {
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.gif': 'image/gif',
-            '.bmp': 'image/bmp',
-            '.webp': 'image/webp',
-            '.pdf': 'application/pdf'
-        }
-
-        ext = Path(file_name).suffix.lower()
-        content_type = content_types.get(ext, 'application/octet-stream')
-
-        return StreamingResponse(
-            buffer,
-            media_type=content_type,
-            headers={
-                'Content-Disposition': f'attachment; filename="{file_name}"'
-            }
-        )
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=f"Imagem não encontrada: {str(e)}")
+async def download_imagem(
+    key: str,
+    range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None)
+):
+    """Baixa uma imagem específica pelo key (aceita Range, If-None-Match e Cache-Control: no-cache)"""
+    return await resposta_objeto_s3(key, 'attachment', range, if_none_match, cache_control)
 
 @app.get("/stream/{key:path}")
-async def stream_imagem(key: str):
-    """Retorna stream da imagem para visualização inline"""
-    s3 = conectar_s3()
-
+async def stream_imagem(
+    key: str,
+    range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None)
+):
+    """Retorna stream da imagem para visualização inline (aceita Range, If-None-Match e Cache-Control: no-cache)"""
+    return await resposta_objeto_s3(key, 'inline', range, if_none_match, cache_control)
+
+@app.get("/thumb/status")
+async def status_miniaturas():
+    """Fila, contadores e cache do gerador de miniaturas"""
+    return miniaturas.status()
+
+@app.get("/thumb/{key:path}")
+async def miniatura_imagem(
+    key: str,
+    w: int = Query(320, ge=16, le=4096, description="Largura (ajustada para a fixa mais próxima acima)"),
+    fmt: str = Query('webp', description="webp, jpeg ou png"),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Miniatura redimensionada e convertida, para galerias (cache por ETag da origem)"""
+    return await resposta_miniatura(key, w, fmt, if_none_match)
+
+@app.post("/thumb/pregenerate")
+async def pregerar_miniaturas(request: PregenerateRequest):
+    """Enfileira a geração das miniaturas das N imagens mais recentes"""
+    if not miniaturas.disponivel:
+        raise HTTPException(status_code=501, detail="Miniaturas indisponíveis: instale o Pillow")
     try:
-        buffer = baixar_imagem_memoria(s3, BUCKET_NAME, key)
-        file_name = key.split('/')[-1]
-
-        # Determinar content type
-        content_types = {
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.gif': 'image/gif',
-            '.bmp': 'image/bmp',
-            '.webp': 'image/webp',
-            '.pdf': 'application/pdf'
-        }
-
-        ext = Path(file_name).suffix.lower()
-        content_type = content_types.get(ext, 'application/octet-stream')
-
-        return StreamingResponse(
-            buffer,
-            media_type=content_type,
-            headers={
-                'Content-Disposition': f'inline; filename="{file_name}"'
-            }
-        )
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=f"Imagem não encontrada: {str(e)}")
+        larguras = [normalizar_parametros(w, request.fmt) for w in (request.widths or [320])]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    imagens = await obter_recentes(request.count)
+    return {'enfileiradas': miniaturas.pregerar(imagens, larguras), 'status': miniaturas.status()}
 
 @app.get("/info/{key:path}")
 async def info_imagem(key: str):
     """Retorna informações detalhadas sobre uma imagem"""
-    s3 = conectar_s3()
-
     try:
-        response = s3.head_object(Bucket=BUCKET_NAME, Key=key)
-
-        return {
-            "key": key,
-            "file_name": key.split('/')[-1],
-            "size": response['ContentLength'],
-            "size_kb": round(response['ContentLength'] / 1024, 1),
-            "size_mb": round(response['ContentLength'] / (1024 * 1024), 2),
-            "last_modified": response['LastModified'].isoformat(),
-            "content_type": response.get('ContentType', 'unknown'),
-            "metadata": response.get('Metadata', {})
-        }
+        info = await obter_info(key, metadata=True)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Imagem não encontrada: {str(e)}")
+    if info is None:
+        raise HTTPException(status_code=404, detail=f"Imagem não encontrada: {key}")
+    return info
 
 @app.get("/health")
 async def health_check():
@@ -303,7 +914,7 @@ async def health_check():
     try:
         s3 = conectar_s3()
         # Tenta listar apenas 1 objeto para verificar conectividade
-        s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=IMAGE_PREFIX, MaxKeys=1)
+        await em_executor(s3.list_objects_v2, Bucket=BUCKET_NAME, Prefix=IMAGE_PREFIX, MaxKeys=1)
         return {
             "status": "healthy",
             "s3_connection": "ok",
@@ -318,13 +929,28 @@ async def health_check():
             "timestamp": datetime.now().isoformat()
         }
 
+@app.get("/catalog/status")
+async def status_catalogo():
+    """Prontidão, idade e tamanho do catálogo em memória"""
+    return {
+        **catalogo.status(),
+        'cache_bytes': cache_bytes.estatisticas(),
+        'cache_head': cache_head.estatisticas(),
+        'coalescencia': coalescedor.status(),
+        'eventos': {
+            **ingestor_eventos.status(),
+            'arquivo': EVENTOS_ARQUIVO,
+            'linhas_invalidas': leitor_eventos.linhas_invalidas if leitor_eventos else None
+        }
+    }
+
 # ==================== ENDPOINTS POST (para uso via terminal/JSON) ====================
 
 @app.post("/api/list", response_model=List[ImageInfo])
-async def listar_imagens_post(request: ListRequest):
+async def listar_imagens_post(request: ListRequest, response: Response):
     """Lista imagens via POST (aceita JSON no body)"""
-    s3 = conectar_s3()
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
+    cabecalhos_catalogo(response)
+    imagens = await obter_imagens()
 
     if not imagens:
         return []
@@ -333,21 +959,24 @@ async def listar_imagens_post(request: ListRequest):
         return imagens[request.offset:request.offset + request.limit]
     return imagens[request.offset:]
 
+@app.post("/api/page", response_model=ImagePage)
+async def listar_pagina_post(request: PageRequest, response: Response):
+    """Lista imagens por página com cursor via POST"""
+    if not 1 <= request.limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit deve estar entre 1 e 1000")
+    cabecalhos_catalogo(response)
+    return await obter_pagina(request.limit, request.cursor)
+
 @app.post("/api/recent", response_model=List[ImageInfo])
-async def listar_recentes_post(request: RecentRequest):
+async def listar_recentes_post(request: RecentRequest, response: Response):
     """Lista imagens recentes via POST"""
-    s3 = conectar_s3()
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
-
-    if not imagens:
-        return []
-
-    return imagens[:request.count]
+    cabecalhos_catalogo(response)
+    return await obter_recentes(request.count)
 
 @app.post("/api/search", response_model=List[ImageInfo])
-async def buscar_imagens_post(request: SearchRequest):
+async def buscar_imagens_post(request: SearchRequest, response: Response):
     """Busca imagens via POST (aceita JSON no body)"""
-    s3 = conectar_s3()
+    cabecalhos_catalogo(response)
 
     # Determinar prefixo de busca
     if request.codigo_pasta:
@@ -355,21 +984,13 @@ async def buscar_imagens_post(request: SearchRequest):
     else:
         prefix_busca = IMAGE_PREFIX
 
-    imagens = listar_imagens(s3, BUCKET_NAME, prefix_busca)
-
-    # Filtrar por termo de busca
-    imagens_encontradas = [
-        img for img in imagens
-        if request.query.lower() in img['file_name'].lower()
-    ]
-
-    return imagens_encontradas
+    return await buscar_por_nome(request.query, prefix_busca, request.inicio)
 
 @app.post("/api/extension", response_model=List[ImageInfo])
-async def listar_por_extensao_post(request: ExtensionRequest):
+async def listar_por_extensao_post(request: ExtensionRequest, response: Response):
     """Lista por extensão via POST"""
-    s3 = conectar_s3()
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
+    cabecalhos_catalogo(response)
+    imagens = await obter_imagens()
 
     # Normalizar extensão
     ext = request.extension.lower()
@@ -377,18 +998,25 @@ async def listar_por_extensao_post(request: ExtensionRequest):
         ext = f'.{ext}'
 
     # Tratar JPEG como JPG também
-    if ext == '.jpeg':
-        imagens_filtradas = [
-            img for img in imagens
-            if img['file_name'].lower().endswith(('.jpg', '.jpeg'))
-        ]
-    else:
-        imagens_filtradas = [
-            img for img in imagens
-            if img['file_name'].lower().endswith(ext)
-        ]
-
-    return imagens_filtradas
+    extensoes = ('.jpg', '.jpeg') if ext == '.jpeg' else (ext,)
+    return imagens.filtrar(extensoes=extensoes)[:]
+
+@app.post("/api/download-zip")
+async def download_zip_post(request: DownloadRequest):
+    """Baixa várias imagens em um único ZIP gerado em streaming (com manifesto das que faltarem)"""
+    # Remove repetidas mantendo a ordem
+    keys = list(dict.fromkeys(k for k in request.keys if k))
+    if not keys:
+        raise HTTPException(status_code=400, detail="Campo 'keys' é obrigatório")
+    if len(keys) > ZIP_MAX_KEYS:
+        raise HTTPException(status_code=400, detail=f"Máximo de {ZIP_MAX_KEYS} keys por ZIP")
+
+    nome = f"imagens_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return StreamingResponse(
+        gerar_zip(keys),
+        media_type='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{nome}"'}
+    )
 
 @app.post("/api/download-info")
 async def download_info_post(request: dict):
@@ -397,24 +1025,92 @@ async def download_info_post(request: dict):
     if not key:
         raise HTTPException(status_code=400, detail="Campo 'key' é obrigatório")
 
-    s3 = conectar_s3()
-
     try:
-        response = s3.head_object(Bucket=BUCKET_NAME, Key=key)
-
-        return {
-            "key": key,
-            "file_name": key.split('/')[-1],
-            "size": response['ContentLength'],
-            "size_kb": round(response['ContentLength'] / 1024, 1),
-            "size_mb": round(response['ContentLength'] / (1024 * 1024), 2),
-            "last_modified": response['LastModified'].isoformat(),
-            "content_type": response.get('ContentType', 'unknown'),
-            "download_url": f"/download/{key}",
-            "stream_url": f"/stream/{key}"
-        }
+        info = await obter_info(key)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"Imagem não encontrada: {str(e)}")
+    if info is None:
+        raise HTTPException(status_code=404, detail=f"Imagem não encontrada: {key}")
+    return {
+        **info,
+        "download_url": f"/download/{key}",
+        "stream_url": f"/stream/{key}"
+    }
+
+@app.post("/api/info-batch")
+async def info_lote_post(request: InfoRequest):
+    """Metadados de várias keys numa chamada (catálogo/cache; faltas resolvidas em paralelo)"""
+    keys = list(dict.fromkeys(k for k in request.keys if k))
+    if not keys:
+        raise HTTPException(status_code=400, detail="Campo 'keys' é obrigatório")
+    if len(keys) > INFO_MAX_KEYS:
+        raise HTTPException(status_code=400, detail=f"Máximo de {INFO_MAX_KEYS} keys por lote")
+
+    vagas = asyncio.Semaphore(INFO_CONCORRENCIA)
+    resultados = await asyncio.gather(
+        *(obter_info(key, request.metadata, vagas) for key in keys),
+        return_exceptions=True
+    )
+
+    itens, faltando, erros = {}, [], {}
+    for key, resultado in zip(keys, resultados):
+        if isinstance(resultado, HTTPException):
+            erros[key] = resultado.detail
+        elif isinstance(resultado, Exception):
+            erros[key] = str(resultado)
+        elif resultado is None:
+            faltando.append(key)
+        else:
+            itens[key] = resultado
+    return {"itens": itens, "faltando": faltando, "erros": erros}
+
+def confirmar_assinatura_sns(url):
+    """Visita a SubscribeURL enviada pelo SNS (só endereços da AWS)"""
+    destino = urlparse(url or '')
+    if destino.scheme != 'https' or not destino.hostname or not destino.hostname.endswith('.amazonaws.com'):
+        raise ValueError(f"SubscribeURL inválida: {url}")
+    with urlopen(url, timeout=10) as resposta:
+        resposta.read()
+
+@app.post("/api/s3-events")
+async def receber_eventos_s3(
+    request: Request,
+    token: Optional[str] = Query(None),
+    x_eventos_token: Optional[str] = Header(None)
+):
+    """Recebe notificações do S3 (diretas, SNS, SQS ou EventBridge) e atualiza o catálogo
+
+    Exige EVENTOS_TOKEN configurado no servidor e enviado no header
+    X-Eventos-Token ou em ?token=. Os eventos entram numa fila e são aplicados
+    em lote após EVENTOS_JANELA segundos; a resposta traz quantos foram enfileirados.
+    """
+    if not EVENTOS_TOKEN:
+        raise HTTPException(status_code=403, detail="Webhook de eventos desativado: configure EVENTOS_TOKEN")
+    if not any(secrets.compare_digest(EVENTOS_TOKEN, valor) for valor in (token, x_eventos_token) if valor):
+        raise HTTPException(status_code=401, detail="Token de eventos inválido")
+
+    # SNS envia JSON com Content-Type text/plain: lê o corpo cru
+    try:
+        payload = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Corpo deve ser JSON")
+
+    if eh_confirmacao_sns(payload):
+        try:
+            await em_executor(confirmar_assinatura_sns, payload.get('SubscribeURL'))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=f"Falha ao confirmar assinatura SNS: {str(e)}")
+        return {"confirmado": True}
+
+    try:
+        enfileirados = await em_executor(ingestor_eventos.processar, payload)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Evento inválido: {str(e)}")
+    return {"enfileirados": enfileirados, "status": ingestor_eventos.status()}
 
 # ==================== MODO CLI (TERMINAL INTERATIVO) ====================
 
@@ -452,20 +1148,20 @@ def listar_todas_cli():
     print("\n[INFO] Conectando ao S3...")
     s3 = conectar_s3()
 
-    print(f"[INFO] Listando imagens em {BUCKET_NAME}/{IMAGE_PREFIX}...")
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
+    print(f"[INFO] Listando imagens em {BUCKET_NAME}/{IMAGE_PREFIX}...\n")
 
-    if not imagens:
-        print("[AVISO] Nenhuma imagem encontrada")
-        return
-
-    print(f"\n[INFO] {len(imagens)} imagens encontradas:\n")
-
-    for i, img in enumerate(imagens[:50], 1):  # Limita a 50 para não poluir terminal
-        print(f"{i:3}. {img['file_name']:<50} {img['size_kb']:>8.1f}KB  {img['last_modified'][:19]}")
+    # Listagem preguiçosa: imprime já a partir da primeira página e para na 51ª imagem
+    total = 0
+    for obj in iterar_objetos(s3, BUCKET_NAME, IMAGE_PREFIX, por_extensao(EXTENSOES_IMAGEM), limite=51):
+        total += 1
+        if total > 50:  # Limita a 50 para não poluir terminal
+            print("\n... e mais imagens (use a API para listar todas)")
+            break
+        img = objeto_para_imagem(obj)
+        print(f"{total:3}. {img['file_name']:<50} {img['size_kb']:>8.1f}KB  {img['last_modified'][:19]}")
 
-    if len(imagens) > 50:
-        print(f"\n... e mais {len(imagens) - 50} imagens")
+    if not total:
+        print("[AVISO] Nenhuma imagem encontrada")
 
 def buscar_por_nome_cli():
     """Busca imagens por nome no terminal"""
@@ -483,17 +1179,26 @@ def buscar_por_nome_cli():
 
     if codigo_pasta:
         prefix_busca = f"{IMAGE_PREFIX}{codigo_pasta}/"
-        print(f"[INFO] Busca rápida em {prefix_busca}...")
     else:
         prefix_busca = IMAGE_PREFIX
-        print(f"[INFO] Buscando em todas as pastas (pode demorar)...")
 
-    imagens = listar_imagens(s3, BUCKET_NAME, prefix_busca)
+    # Catálogo em disco recente: busca indexada, sem listar o S3
+    idade = armazem.idade()
+    if idade is not None and idade <= CATALOGO_IDADE_MAXIMA:
+        print(f"[INFO] Buscando no catálogo local (atualizado há {idade / 60:.0f} min)...")
+        imagens_encontradas = [img for img in armazem.buscar(nome_busca, prefix_busca) if eh_imagem(img)]
+    else:
+        if codigo_pasta:
+            print(f"[INFO] Busca rápida em {prefix_busca}...")
+        else:
+            print(f"[INFO] Buscando em todas as pastas (pode demorar)...")
 
-    imagens_encontradas = [
-        img for img in imagens
-        if nome_busca.lower() in img['file_name'].lower()
-    ]
+        # Filtra enquanto lista: só os resultados ficam em memória
+        imagens_encontradas = [
+            objeto_para_imagem(obj)
+            for obj in iterar_objetos(s3, BUCKET_NAME, prefix_busca,
+                                      por_extensao(EXTENSOES_IMAGEM), por_nome(nome_busca))
+        ]
 
     if not imagens_encontradas:
         print(f"[AVISO] Nenhuma imagem encontrada com '{nome_busca}'")
@@ -558,29 +1263,23 @@ def listar_por_extensao_cli():
     print("\n[INFO] Conectando ao S3...")
     s3 = conectar_s3()
 
-    print(f"[INFO] Listando imagens...")
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
+    print(f"[INFO] Listando imagens...\n")
 
+    filtros = [por_extensao(EXTENSOES_IMAGEM)]
     if ext_map[opcao]:
-        extensoes = ext_map[opcao]
-        imagens_filtradas = [
-            img for img in imagens
-            if img['file_name'].lower().endswith(extensoes)
-        ]
-    else:
-        imagens_filtradas = imagens
+        filtros.append(por_extensao(ext_map[opcao]))
 
-    if not imagens_filtradas:
-        print("[AVISO] Nenhuma imagem encontrada")
-        return
-
-    print(f"\n[INFO] {len(imagens_filtradas)} imagens encontradas:\n")
-
-    for i, img in enumerate(imagens_filtradas[:50], 1):
-        print(f"{i:3}. {img['file_name']:<50} {img['size_kb']:>8.1f}KB")
+    total = 0
+    for obj in iterar_objetos(s3, BUCKET_NAME, IMAGE_PREFIX, *filtros, limite=51):
+        total += 1
+        if total > 50:
+            print("\n... e mais imagens (use a API para listar todas)")
+            break
+        img = objeto_para_imagem(obj)
+        print(f"{total:3}. {img['file_name']:<50} {img['size_kb']:>8.1f}KB")
 
-    if len(imagens_filtradas) > 50:
-        print(f"\n... e mais {len(imagens_filtradas) - 50} imagens")
+    if not total:
+        print("[AVISO] Nenhuma imagem encontrada")
 
 def baixar_ultimas_n_cli():
     """Baixa as últimas N imagens"""
@@ -598,13 +1297,12 @@ def baixar_ultimas_n_cli():
     s3 = conectar_s3()
 
     print(f"[INFO] Buscando últimas {n} imagens...")
-    imagens = listar_imagens(s3, BUCKET_NAME, IMAGE_PREFIX)
+    imagens_selecionadas = listar_imagens_recentes(s3, BUCKET_NAME, IMAGE_PREFIX, n)
 
-    if not imagens:
+    if not imagens_selecionadas:
         print("[AVISO] Nenhuma imagem encontrada")
         return
 
-    imagens_selecionadas = imagens[:n]
     print(f"\n[INFO] {len(imagens_selecionadas)} imagens serão baixadas")
 
     confirma = input("Deseja continuar? (s/n): ").strip().lower()
@@ -646,15 +1344,34 @@ if __name__ == '__main__':
         if sys.argv[1] == '--api':
             # Modo API
             import uvicorn
+
+            def opcao_inteira(nome, padrao):
+                if nome in sys.argv:
+                    try:
+                        return int(sys.argv[sys.argv.index(nome) + 1])
+                    except (IndexError, ValueError):
+                        print(f"[ERRO] {nome} precisa de um número")
+                        sys.exit(1)
+                return padrao
+
+            workers = opcao_inteira('--workers', API_WORKERS)
+            porta = opcao_inteira('--port', API_PORTA)
             print("\n[MODO API] Iniciando servidor FastAPI...")
-            print("API disponível em: http://localhost:8000")
-            print("Documentação em: http://localhost:8000/docs")
+            print(f"API disponível em: http://localhost:{porta}")
+            print(f"Documentação em: http://localhost:{porta}/docs")
+            print(f"Workers: {workers} (catálogo compartilhado em {armazem.caminho})")
             print("="*60)
-            uvicorn.run(app, host="0.0.0.0", port=8000)
+            if workers > 1:
+                # Vários processos exigem o app como string de import; cada worker
+                # importa o módulo, e o líder do catálogo é escolhido pelo SQLite
+                uvicorn.run("s3_images_downloader:app", host="0.0.0.0", port=porta, workers=workers,
+                            app_dir=str(Path(__file__).parent))
+            else:
+                uvicorn.run(app, host="0.0.0.0", port=porta)
         else:
             print("\nUso:")
-            print("  python s3_images_downloader.py       # Modo CLI interativo")
-            print("  python s3_images_downloader.py --api # Modo API REST")
+            print("  python s3_images_downloader.py                                # Modo CLI interativo")
+            print("  python s3_images_downloader.py --api [--workers N] [--port P] # Modo API REST")
     else:
         # Modo CLI por padrão
         print("\n[MODO CLI] Modo interativo de terminal")
@@ -4,6 +4,7 @@ import os
 from datetime import datetime
 from pathlib import Path
 import time
+from coalescencia import Coalescedor
 
 app = Flask(__name__)
 
@@ -69,6 +70,13 @@ def listar_arquivos_s3(s3_client, bucket_name, prefix):
         print(f"❌ Erro ao listar arquivos S3: {e}")
         return []
 
+# Chamadas simultâneas (várias abas em /backups) dividem a mesma listagem
+coalescedor = Coalescedor()
+
+def listar_backups_s3(s3_client):
+    """Lista a pasta de backups, compartilhando a chamada com requisições simultâneas"""
+    return coalescedor.executar(BUCKET_PREFIX, listar_arquivos_s3, s3_client, BUCKET_NAME, BUCKET_PREFIX)
+
 @app.route('/')
 def home():
     """Página inicial com interface HTML"""
@@ -99,7 +107,8 @@ def status():
             'status': 'online',
             'message': 'Serviço S3 funcionando',
             'bucket': BUCKET_NAME,
-            'region': AWS_REGION
+            'region': AWS_REGION,
+            'coalescencia': coalescedor.status()
         })
     else:
         return jsonify({
@@ -117,7 +126,7 @@ def listar_backups():
         if not s3_client:
             return jsonify({'error': 'Não foi possível conectar ao S3'}), 500
 
-        arquivos = listar_arquivos_s3(s3_client, BUCKET_NAME, BUCKET_PREFIX)
+        arquivos = listar_backups_s3(s3_client)
 
         # Filtrar apenas arquivos .7z
         backups = [arq for arq in arquivos if arq['FileName'].endswith('.7z')]
@@ -146,7 +155,7 @@ def backup_mais_recente():
         if not s3_client:
             return jsonify({'error': 'Não foi possível conectar ao S3'}), 500
 
-        arquivos = listar_arquivos_s3(s3_client, BUCKET_NAME, BUCKET_PREFIX)
+        arquivos = listar_backups_s3(s3_client)
 
         # Filtrar arquivos que começam com 'lab_' e terminam com '.7z'
         backups = [
@@ -245,7 +254,7 @@ def baixar_backup_mais_recente():
         if not s3_client:
             return jsonify({'error': 'Não foi possível conectar ao S3'}), 500
 
-        arquivos = listar_arquivos_s3(s3_client, BUCKET_NAME, BUCKET_PREFIX)
+        arquivos = listar_backups_s3(s3_client)
 
         backups = [
             arq for arq in arquivos
@@ -0,0 +1,672 @@
+import heapq
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from datetime import datetime, timezone, timedelta
+
+_EPOCA = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICRO = timedelta(microseconds=1)
+
+# Deltas pequenos (eventos, sincronizações curtas) ficam por cima da tabela sem
+# copiar as colunas; acima deste total de linhas novas + ocultas, mesclar reconstrói
+SOBREPOSICAO_MAX = int(os.getenv('TABELA_SOBREPOSICAO_MAX', '5000'))
+
+
+def para_micros(valor):
+    """datetime ou string ISO -> microssegundos desde a época (UTC se vier sem fuso)"""
+    if isinstance(valor, str):
+        valor = datetime.fromisoformat(valor)
+    if valor.tzinfo is None:
+        valor = valor.replace(tzinfo=timezone.utc)
+    return (valor - _EPOCA) // _MICRO
+
+
+def de_micros(micros):
+    return (_EPOCA + timedelta(microseconds=micros)).isoformat()
+
+
+# Registro: (last_modified em µs, key, size, etag) — a forma mínima de uma linha
+
+def registro_de_objeto(obj):
+    """Registro a partir de um objeto do list_objects_v2 (sem montar dicionário)"""
+    return para_micros(obj['LastModified']), obj['Key'], obj['Size'], obj.get('ETag', '').strip('"')
+
+
+def registro_de_imagem(img):
+    """Registro a partir do dicionário usado pela API"""
+    return para_micros(img['last_modified']), img['key'], img['size'], img.get('etag') or ''
+
+
+def _ordem(registro):
+    return registro[0], registro[1]
+
+
+_MICROS_DIA = 86_400_000_000
+
+
+def extensao_de(key):
+    """Extensão em minúsculas com o ponto ('.jpg'), ou '' se o nome não tiver"""
+    nome = key[key.rfind('/') + 1:]
+    ponto = nome.rfind('.')
+    return nome[ponto:].lower() if ponto >= 0 else ''
+
+
+class AgregadosImagens:
+    """Contagem e bytes por pasta, por extensão e por dia (UTC) de uma tabela
+
+    Calculados junto com a tabela e, em mesclar, atualizados só com o delta
+    (subtrai as linhas que saíram, soma as que entraram).
+    """
+
+    __slots__ = ('total', 'por_pasta', 'por_extensao', 'por_dia')
+
+    def __init__(self):
+        self.total = [0, 0]
+        self.por_pasta = {}
+        self.por_extensao = {}
+        self.por_dia = {}      # dia (inteiro desde a época) -> [quantidade, bytes]
+
+    def copia(self):
+        nova = AgregadosImagens()
+        nova.total = list(self.total)
+        for origem, destino in ((self.por_pasta, nova.por_pasta), (self.por_extensao, nova.por_extensao),
+                                (self.por_dia, nova.por_dia)):
+            destino.update((chave, list(valor)) for chave, valor in origem.items())
+        return nova
+
+    def somar(self, micros, key, tamanho, sinal=1):
+        pasta = key[:key.rfind('/')] if '/' in key else ''
+        self.total[0] += sinal
+        self.total[1] += sinal * tamanho
+        for grupo, chave in ((self.por_pasta, pasta), (self.por_extensao, extensao_de(key)),
+                             (self.por_dia, micros // _MICROS_DIA)):
+            valor = grupo.get(chave)
+            if valor is None:
+                valor = grupo[chave] = [0, 0]
+            valor[0] += sinal
+            valor[1] += sinal * tamanho
+            if valor[0] == 0:
+                del grupo[chave]
+
+    @staticmethod
+    def _lista(grupo, limite=None, ordenar_por_chave=False):
+        if ordenar_por_chave:
+            itens = sorted(grupo.items(), reverse=True)
+        else:
+            itens = sorted(grupo.items(), key=lambda item: (-item[1][0], item[0]))
+        if limite:
+            itens = itens[:limite]
+        return itens
+
+    def resumo(self, limite=None):
+        """Dicionário para a API: totais e grupos (pastas/extensões por quantidade, dias do mais recente)"""
+        def item(chave, valor):
+            return {'chave': chave, 'quantidade': valor[0], 'bytes': valor[1],
+                    'mb': round(valor[1] / (1024 * 1024), 2)}
+
+        return {
+            'total': item('total', self.total),
+            'pastas': len(self.por_pasta),
+            'por_pasta': [item(k, v) for k, v in self._lista(self.por_pasta, limite)],
+            'por_extensao': [item(k or '(sem extensão)', v) for k, v in self._lista(self.por_extensao)],
+            'por_dia': [
+                item((_EPOCA + timedelta(days=k)).date().isoformat(), v)
+                for k, v in self._lista(self.por_dia, limite, ordenar_por_chave=True)
+            ]
+        }
+
+
+class _Colunas:
+    """Armazenamento de uma tabela: texto único das keys + arrays de tipos primitivos"""
+
+    __slots__ = ('texto', 'offsets', 'modificado', 'tamanhos', 'pasta_ids', 'pastas',
+                 'etags', 'etag_partes', 'etags_extra', 'nomes', 'offsets_nomes', 'por_key',
+                 'indice', 'docs', 'linha_do_doc', 'agregados', 'por_extensao')
+
+    def __init__(self):
+        self.texto = ''
+        self.offsets = array('Q', [0])      # linha i = texto[offsets[i]:offsets[i+1]-1]
+        self.modificado = array('q')        # µs desde a época
+        self.tamanhos = array('q')
+        self.pasta_ids = array('I')         # índice em `pastas` (strings internadas)
+        self.pastas = []
+        self.etags = bytearray()            # MD5 em 16 bytes por linha
+        self.etag_partes = array('H')       # sufixo '-N' de uploads multipart (0 = sem)
+        self.etags_extra = {}               # linha -> ETag que não cabe no formato acima
+        self.nomes = None                   # nomes de arquivo em minúsculas (montado na 1ª busca)
+        self.offsets_nomes = None
+        self.por_key = array('I')           # linhas ordenadas por key (busca em obter)
+        self.indice = None                  # IndiceTrigramas dos nomes, se a tabela for indexada
+        self.docs = array('I')              # id do nome no índice, por linha
+        self.linha_do_doc = None            # id do nome -> linha (montado na 1ª busca)
+        self.agregados = AgregadosImagens()
+        self.por_extensao = {}              # extensão -> array('I') de linhas (ordem da tabela)
+
+
+def _empacotar_etag(etag):
+    base, _, partes = etag.partition('-')
+    if len(base) != 32 or (partes and not (partes.isdigit() and int(partes) < 65536)):
+        return None
+    try:
+        return bytes.fromhex(base), int(partes or 0)
+    except ValueError:
+        return None
+
+
+class TabelaImagens:
+    """Listagem de imagens em colunas, ordenada por recência (mais recente primeiro)
+
+    Em vez de um dicionário por objeto, guarda as keys num único texto com
+    offsets, datas em µs e tamanhos em arrays, pastas internadas e ETags em
+    16 bytes. Filtros rodam sobre essas colunas e devolvem uma visão (só os
+    números das linhas); os dicionários da API são montados apenas para as
+    linhas efetivamente retornadas (indexação, fatias e iteração).
+    """
+
+    __slots__ = ('_c', '_linhas')
+
+    def __init__(self, colunas=None, linhas=None):
+        self._c = colunas or _Colunas()
+        self._linhas = linhas     # None = todas as linhas de `_c`, senão array('I') de linhas
+
+    # ---------- construção ----------
+
+    @classmethod
+    def construir(cls, registros, ordenado=False, indice=None, agregados=None):
+        """Monta a tabela a partir de registros (ver registro_de_objeto / registro_de_imagem)
+
+        indice: IndiceTrigramas para as buscas por nome. Registros com um 5º
+        campo (id do nome, vindo de mesclar) reaproveitam o que já está indexado;
+        os demais nomes são acrescentados ao índice.
+        agregados: AgregadosImagens já calculados (mesclar); senão são somados aqui.
+        """
+        if not ordenado:
+            registros = sorted(registros, key=_ordem, reverse=True)
+        c = _Colunas()
+        c.indice = indice
+        calcular = agregados is None
+        if not calcular:
+            c.agregados = agregados
+        keys = []
+        pasta_id = {}
+        posicao = 0
+        for registro in registros:
+            micros, key, tamanho, etag = registro[:4]
+            if indice is not None:
+                c.docs.append(registro[4] if len(registro) > 4 else indice.adicionar(key[key.rfind('/') + 1:].lower()))
+            linha = len(c.modificado)
+            extensao = extensao_de(key)
+            bucket = c.por_extensao.get(extensao)
+            if bucket is None:
+                bucket = c.por_extensao[extensao] = array('I')
+            bucket.append(linha)
+            if calcular:
+                c.agregados.somar(micros, key, tamanho)
+            keys.append(key)
+            posicao += len(key) + 1
+            c.offsets.append(posicao)
+            c.modificado.append(micros)
+            c.tamanhos.append(tamanho)
+            pasta = key[:key.rfind('/')] if '/' in key else ''
+            if pasta not in pasta_id:
+                pasta_id[pasta] = len(c.pastas)
+                c.pastas.append(pasta)
+            c.pasta_ids.append(pasta_id[pasta])
+            empacotado = _empacotar_etag(etag or '')
+            if empacotado:
+                c.etags += empacotado[0]
+                c.etag_partes.append(empacotado[1])
+            else:
+                c.etags += bytes(16)
+                c.etag_partes.append(0)
+                c.etags_extra[linha] = etag or ''
+        c.texto = '\n'.join(keys) + '\n' if keys else ''
+        # Índice por key montado aqui (construir/mesclar rodam fora do event loop):
+        # obter nunca paga a ordenação da tabela inteira no meio de uma requisição
+        c.por_key = array('I', sorted(range(len(keys)), key=keys.__getitem__))
+        return cls(c)
+
+    def mesclar(self, novos, removidos=(), compactar=False):
+        """Nova tabela = esta sem `removidos` e sem as keys de `novos`, mais os `novos`
+
+        novos: registros em qualquer ordem. Deltas pequenos viram uma
+        TabelaSobreposta (nada é copiado); com `compactar` ou deltas grandes,
+        merge linear com a tabela (já ordenada).
+        """
+        novos = sorted(novos, key=_ordem, reverse=True)
+        fora = set(removidos) | {r[1] for r in novos}
+        if not fora:
+            return self
+        if not compactar and self._linhas is None and len(fora) <= SOBREPOSICAO_MAX:
+            return TabelaSobreposta(self).mesclar(novos, removidos)
+        c = self._c
+        agregados = c.agregados.copia() if self._linhas is None else None
+        if agregados is not None:
+            for registro in novos:
+                agregados.somar(*registro[:3])
+
+        def base():
+            indexada = c.indice is not None
+            for linha, registro in zip(self.linhas(), self.registros()):
+                if registro[1] in fora:
+                    if agregados is not None:
+                        agregados.somar(*registro[:3], sinal=-1)
+                elif indexada:
+                    # Linhas mantidas levam o id do nome: só os novos são indexados
+                    yield registro + (c.docs[linha],)
+                else:
+                    yield registro
+
+        return TabelaImagens.construir(heapq.merge(novos, base(), key=_ordem, reverse=True),
+                                       ordenado=True, indice=c.indice, agregados=agregados)
+
+    # ---------- acesso ----------
+
+    def __len__(self):
+        return len(self._c.modificado) if self._linhas is None else len(self._linhas)
+
+    def _linha_real(self, i):
+        return i if self._linhas is None else self._linhas[i]
+
+    def linhas(self):
+        return range(len(self._c.modificado)) if self._linhas is None else self._linhas
+
+    def _key(self, linha):
+        c = self._c
+        return c.texto[c.offsets[linha]:c.offsets[linha + 1] - 1]
+
+    def _etag(self, linha):
+        c = self._c
+        if linha in c.etags_extra:
+            return c.etags_extra[linha]
+        etag = c.etags[linha * 16:linha * 16 + 16].hex()
+        partes = c.etag_partes[linha]
+        return f"{etag}-{partes}" if partes else etag
+
+    def _imagem(self, linha):
+        """Dicionário no formato da API (mesmo de objeto_para_imagem) para uma linha"""
+        c = self._c
+        key = self._key(linha)
+        tamanho = c.tamanhos[linha]
+        return {
+            'key': key,
+            'size': tamanho,
+            'last_modified': de_micros(c.modificado[linha]),
+            'file_name': key[key.rfind('/') + 1:],
+            'pasta': c.pastas[c.pasta_ids[linha]],
+            'size_kb': round(tamanho / 1024, 1),
+            'etag': self._etag(linha)
+        }
+
+    def __getitem__(self, indice):
+        if isinstance(indice, slice):
+            return [self._imagem(self._linha_real(i)) for i in range(*indice.indices(len(self)))]
+        if indice < 0:
+            indice += len(self)
+        if not 0 <= indice < len(self):
+            raise IndexError(indice)
+        return self._imagem(self._linha_real(indice))
+
+    def __iter__(self):
+        for linha in self.linhas():
+            yield self._imagem(linha)
+
+    def _registro(self, linha):
+        c = self._c
+        return c.modificado[linha], self._key(linha), c.tamanhos[linha], self._etag(linha)
+
+    def registros(self):
+        """Gera (µs, key, size, etag) de cada linha, na ordem da tabela"""
+        for linha in self.linhas():
+            yield self._registro(linha)
+
+    def pares(self):
+        """Gera (key, etag) de cada linha (para detectar o que mudou entre snapshots)"""
+        for linha in self.linhas():
+            yield self._key(linha), self._etag(linha)
+
+    def _linha_de(self, key):
+        """Linha (nas colunas) da key, se estiver nesta tabela/visão; senão None"""
+        c = self._c
+        baixo, alto = 0, len(c.por_key)
+        while baixo < alto:
+            meio = (baixo + alto) // 2
+            if self._key(c.por_key[meio]) < key:
+                baixo = meio + 1
+            else:
+                alto = meio
+        if baixo < len(c.por_key) and self._key(c.por_key[baixo]) == key:
+            linha = c.por_key[baixo]
+            if self._linhas is None:
+                return linha
+            # Visões guardam as linhas em ordem crescente
+            i = bisect_left(self._linhas, linha)
+            if i < len(self._linhas) and self._linhas[i] == linha:
+                return linha
+        return None
+
+    def obter(self, key):
+        """Imagem pela key (busca binária no índice por key), ou None"""
+        linha = self._linha_de(key)
+        return self._imagem(linha) if linha is not None else None
+
+    # ---------- filtros (sobre as colunas, sem montar dicionários) ----------
+
+    def _nomes_minusculos(self):
+        """Texto só com os nomes de arquivo em minúsculas, com offsets próprios (montado sob demanda)"""
+        c = self._c
+        if c.nomes is None:
+            offsets = array('Q', [0])
+            partes = []
+            for linha in range(len(c.modificado)):
+                key = self._key(linha)
+                nome = key[key.rfind('/') + 1:].lower()
+                partes.append(nome)
+                offsets.append(offsets[-1] + len(nome) + 1)
+            c.offsets_nomes = offsets
+            c.nomes = '\n'.join(partes) + '\n' if partes else ''
+        return c.nomes, c.offsets_nomes
+
+    @property
+    def indexada(self):
+        return self._c.indice is not None
+
+    def agregados(self, limite=None):
+        """Resumo por pasta, extensão e dia (pré-calculado; só da tabela inteira)"""
+        if self._linhas is not None:
+            agregados = AgregadosImagens()
+            for registro in self.registros():
+                agregados.somar(*registro[:3])
+            return agregados.resumo(limite)
+        return self._c.agregados.resumo(limite)
+
+    def status_indice(self):
+        return self._c.indice.status() if self._c.indice is not None else None
+
+    def documentos_indexados(self):
+        """Quantos nomes existem no índice (inclusive de linhas que já saíram)"""
+        return len(self._c.indice) if self._c.indice is not None else 0
+
+    def _linhas_indexadas(self, termo, inicio):
+        c = self._c
+        if c.linha_do_doc is None:
+            linha_do_doc = array('i', [-1]) * (max(c.docs) + 1 if c.docs else 0)
+            for linha, doc in enumerate(c.docs):
+                linha_do_doc[doc] = linha
+            c.linha_do_doc = linha_do_doc
+        mapa = c.linha_do_doc
+        # Ids de nomes que não são desta tabela (removidos ou de snapshots mais novos) ficam de fora
+        linhas = [mapa[doc] for doc in c.indice.buscar(termo, inicio) if doc < len(mapa) and mapa[doc] >= 0]
+        linhas.sort()
+        return linhas
+
+    def _linhas_com_termo(self, termo, inicio=False):
+        """Linhas cujo nome de arquivo contém `termo` (ou começa com ele), case-insensitive
+
+        Tabelas indexadas usam o índice de trigramas; as demais, find no texto dos nomes.
+        """
+        if self._c.indice is not None:
+            return self._linhas_indexadas(termo, inicio)
+        texto, offsets = self._nomes_minusculos()
+        termo = termo.lower()
+        encontradas = array('I')
+        posicao = texto.find(termo)
+        while posicao != -1:
+            linha = bisect_right(offsets, posicao) - 1
+            fim = offsets[linha + 1] - 1
+            if posicao + len(termo) <= fim and (not inicio or posicao == offsets[linha]):
+                encontradas.append(linha)
+                # Próxima linha (um nome conta uma vez só)
+                posicao = texto.find(termo, fim + 1)
+            else:
+                posicao = texto.find(termo, posicao + 1)
+        return encontradas
+
+    def filtrar(self, prefix=None, termo=None, extensoes=None, pasta=None, funcao=None, inicio=False):
+        """Visão com as linhas que passam em todos os filtros informados
+
+        prefix: início da key; termo: substring do nome do arquivo (início
+        do nome, se `inicio`);
+        extensoes: tupla de sufixos ('.jpg', ...), case-insensitive;
+        pasta: pasta exata; funcao: predicado sobre o dicionário da imagem.
+        """
+        c = self._c
+        todas = linhas = self.linhas()
+        if termo:
+            candidatas = self._linhas_com_termo(termo, inicio)
+            if self._linhas is not None:
+                visiveis = set(self._linhas)
+                candidatas = [linha for linha in candidatas if linha in visiveis]
+            linhas = candidatas
+        if pasta is not None:
+            pasta = pasta.rstrip('/')
+            pasta_id = c.pastas.index(pasta) if pasta in c.pastas else -1
+            linhas = [linha for linha in linhas if c.pasta_ids[linha] == pasta_id]
+        if prefix:
+            texto, offsets = c.texto, c.offsets
+            linhas = [linha for linha in linhas if texto.startswith(prefix, offsets[linha], offsets[linha + 1] - 1)]
+        if extensoes:
+            extensoes = tuple(e.lower() for e in extensoes)
+            if linhas is todas and self._linhas is None and all(e.count('.') == 1 and e.startswith('.')
+                                                                   for e in extensoes):
+                # Tabela inteira e extensões simples: os buckets já têm as linhas prontas
+                buckets = [c.por_extensao.get(e, ()) for e in dict.fromkeys(extensoes)]
+                # Cada bucket já está em ordem: o sort do Python junta as sequências quase em tempo linear
+                linhas = buckets[0] if len(buckets) == 1 else array('I', sorted(chain.from_iterable(buckets)))
+            elif c.indice is not None:
+                # Os nomes em minúsculas já estão no índice: não monta outro texto
+                sufixos = tuple(e.encode('utf-8') for e in extensoes)
+                linhas = [linha for linha in linhas if c.indice.termina_com(c.docs[linha], sufixos)]
+            else:
+                texto, offsets = self._nomes_minusculos()
+                linhas = [linha for linha in linhas
+                          if texto.endswith(extensoes, offsets[linha], offsets[linha + 1] - 1)]
+        if funcao:
+            linhas = [linha for linha in linhas if funcao(self._imagem(linha))]
+        if linhas is todas:
+            return self
+        # Filtros preservam a ordem das linhas (por recência)
+        return TabelaImagens(c, linhas if isinstance(linhas, array) else array('I', linhas))
+
+    # ---------- paginação ----------
+
+    def _indice_apos(self, alvo):
+        """Posição do primeiro item depois de `alvo` = (µs, key) na ordem decrescente"""
+        c = self._c
+        baixo, alto = 0, len(self)
+        while baixo < alto:
+            meio = (baixo + alto) // 2
+            linha = self._linha_real(meio)
+            if (c.modificado[linha], self._key(linha)) < alvo:
+                alto = meio
+            else:
+                baixo = meio + 1
+        return baixo
+
+    def pagina(self, limite, apos=None):
+        """Próximas `limite` imagens depois da posição `apos` = (last_modified, key)"""
+        inicio = 0 if apos is None else self._indice_apos((para_micros(apos[0]), apos[1]))
+        return self[inicio:inicio + limite], inicio + limite < len(self)
+
+    def sobrepostas(self):
+        """Linhas pendentes de compactação (sempre 0: a tabela já é compacta)"""
+        return 0
+
+    def compactar(self):
+        return self
+
+    def memoria(self):
+        """Bytes aproximados das colunas (sem contar índices montados sob demanda)"""
+        c = self._c
+        return (len(c.texto) + c.offsets.itemsize * len(c.offsets)
+                + (c.modificado.itemsize + c.tamanhos.itemsize + c.pasta_ids.itemsize
+                   + c.etag_partes.itemsize + 16) * len(c.modificado)
+                + sum(len(p) for p in c.pastas))
+
+
+class TabelaSobreposta:
+    """Tabela base (sem cópia) + um delta pequeno por cima, com a mesma interface de TabelaImagens
+
+    Eventos do S3 chegam um a um; reconstruir as colunas a cada um custa O(N).
+    Aqui as imagens novas/alteradas ficam numa tabela pequena (`frente`) e as
+    keys removidas ou substituídas viram linhas ocultas da base; a leitura
+    junta as duas na ordem por recência. Passando de SOBREPOSICAO_MAX linhas,
+    ou em compactar() (periodicamente, fora das requisições), tudo vira uma
+    TabelaImagens comum de novo.
+    """
+
+    __slots__ = ('_base', '_frente', '_fora', '_ocultas', '_ajuste', '_pos_frente', '_agregados')
+
+    def __init__(self, base, frente=None, fora=frozenset(), ocultas=()):
+        # base: TabelaImagens; frente: TabelaImagens pequena, sem índice de trigramas
+        # fora: keys cuja versão da base não vale mais; ocultas: linhas da base dessas
+        # keys (só com a base inteira, em que posição = linha)
+        self._base = base
+        self._frente = frente if frente is not None else TabelaImagens()
+        self._fora = frozenset(fora)
+        self._ocultas = array('I', sorted(ocultas))
+        # Posição visível -> posição na base: soma as ocultas que ficam antes
+        self._ajuste = [linha - i for i, linha in enumerate(self._ocultas)]
+        # Posição de cada linha da frente na ordem combinada
+        self._pos_frente = []
+        for i, registro in enumerate(self._frente.registros()):
+            antes = base._indice_apos(_ordem(registro))
+            self._pos_frente.append(i + antes - bisect_left(self._ocultas, antes))
+        self._agregados = None
+
+    def mesclar(self, novos, removidos=(), compactar=False):
+        novos = sorted(novos, key=_ordem, reverse=True)
+        chaves = set(removidos) | {r[1] for r in novos}
+        if not chaves:
+            return self
+        base = self._base
+        if base._linhas is not None:
+            # Visão filtrada: não é um snapshot, junta tudo de uma vez
+            return self.compactar().mesclar(novos, removidos, compactar=True)
+        frente = self._frente.mesclar(novos, removidos, compactar=True)
+        ocultas = set(self._ocultas)
+        ocultas.update(linha for linha in map(base._linha_de, chaves) if linha is not None)
+        sobreposta = TabelaSobreposta(base, frente, self._fora | chaves, ocultas)
+        if compactar or sobreposta.sobrepostas() > SOBREPOSICAO_MAX:
+            return sobreposta.compactar()
+        return sobreposta
+
+    def compactar(self):
+        """TabelaImagens com a base e o delta juntos (merge linear, O(N))"""
+        if not self._fora:
+            return self._base
+        return self._base.mesclar(self._frente.registros(), self._fora, compactar=True)
+
+    def sobrepostas(self):
+        """Linhas novas + ocultas acumuladas por cima da base"""
+        return len(self._frente) + len(self._ocultas)
+
+    # ---------- acesso ----------
+
+    def __len__(self):
+        return len(self._base) - len(self._ocultas) + len(self._frente)
+
+    def _fonte(self, posicao):
+        """(tabela, linha) do item na posição `posicao` da ordem combinada"""
+        j = bisect_left(self._pos_frente, posicao)
+        if j < len(self._pos_frente) and self._pos_frente[j] == posicao:
+            return self._frente, self._frente._linha_real(j)
+        visivel = posicao - j
+        return self._base, self._base._linha_real(visivel + bisect_right(self._ajuste, visivel))
+
+    def _fontes(self):
+        """Gera (tabela, linha) de cada item na ordem combinada"""
+        frente, pos_frente = self._frente, self._pos_frente
+        ocultas = set(self._ocultas)
+        j = posicao = 0
+        for linha in self._base.linhas():
+            if linha in ocultas:
+                continue
+            while j < len(pos_frente) and pos_frente[j] == posicao:
+                yield frente, frente._linha_real(j)
+                j += 1
+                posicao += 1
+            yield self._base, linha
+            posicao += 1
+        for j in range(j, len(pos_frente)):
+            yield frente, frente._linha_real(j)
+
+    def __getitem__(self, indice):
+        if isinstance(indice, slice):
+            return [tabela._imagem(linha)
+                    for tabela, linha in map(self._fonte, range(*indice.indices(len(self))))]
+        if indice < 0:
+            indice += len(self)
+        if not 0 <= indice < len(self):
+            raise IndexError(indice)
+        tabela, linha = self._fonte(indice)
+        return tabela._imagem(linha)
+
+    def __iter__(self):
+        for tabela, linha in self._fontes():
+            yield tabela._imagem(linha)
+
+    def registros(self):
+        for tabela, linha in self._fontes():
+            yield tabela._registro(linha)
+
+    def pares(self):
+        for tabela, linha in self._fontes():
+            yield tabela._key(linha), tabela._etag(linha)
+
+    def obter(self, key):
+        img = self._frente.obter(key)
+        if img is not None or key in self._fora:
+            return img
+        return self._base.obter(key)
+
+    # ---------- filtros ----------
+
+    @property
+    def indexada(self):
+        return self._base.indexada
+
+    def status_indice(self):
+        return self._base.status_indice()
+
+    def documentos_indexados(self):
+        return self._base.documentos_indexados()
+
+    def agregados(self, limite=None):
+        if self._agregados is None:
+            if self._base._linhas is None:
+                # Agregados da base já prontos: só desconta as ocultas e soma a frente
+                agregados = self._base._c.agregados.copia()
+                for linha in self._ocultas:
+                    agregados.somar(*self._base._registro(linha)[:3], sinal=-1)
+            else:
+                agregados = AgregadosImagens()
+                for registro in self._base.registros():
+                    agregados.somar(*registro[:3])
+            for registro in self._frente.registros():
+                agregados.somar(*registro[:3])
+            self._agregados = agregados
+        return self._agregados.resumo(limite)
+
+    def filtrar(self, prefix=None, termo=None, extensoes=None, pasta=None, funcao=None, inicio=False):
+        """Mesmos filtros de TabelaImagens.filtrar, aplicados à base e à frente"""
+        base = self._base.filtrar(prefix, termo, extensoes, pasta, funcao, inicio)
+        frente = self._frente.filtrar(prefix, termo, extensoes, pasta, funcao, inicio)
+        if base is self._base and frente is self._frente:
+            return self
+        if self._ocultas:
+            ocultas = set(self._ocultas)
+            base = TabelaImagens(base._c, array('I', (linha for linha in base.linhas() if linha not in ocultas)))
+        return TabelaSobreposta(base, frente)
+
+    def pagina(self, limite, apos=None):
+        inicio = 0
+        if apos is not None:
+            alvo = (para_micros(apos[0]), apos[1])
+            antes = self._base._indice_apos(alvo)
+            inicio = antes - bisect_left(self._ocultas, antes) + self._frente._indice_apos(alvo)
+        return self[inicio:inicio + limite], inicio + limite < len(self)
+
+    def memoria(self):
+        return self._base.memoria() + self._frente.memoria()
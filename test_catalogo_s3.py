@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from catalogo_s3 import ArmazemCatalogo, SincronizadorCatalogo
+
+BUCKET = 'aplis2'
+RAIZ = 'lab/Arquivos/Foto/'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'teste')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'teste')
+    with moto.mock_aws():
+        cliente = boto3.client('s3', region_name='sa-east-1')
+        cliente.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'sa-east-1'})
+        yield cliente
+
+
+@pytest.fixture
+def sincronizador(s3, tmp_path):
+    armazem = ArmazemCatalogo(tmp_path / 'catalogo.db')
+    return SincronizadorCatalogo(lambda: s3, BUCKET, [RAIZ], armazem)
+
+
+def enviar(s3, *keys):
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'x')
+
+
+def keys_do_armazem(sincronizador):
+    return {img['key'] for img in sincronizador.armazem.todas()}
+
+
+def test_pasta_removida_nao_quebra_sincronizacao(s3, sincronizador):
+    enviar(s3, RAIZ + '0031/00310000001.jpg', RAIZ + '0200/02000000001.jpg')
+    sincronizador.sincronizar()
+    assert set(sincronizador.armazem.marcas()) == {RAIZ + '0031/', RAIZ + '0200/'}
+
+    s3.delete_object(Bucket=BUCKET, Key=RAIZ + '0200/02000000001.jpg')
+    novos, removidos = sincronizador.sincronizar()
+    assert removidos == [RAIZ + '0200/02000000001.jpg']
+    assert set(sincronizador.armazem.marcas()) == {RAIZ + '0031/'}
+
+    # As sincronizações seguintes continuam funcionando
+    enviar(s3, RAIZ + '0031/00310000002.jpg')
+    novos, _ = sincronizador.sincronizar()
+    assert [img['key'] for img in novos] == [RAIZ + '0031/00310000002.jpg']
+
+
+def test_marca_ignora_arquivos_fora_da_numeracao(s3, sincronizador):
+    enviar(s3, RAIZ + '0200/0200ABC001.jpg', RAIZ + '0200/note.txt', RAIZ + '0200/Thumbs.db')
+    sincronizador.sincronizar()
+    assert sincronizador.armazem.marcas()[RAIZ + '0200/']['ultima_key'] == RAIZ + '0200/0200ABC001.jpg'
+
+    enviar(s3, RAIZ + '0200/0200ABC999.jpg')
+    sincronizador.sincronizar()
+    assert RAIZ + '0200/0200ABC999.jpg' in keys_do_armazem(sincronizador)
+
+
+def test_key_abaixo_da_marca_reconcilia_a_pasta(s3, sincronizador):
+    enviar(s3, RAIZ + '0031/00310000005.jpg')
+    sincronizador.sincronizar()
+
+    enviar(s3, RAIZ + '0031/00310000001.jpg')
+    assert sincronizador.observar_keys([RAIZ + '0031/00310000001.jpg']) == {RAIZ + '0031/'}
+    sincronizador.sincronizar()
+    assert sincronizador.ultima_execucao['pastas_reconciliadas'] == 1
+    assert RAIZ + '0031/00310000001.jpg' in keys_do_armazem(sincronizador)
+
+
+def test_incremental_nao_repete_arquivos_fora_da_numeracao(s3, sincronizador):
+    enviar(s3, RAIZ + '0031/00310000001.jpg', RAIZ + '0031/IMG_0001.jpg', RAIZ + '0031/Thumbs.db')
+    sincronizador.sincronizar()
+
+    # Ficam acima da marca e voltam na listagem com StartAfter, mas não mudaram
+    novos, _ = sincronizador.sincronizar()
+    assert sincronizador.ultima_execucao['pastas_reconciliadas'] == 0
+    assert novos == []
+
+    enviar(s3, RAIZ + '0031/00310000002.jpg')
+    novos, _ = sincronizador.sincronizar()
+    assert [img['key'] for img in novos] == [RAIZ + '0031/00310000002.jpg']